@@ -4,6 +4,7 @@ from flask_babel import Babel
 import config
 from flask_wtf.csrf import CSRFProtect
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy import event
 from flask_admin import Admin
@@ -42,12 +43,25 @@ class Base(DeclarativeBase):
 
 #connect_args={"options": "-c timezone=utc"}
 
+class BcourseSession(Session):
+    """
+    Session whose commit() only flushes while session.info['defer_commit'] 
+    is set: code that commits after each step can run as part of a larger 
+    transaction (see admin_api.batch), the owner of the flag commits.
+    """
+    def commit(self):
+        if self.info.get('defer_commit'):
+            self.flush()
+            return
+        super().commit()
+
+
 menu_structure = Menu('root')
 
 moment = Moment()
 mobility = Mobility()
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={'class_': BcourseSession})
 
 MyFsModels.set_db_info(base_model=Base)
 
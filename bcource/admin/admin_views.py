@@ -1,6 +1,6 @@
 from bcource import db
 from bcource import table_admin
-from bcource.models import User, Role, Permission, Content
+from bcource.models import User, Role, Permission, Content, MessageTag
 from flask_security import current_user, hash_password
 from wtforms.fields import PasswordField
 from flask import current_app, url_for, abort, redirect, request, flash
@@ -120,6 +120,17 @@ class ContentModelView(CkModelView, AuthModelView):
 table_admin.add_view(ContentModelView(Content, db.session, ckfields=["text"])) #@UndefinedVariable
 
 
+class MessageTagAdmin(AuthModelView):
+    form_columns = ["tag", "hidden", "retention_days"]
+    column_list = ["tag", "hidden", "retention_days", "created_date"]
+    column_searchable_list = ['tag']
+    column_descriptions = {'retention_days': 'Archive and purge messages with this tag after this many days, 0 keeps them. '
+                                               'Empty uses BCOURSE_MESSAGE_RETENTION_DAYS; a message with several tags is kept for the longest'}
+    permission = "admin-messagetag-edit"
+
+table_admin.add_view(MessageTagAdmin(MessageTag, db.session, category='Messages'))
+
+
 class ApiTokenView(BaseView):
     @expose('/', methods=['GET', 'POST'])
     def index(self):
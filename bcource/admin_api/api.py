@@ -53,4 +53,6 @@ from bcource.admin_api import students        # noqa: E402, F401
 from bcource.admin_api import trainings       # noqa: E402, F401
 from bcource.admin_api import training_events # noqa: E402, F401
 from bcource.admin_api import enrollments     # noqa: E402, F401
+from bcource.admin_api import changes         # noqa: E402, F401
+from bcource.admin_api import batch           # noqa: E402, F401
 from bcource.admin_api import auth            # noqa: E402, F401
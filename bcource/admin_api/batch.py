@@ -0,0 +1,164 @@
+import time
+from collections import namedtuple
+
+from flask import current_app
+from flask_restx import Namespace, Resource, abort, marshal
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import HTTPException
+
+from bcource import db
+import bcource.messages as system_msg
+from bcource.admin_api.api import api
+from bcource.admin_api.auth import admin_required
+from bcource.admin_api.serializers import (
+    batch_input, batch_result, training_input, training_update_input, training_detail_model,
+    enrollment_input, enrollment_model, enrollment_action_input, enrollment_action_result,
+)
+from bcource.admin_api.trainings import create_training, update_training
+from bcource.admin_api.enrollments import enroll_student, enrollment_action, remove_enrollment
+from bcource.models import Training
+
+ns = Namespace('batch', description='Several operations in one request and one transaction')
+api.add_namespace(ns)
+
+# function(*params, data) of an operation, the input model of data (None: no body),
+# the response model and the status code of the single endpoint
+Operation = namedtuple('Operation', 'function params body model status')
+
+OPERATIONS = {
+    'create_training': Operation(create_training, (), training_input, training_detail_model, 201),
+    'update_training': Operation(update_training, ('training_id',), training_update_input,
+                                 training_detail_model, 200),
+    'enroll': Operation(enroll_student, ('training_id',), enrollment_input, enrollment_model, 201),
+    'enrollment_action': Operation(enrollment_action, ('training_id', 'student_id'), enrollment_action_input,
+                                   enrollment_action_result, 200),
+    'remove_enrollment': Operation(remove_enrollment, ('training_id', 'student_id'), None, None, 204),
+}
+
+MODES = ('atomic', 'best-effort')
+
+
+def run_operation(operation, op):
+    """Run one operation of a batch, returns the marshalled result (None for operations without a body)."""
+    args = []
+    for name in operation.params:
+        if not isinstance(op.get(name), int):
+            abort(400, f'{name} is required')
+        args.append(op[name])
+    if operation.body is not None:
+        data = op.get('data') or {}
+        operation.body.validate(data)
+        args.append(data)
+
+    result = operation.function(*args)
+    return marshal(result, operation.model) if operation.model is not None else None
+
+
+def _fresh_view(session):
+    """
+    Let the next operation see the database as a request of its own would: 
+    reload the instances, forget the enrollment counts cached on trainings.
+    """
+    session.expire_all()
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Training):
+            obj.init_on_load()
+
+
+def _error(e):
+    """(status, message) of an exception raised by an operation."""
+    if isinstance(e, HTTPException):
+        message = (getattr(e, 'data', None) or {}).get('message') or e.description
+        return e.code, message
+    return 409, str(getattr(e, 'orig', None) or e)
+
+
+@ns.route('/')
+class Batch(Resource):
+    @ns.doc('batch')
+    @ns.expect(batch_input)
+    @ns.marshal_with(batch_result)
+    @admin_required
+    def post(self):
+        """Run a list of operations in order, in one database transaction.
+
+        Each operation is one of the single endpoints: create_training,
+        update_training, enroll, enrollment_action or remove_enrollment,
+        with the same validation and flow. The result of every operation
+        has the status code and body the single endpoint would have
+        returned, or the error.
+
+        - **atomic** (default): all operations are committed or none. The
+          first failure rolls back the batch, the operations after it are
+          not run (committed is false).
+        - **best-effort**: a failed operation is rolled back on its own,
+          the successful operations are committed.
+
+        Operations are not run after ADMIN_API_BATCH_MAX_SECONDS; they fail
+        with status 503, so the transaction stays short.
+
+        Notifications (e-mail, SMS, message center) of the committed
+        operations are sent after the commit; nothing is sent for
+        operations that were rolled back.
+        """
+        data = api.payload or {}
+        mode = data.get('mode') or 'atomic'
+        if mode not in MODES:
+            abort(400, f'mode must be one of: {", ".join(MODES)}')
+
+        operations = data.get('operations')
+        if not isinstance(operations, list) or not operations:
+            abort(400, 'operations must be a non-empty list')
+        maximum = current_app.config['ADMIN_API_BATCH_MAX_OPERATIONS']
+        if len(operations) > maximum:
+            abort(400, f'At most {maximum} operations per batch')
+        for index, op in enumerate(operations):
+            if not isinstance(op, dict) or op.get('op') not in OPERATIONS:
+                abort(400, f'Operation {index}: op must be one of: {", ".join(OPERATIONS)}')
+
+        session = db.session()
+        results = []
+        outbox = []
+        failed = False
+        deadline = time.monotonic() + current_app.config['ADMIN_API_BATCH_MAX_SECONDS']
+
+        # the commits of the operations only flush, each operation runs in a savepoint
+        session.info['defer_commit'] = True
+        try:
+            for index, op in enumerate(operations):
+                operation = OPERATIONS[op['op']]
+                result = {'index': index, 'op': op['op'], 'status': None, 'ok': False}
+                results.append(result)
+
+                if failed and mode == 'atomic':
+                    result['error'] = 'Not run: an earlier operation failed'
+                    continue
+                if time.monotonic() > deadline:
+                    result['status'], result['error'] = 503, 'Not run: the batch time limit was reached'
+                    failed = True
+                    continue
+
+                _fresh_view(session)
+                savepoint = session.begin_nested()
+                try:
+                    with system_msg.deferred_messages() as messages:
+                        result['result'] = run_operation(operation, op)
+                    savepoint.commit()
+                except (HTTPException, SQLAlchemyError) as e:
+                    savepoint.rollback()
+                    result['status'], result['error'] = _error(e)
+                    failed = True
+                else:
+                    result['status'] = operation.status
+                    result['ok'] = True
+                    outbox.extend(messages)
+        finally:
+            session.info.pop('defer_commit', None)
+
+        if failed and mode == 'atomic':
+            session.rollback()
+            return {'mode': mode, 'committed': False, 'results': results}
+
+        session.commit()
+        system_msg.send_deferred(outbox)
+        return {'mode': mode, 'committed': True, 'results': results}
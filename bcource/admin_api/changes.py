@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+
+from flask import current_app
+from flask_restx import Namespace, Resource, marshal
+from sqlalchemy import select, func, or_, tuple_, exists
+from sqlalchemy.orm import aliased
+
+from bcource import db
+from bcource.admin_api.api import api
+from bcource.admin_api.auth import admin_required
+from bcource.admin_api.pagination import eager_loads
+from bcource.admin_api.serializers import (
+    change_list_model, training_summary_model, training_event_model, enrollment_model,
+)
+from bcource.admin_api.trainings import summary_loads
+from bcource.admin_api.training_events import event_loads
+from bcource.admin_api.enrollments import enrollment_loads
+from bcource.models import EntityChange, Training, TrainingEvent, TrainingEnroll, Practice
+
+ns = Namespace('changes', description='Change feed for integrations')
+api.add_namespace(ns)
+
+parser = ns.parser()
+parser.add_argument('since', type=int, default=0, help='Cursor of the last change seen (0: from the start)',
+                    location='args')
+parser.add_argument('limit', type=int, help='Maximum number of changes (default and maximum are configured)',
+                    location='args')
+
+
+def current_states(changes):
+    """{(entity, training_id, ref_id): data} of the changed entities that still exist, one query per entity."""
+    keys = {entity: {(c.training_id, c.ref_id) for c in changes if c.entity == entity}
+            for entity in ('training', 'event', 'enrollment')}
+    states = {}
+
+    if keys['training']:
+        trainings = Training.query.options(*eager_loads(summary_loads, summary_loads)).filter(
+            Training.id.in_({training_id for training_id, _ in keys['training']}))
+        for training in trainings:
+            states[('training', training.id, None)] = marshal(training, training_summary_model)
+
+    if keys['event']:
+        events = TrainingEvent.query.options(*event_loads['location_name']).filter(
+            TrainingEvent.id.in_({event_id for _, event_id in keys['event']}))
+        for event in events:
+            states[('event', event.training_id, event.id)] = marshal(event, training_event_model)
+
+    if keys['enrollment']:
+        enrollments = TrainingEnroll.query.options(*enrollment_loads['student_name']).filter(
+            tuple_(TrainingEnroll.training_id, TrainingEnroll.student_id).in_(keys['enrollment']))
+        for enrollment in enrollments:
+            states[('enrollment', enrollment.training_id, enrollment.student_id)] = marshal(enrollment, enrollment_model)
+
+    return states
+
+
+@ns.route('/')
+class ChangeList(Resource):
+    @ns.doc('list_changes')
+    @ns.expect(parser)
+    @ns.marshal_with(change_list_model)
+    @admin_required
+    def get(self):
+        """Trainings, events and enrollments created, updated or deleted after the since cursor.
+
+        Changes are returned in the order they were logged, each with the
+        current state of the entity (null once it is deleted: a tombstone).
+        Start with since=0 (or a full sync of the list endpoints and the
+        cursor of a since=0 call) and pass the returned cursor as since in
+        the next poll; poll again right away while has_more is true.
+
+        Changes are inserted right before their transaction commits (a
+        rolled back transaction or savepoint takes no ids) but only become
+        visible once it has: a missing id below a visible one may still be
+        committing. The feed stops before such a gap until the change after
+        it is older than ADMIN_API_CHANGES_GAP_SECONDS, after which the gap
+        is a failed commit.
+        """
+        args = parser.parse_args()
+        practice = Practice.default_row()
+
+        limit = args.get('limit') or current_app.config['ADMIN_API_PAGE_SIZE']
+        limit = max(1, min(limit, current_app.config['ADMIN_API_MAX_PAGE_SIZE']))
+        open_since = datetime.utcnow() - timedelta(seconds=current_app.config['ADMIN_API_CHANGES_GAP_SECONDS'])
+
+        # stop before the first change whose id follows a missing id that may still commit
+        previous = aliased(EntityChange)
+        after_gap = select(func.min(EntityChange.id)).where(
+            EntityChange.id > args['since'] + 1,
+            EntityChange.created_date > open_since,
+            ~exists().where(previous.id == EntityChange.id - 1),
+            ).scalar_subquery().correlate(None)
+        changes = db.session.scalars(select(EntityChange).where(
+            EntityChange.practice_id == practice.id,
+            EntityChange.id > args['since'],
+            or_(after_gap.is_(None), EntityChange.id < after_gap),
+            ).order_by(EntityChange.id).limit(limit + 1)).all()
+
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+        states = current_states(changes)
+
+        return {
+            'changes': [dict(cursor=c.id, entity=c.entity, op=c.op, training_id=c.training_id,
+                             event_id=c.ref_id if c.entity == 'event' else None,
+                             student_id=c.ref_id if c.entity == 'enrollment' else None,
+                             changed_at=c.created_date,
+                             data=states.get((c.entity, c.training_id, c.ref_id)) if c.op != 'deleted' else None)
+                        for c in changes],
+            'cursor': changes[-1].id if changes else args['since'],
+            'has_more': has_more,
+        }
@@ -5,18 +5,140 @@ from bcource.admin_api.serializers import (
     enrollment_action_input, enrollment_action_result,
 )
 from bcource.admin_api.api import api
+from bcource.admin_api.pagination import add_list_arguments, paginated
 from bcource.admin_api.trainings import ns
-from bcource.models import Training, TrainingEnroll, Student, User, Practice
+from bcource.models import Training, TrainingEnroll, Student, User, Practice, UserChange, EntityChange
 from bcource.students.common import (
     invite_from_waitlist, deinvite_from_waitlist,
     enroll_from_waitlist, enroll_common, deroll_common,
 )
 from bcource import db
+from sqlalchemy import func, select, update, case
+from sqlalchemy.orm import joinedload
+from uuid import uuid4
+import datetime
 
 enroll_parser = ns.parser()
 enroll_parser.add_argument('status', type=str, help='Filter by enrollment status '
                            '(enrolled, waitlist, waitlist-invited, waitlist-invite-expired, '
                            'waitlist-declined)', location='args')
+add_list_arguments(enroll_parser)
+
+_student = joinedload(TrainingEnroll.student).joinedload(Student.user)
+enrollment_loads = {'student_name': [_student], 'student_email': [_student]}
+# enrole_date is nullable, the keyset comparison needs a value
+enrole_date_key = func.coalesce(TrainingEnroll.enrole_date, datetime.datetime(1970, 1, 1))
+# statuses that take one of the max_participants spots of a training
+SPOT_STATUSES = ('enrolled', 'waitlist-invited')
+
+
+def enroll_student(training_id, data):
+    """Enroll data['student_id'] in a training (see EnrollmentList.post), returns the enrollment."""
+    training = Training.query.get_or_404(training_id)
+
+    student = Student.query.get(data['student_id'])
+    if not student:
+        abort(400, 'Invalid student_id')
+
+    result = enroll_common(training, student.user)
+
+    if not result:
+        existing = TrainingEnroll.query.filter_by(
+            student_id=data['student_id'],
+            training_id=training_id,
+        ).first()
+        if existing and existing.status not in (
+            'waitlist-invite-expired', 'waitlist-declined', 'force-off-waitlist'
+        ):
+            abort(409, f'Student is already enrolled with status: {existing.status}')
+        abort(400, 'Enrollment failed — student may not be active or training may have started')
+
+    enrollment = TrainingEnroll.query.filter_by(
+        student_id=data['student_id'],
+        training_id=training_id,
+    ).first()
+    return enrollment
+
+
+def remove_enrollment(training_id, student_id):
+    """Remove an enrollment as an admin (see EnrollmentDetail.delete)."""
+    training = Training.query.get_or_404(training_id)
+    enrollment = TrainingEnroll.query.filter_by(
+        training_id=training_id,
+        student_id=student_id,
+    ).first_or_404()
+
+    result = deroll_common(training, enrollment.student.user, admin=True)
+    if not result:
+        abort(400, 'De-enrollment failed — training may have already started')
+
+
+def enrollment_action(training_id, student_id, data):
+    """Perform data['action'] on an enrollment (see EnrollmentAction.post), returns the action result."""
+    training = Training.query.get_or_404(training_id)
+    enrollment = TrainingEnroll.query.filter_by(
+        training_id=training_id,
+        student_id=student_id,
+    ).first_or_404()
+
+    action = data['action']
+
+    if action == 'invite':
+        if enrollment.status != 'waitlist':
+            abort(400, f'Cannot invite: current status is {enrollment.status}, must be waitlist')
+        # Check spot availability (mirrors training_detail_view.invite)
+        if not training.wait_list_spot_available(enrollment.student):
+            abort(409, 'No spots available — training is at capacity (enrolled + waitlist-invited)')
+        invite_from_waitlist(enrollment)
+
+    elif action == 'deinvite':
+        if enrollment.status != 'waitlist-invited':
+            abort(400, f'Cannot de-invite: current status is {enrollment.status}, must be waitlist-invited')
+        deinvite_from_waitlist(enrollment)
+
+    elif action == 'return-to-waitlist':
+        # Mirrors training_detail_view.deinvite — sets back to waitlist silently
+        if enrollment.status != 'waitlist-invited':
+            abort(400, f'Cannot return to waitlist: current status is {enrollment.status}, must be waitlist-invited')
+        enrollment.status = 'waitlist'
+        db.session.commit()
+
+    elif action == 'force-enroll':
+        if enrollment.status != 'waitlist':
+            abort(400, f'Cannot force-enroll: current status is {enrollment.status}, must be waitlist')
+        enrollment.status = 'force-off-waitlist'
+        db.session.commit()
+        result = enroll_common(training, enrollment.student.user)
+        if not result:
+            abort(500, 'Force-enroll failed unexpectedly')
+        enrollment = TrainingEnroll.query.filter_by(
+            training_id=training_id,
+            student_id=student_id,
+        ).first()
+
+    elif action == 'decline':
+        if enrollment.status != 'waitlist-invited':
+            abort(400, f'Cannot decline: current status is {enrollment.status}, must be waitlist-invited')
+        enrollment.status = 'waitlist-declined'
+        db.session.commit()
+        # Cascade: invite next eligible waitlisted students (mirrors scheduler_views.decline_invite)
+        for eligible in training.waitlist_enrollments_eligeble():
+            invite_from_waitlist(eligible)
+
+    elif action == 'toggle-paid':
+        enrollment.paid = not enrollment.paid
+        db.session.commit()
+
+    else:
+        abort(400, f'Unknown action: {action}. '
+              'Must be invite, deinvite, return-to-waitlist, force-enroll, decline, or toggle-paid')
+
+    return {
+        'student_id': student_id,
+        'training_id': training_id,
+        'status': enrollment.status,
+        'action': action,
+    }
 
 
 @ns.route('/<int:training_id>/enrollments')
@@ -24,10 +146,10 @@ enroll_parser.add_argument('status', type=str, help='Filter by enrollment status
 class EnrollmentList(Resource):
     @ns.doc('list_enrollments')
     @ns.expect(enroll_parser)
-    @ns.marshal_list_with(enrollment_model)
+    @ns.response(200, 'Success', [enrollment_model])
     @admin_required
     def get(self, training_id):
-        """List enrollments for a training.
+        """List enrollments for a training in enrollment order, one page at a time.
 
         Possible status values: enrolled, waitlist, waitlist-invited,
         waitlist-invite-expired, waitlist-declined.
@@ -40,7 +162,8 @@ class EnrollmentList(Resource):
         if args.get('status'):
             query = query.filter_by(status=args['status'])
 
-        return query.order_by(TrainingEnroll.enrole_date).all()
+        return paginated(query, enrollment_model, args, TrainingEnroll.student_id,
+                         order=(enrole_date_key,), loads=enrollment_loads)
 
     @ns.doc('enroll_student')
     @ns.expect(enrollment_input)
@@ -60,31 +183,7 @@ class EnrollmentList(Resource):
         Note: booking policies (max-2-sessions-4-weeks) are NOT enforced here,
         matching the admin enrollment behaviour in the web UI.
         """
-        training = Training.query.get_or_404(training_id)
-        data = api.payload
-
-        student = Student.query.get(data['student_id'])
-        if not student:
-            abort(400, 'Invalid student_id')
-
-        result = enroll_common(training, student.user)
-
-        if not result:
-            existing = TrainingEnroll.query.filter_by(
-                student_id=data['student_id'],
-                training_id=training_id,
-            ).first()
-            if existing and existing.status not in (
-                'waitlist-invite-expired', 'waitlist-declined', 'force-off-waitlist'
-            ):
-                abort(409, f'Student is already enrolled with status: {existing.status}')
-            abort(400, 'Enrollment failed — student may not be active or training may have started')
-
-        enrollment = TrainingEnroll.query.filter_by(
-            student_id=data['student_id'],
-            training_id=training_id,
-        ).first()
-        return enrollment, 201
+        return enroll_student(training_id, api.payload), 201
 
 
 @ns.route('/<int:training_id>/enrollments/<int:student_id>')
@@ -114,16 +213,7 @@ class EnrollmentDetail(Resource):
 
         Use the 'invite' action to manually invite the next waitlisted student.
         """
-        training = Training.query.get_or_404(training_id)
-        enrollment = TrainingEnroll.query.filter_by(
-            training_id=training_id,
-            student_id=student_id,
-        ).first_or_404()
-
-        result = deroll_common(training, enrollment.student.user, admin=True)
-        if not result:
-            abort(400, 'De-enrollment failed — training may have already started')
-
+        remove_enrollment(training_id, student_id)
         return '', 204
 
 
@@ -152,71 +242,7 @@ class EnrollmentAction(Resource):
           Cascades: automatically invites next eligible waitlisted student(s).
         - **toggle-paid**: Flips the paid flag on the enrollment (any status).
         """
-        training = Training.query.get_or_404(training_id)
-        enrollment = TrainingEnroll.query.filter_by(
-            training_id=training_id,
-            student_id=student_id,
-        ).first_or_404()
-
-        data = api.payload
-        action = data['action']
-
-        if action == 'invite':
-            if enrollment.status != 'waitlist':
-                abort(400, f'Cannot invite: current status is {enrollment.status}, must be waitlist')
-            # Check spot availability (mirrors training_detail_view.invite)
-            if not training.wait_list_spot_available(enrollment.student):
-                abort(409, 'No spots available — training is at capacity (enrolled + waitlist-invited)')
-            invite_from_waitlist(enrollment)
-
-        elif action == 'deinvite':
-            if enrollment.status != 'waitlist-invited':
-                abort(400, f'Cannot de-invite: current status is {enrollment.status}, must be waitlist-invited')
-            deinvite_from_waitlist(enrollment)
-
-        elif action == 'return-to-waitlist':
-            # Mirrors training_detail_view.deinvite — sets back to waitlist silently
-            if enrollment.status != 'waitlist-invited':
-                abort(400, f'Cannot return to waitlist: current status is {enrollment.status}, must be waitlist-invited')
-            enrollment.status = 'waitlist'
-            db.session.commit()
-
-        elif action == 'force-enroll':
-            if enrollment.status != 'waitlist':
-                abort(400, f'Cannot force-enroll: current status is {enrollment.status}, must be waitlist')
-            enrollment.status = 'force-off-waitlist'
-            db.session.commit()
-            result = enroll_common(training, enrollment.student.user)
-            if not result:
-                abort(500, 'Force-enroll failed unexpectedly')
-            enrollment = TrainingEnroll.query.filter_by(
-                training_id=training_id,
-                student_id=student_id,
-            ).first()
-
-        elif action == 'decline':
-            if enrollment.status != 'waitlist-invited':
-                abort(400, f'Cannot decline: current status is {enrollment.status}, must be waitlist-invited')
-            enrollment.status = 'waitlist-declined'
-            db.session.commit()
-            # Cascade: invite next eligible waitlisted students (mirrors scheduler_views.decline_invite)
-            for eligible in training.waitlist_enrollments_eligeble():
-                invite_from_waitlist(eligible)
-
-        elif action == 'toggle-paid':
-            enrollment.paid = not enrollment.paid
-            db.session.commit()
-
-        else:
-            abort(400, f'Unknown action: {action}. '
-                  'Must be invite, deinvite, return-to-waitlist, force-enroll, decline, or toggle-paid')
-
-        return {
-            'student_id': student_id,
-            'training_id': training_id,
-            'status': enrollment.status,
-            'action': action,
-        }
+        return enrollment_action(training_id, student_id, api.payload)
 
 
 @ns.route('/<int:training_id>/enrollments/bulk-move')
@@ -227,16 +253,26 @@ class EnrollmentBulkMove(Resource):
     @ns.marshal_with(bulk_move_result)
     @admin_required
     def post(self, training_id):
-        """Move or copy enrollments to another training.
+        """Move or copy enrollments to another training in one short transaction.
 
         Preserves the enrollment status and paid flag.  Students already
         enrolled in the target training are skipped (reported in the
         skipped list).
 
+        Enrollments that take a spot (enrolled, waitlist-invited) are only
+        moved while the target has room: when it is full they are placed
+        at the end of its waitlist if waitlist_when_full is set (reported
+        in the waitlisted list as well as in moved), otherwise they are
+        reported as errors.  Waitlisted enrollments join the end of the
+        target's waitlist.
+
+        The source rows and the target's enrollments are read with two
+        queries, a move is one UPDATE and a copy one INSERT.
+
         Note: no notifications are sent and no policy checks are performed.
         This is a direct database operation for admin convenience.
         """
-        Training.query.get_or_404(training_id)
+        source = Training.query.get_or_404(training_id)
         data = api.payload
 
         target_id = data['target_training_id']
@@ -257,41 +293,82 @@ class EnrollmentBulkMove(Resource):
         if override_status and override_status not in valid_statuses:
             abort(400, f'Invalid override_status. Must be one of: {", ".join(valid_statuses)}')
 
+        student_ids = list(dict.fromkeys(data['student_ids']))
+        sources = {row.student_id: row for row in db.session.execute(select(
+            TrainingEnroll.student_id, TrainingEnroll.status, TrainingEnroll.paid,
+            TrainingEnroll.waitlist_position, TrainingEnroll.waitlist_opt_out,
+            ).where(TrainingEnroll.training_id == training_id, TrainingEnroll.student_id.in_(student_ids)))}
+        in_target = db.session.execute(select(
+            TrainingEnroll.student_id, TrainingEnroll.status, TrainingEnroll.waitlist_position,
+            ).where(TrainingEnroll.training_id == target_id)).all()
+
+        existing = {row.student_id for row in in_target}
+        spots = target.max_participants - len([row for row in in_target if row.status in SPOT_STATUSES])
+        tail = max([row.waitlist_position or 0 for row in in_target if row.status == 'waitlist'], default=0)
+
         moved = []
+        waitlisted = []
         skipped = []
         errors = []
+        rows = []  # (student_id, new status, new waitlist position, source row)
 
-        for sid in data['student_ids']:
-            source_enrollment = TrainingEnroll.query.filter_by(
-                training_id=training_id,
-                student_id=sid,
-            ).first()
-
+        for sid in student_ids:
+            source_enrollment = sources.get(sid)
             if not source_enrollment:
                 errors.append(f'Student {sid} not enrolled in source training')
                 continue
 
-            existing = TrainingEnroll.query.filter_by(
-                training_id=target_id,
-                student_id=sid,
-            ).first()
-
-            if existing:
+            if sid in existing:
                 skipped.append(sid)
                 continue
 
-            new_enrollment = TrainingEnroll(
-                student_id=sid,
-                training_id=target_id,
-                status=override_status or source_enrollment.status,
-                paid=source_enrollment.paid,
-            )
-            db.session.add(new_enrollment)
+            status = override_status or source_enrollment.status
+            if status in SPOT_STATUSES:
+                if spots > 0:
+                    spots -= 1
+                elif data.get('waitlist_when_full'):
+                    status = 'waitlist'
+                    waitlisted.append(sid)
+                else:
+                    errors.append(f'Student {sid}: target training is full')
+                    continue
+
+            position = None
+            if status == 'waitlist':
+                tail += 1
+                position = tail
+
+            rows.append((sid, status, position, source_enrollment))
+            moved.append(sid)
 
+        if rows:
+            positions = {sid: position for sid, _, position, _ in rows if position is not None}
             if operation == 'move':
-                db.session.delete(source_enrollment)
-
-            moved.append(sid)
+                db.session.execute(update(TrainingEnroll).where(
+                    TrainingEnroll.training_id == training_id,
+                    TrainingEnroll.student_id.in_(moved),
+                    ).values(training_id=target_id,
+                             status=case({sid: status for sid, status, _, _ in rows}, value=TrainingEnroll.student_id),
+                             waitlist_position=case(positions, value=TrainingEnroll.student_id) if positions else None,
+                             enrole_date=func.now(),
+                    ).execution_options(synchronize_session=False))
+                TrainingEnroll.compact_waitlist(db.session, training_id,
+                                                [row.waitlist_position for _, _, _, row in rows if row.status == 'waitlist'])
+            else:
+                db.session.execute(TrainingEnroll.__table__.insert(), [
+                    dict(student_id=sid, training_id=target_id, status=status, waitlist_position=position,
+                         paid=row.paid, waitlist_opt_out=row.waitlist_opt_out, uuid=str(uuid4()))
+                    for sid, status, position, row in rows])
+
+            # Core statements skip the flush hooks that log these for the ORM
+            statuses = [(sid, target_id, status) for sid, status, _, _ in rows]
+            changes = [('enrollment', 'created', target_id, sid) for sid in moved]
+            if operation == 'move':
+                statuses = [(sid, training_id, None) for sid in moved] + statuses
+                changes = [('enrollment', 'deleted', training_id, sid) for sid in moved] + changes
+            UserChange.log_enrollments(db.session, statuses)
+            EntityChange.log(db.session, changes,
+                             practices={training_id: source.practice_id, target_id: target.practice_id})
 
         db.session.commit()
-        return {'moved': moved, 'skipped': skipped, 'errors': errors}
+        return {'moved': moved, 'waitlisted': waitlisted, 'skipped': skipped, 'errors': errors}
@@ -1,5 +1,6 @@
 from flask_restx import Namespace, Resource
 from bcource.admin_api.auth import admin_required
+from bcource.admin_api.pagination import add_list_arguments, paginated
 from bcource.admin_api.serializers import location_model
 from bcource.models import Location, Practice
 
@@ -8,13 +9,18 @@ ns = Namespace('locations', description='Location lookup')
 from bcource.admin_api.api import api
 api.add_namespace(ns)
 
+parser = add_list_arguments(ns.parser())
+
 
 @ns.route('/')
 class LocationList(Resource):
     @ns.doc('list_locations')
-    @ns.marshal_list_with(location_model)
+    @ns.expect(parser)
+    @ns.response(200, 'Success', [location_model])
     @admin_required
     def get(self):
-        """List all locations for the current practice."""
+        """List the locations of the current practice by name, one page at a time."""
+        args = parser.parse_args()
         practice = Practice.default_row()
-        return Location.query.filter_by(practice_id=practice.id).order_by(Location.name).all()
+        query = Location.query.filter_by(practice_id=practice.id)
+        return paginated(query, location_model, args, Location.id, order=(Location.name,))
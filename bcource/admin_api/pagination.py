@@ -0,0 +1,97 @@
+"""Cursor pagination and sparse fieldsets for the admin API list endpoints.
+
+A list endpoint returns at most ``limit`` items. When there are more, the
+response has an ``X-Next-Cursor`` header (and a ``Link: <...>; rel="next"``
+header) with the id of the last item; pass it as ``after`` to get the next
+page. Pages are selected with a keyset condition on the sort columns, so
+every page is one bounded query, also deep into a large list.
+
+``fields=id,name`` limits the items to the given fields (the same as the
+X-Fields mask header), and only the relations those fields need are loaded.
+"""
+from urllib.parse import urlencode
+
+from flask import current_app, request
+from flask_restx import abort, marshal
+from sqlalchemy import and_, or_
+
+
+def add_list_arguments(parser, default_limit=None):
+    """Add the limit, after and fields arguments to a list endpoint's parser."""
+    parser.add_argument('limit', type=int, default=default_limit,
+                        help='Maximum number of items (default and maximum are configured)', location='args')
+    parser.add_argument('after', type=int, help='Cursor: the X-Next-Cursor of the previous page', location='args')
+    parser.add_argument('fields', type=str, help='Comma separated fields to return (default all)', location='args')
+    return parser
+
+
+def selected_fields(model, fields):
+    """The field names of fields (a comma separated string), all fields of model when empty."""
+    if not fields:
+        return list(model.keys())
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in model]
+    if unknown:
+        abort(400, f'Unknown fields: {", ".join(unknown)}')
+    return names
+
+
+def eager_loads(loads, fields):
+    """The loader options of loads ({field: [option, ...]}) that the selected fields need."""
+    options = []
+    for name in fields:
+        for option in loads.get(name, ()):
+            if option not in options:
+                options.append(option)
+    return options
+
+
+def _after(query, args, key, order, descending):
+    """query limited to the rows sorted after the cursor row, 400 when the cursor is not in the list."""
+    after = args['after']
+    if not order:
+        return query.filter(key < after if descending else key > after)
+
+    if query.with_entities(key).filter(key == after).first() is None:
+        abort(400, f'Invalid cursor: {after}')
+
+    # the sort values of the cursor row are compared in SQL, as stored
+    columns = [*order, key]
+    values = [query.with_entities(column).filter(key == after).scalar_subquery().correlate(None)
+              for column in order] + [after]
+    conditions = []
+    for i, column in enumerate(columns):
+        equal = [columns[j] == values[j] for j in range(i)]
+        conditions.append(and_(*equal, column < values[i] if descending else column > values[i]))
+    return query.filter(or_(*conditions))
+
+
+def paginated(query, model, args, key, order=(), descending=False, loads=None, maximum=None):
+    """
+    One page of query as a (body, status, headers) response: the items
+    marshalled with model and the selected fields, sorted on order and then
+    key, a column unique within the list (the cursor is its value).
+    loads maps field names to the loader options they need.
+    """
+    fields = selected_fields(model, args.get('fields'))
+    limit = args.get('limit') or current_app.config['ADMIN_API_PAGE_SIZE']
+    limit = max(1, min(limit, maximum or current_app.config['ADMIN_API_MAX_PAGE_SIZE']))
+
+    if args.get('after') is not None:
+        query = _after(query, args, key, order, descending)
+    options = eager_loads(loads or {}, fields)
+    if options:
+        query = query.options(*options)
+
+    columns = [*order, key]
+    items = query.order_by(*[column.desc() if descending else column for column in columns]).limit(limit + 1).all()
+
+    headers = {}
+    if len(items) > limit:
+        items = items[:limit]
+        cursor = getattr(items[-1], key.key)
+        query_args = [(name, value) for name, value in request.args.items(multi=True) if name != 'after']
+        headers['X-Next-Cursor'] = str(cursor)
+        headers['Link'] = f'<{request.base_url}?{urlencode(query_args + [("after", cursor)])}>; rel="next"'
+
+    return marshal(items, model, mask='{' + ','.join(fields) + '}'), 200, headers
@@ -86,10 +86,13 @@ bulk_move_input = api.model('BulkMoveInput', {
     'target_training_id': fields.Integer(required=True),
     'operation': fields.String(required=True, description='move or copy'),
     'override_status': fields.String(description='If set, all moved enrollments get this status instead of the source status'),
+    'waitlist_when_full': fields.Boolean(default=False, description='Place enrollments that take a spot on the '
+                                         'waitlist of the target when it is full, instead of reporting an error'),
 })
 
 bulk_move_result = api.model('BulkMoveResult', {
     'moved': fields.List(fields.Integer, description='Student IDs successfully processed'),
+    'waitlisted': fields.List(fields.Integer, description='Student IDs placed on the target waitlist because it was full'),
     'skipped': fields.List(fields.Integer, description='Student IDs skipped (already in target)'),
     'errors': fields.List(fields.String, description='Error messages'),
 })
@@ -163,3 +166,59 @@ training_update_input = api.model('TrainingUpdateInput', {
     'apply_policies': fields.Boolean(),
     'trainer_ids': fields.List(fields.Integer, description='Replace trainer assignments'),
 })
+
+# --- Change feed ---
+change_model = api.model('Change', {
+    'cursor': fields.Integer(description='Pass as since to get the changes after this one'),
+    'entity': fields.String(description='training, event or enrollment'),
+    'op': fields.String(description='created, updated or deleted'),
+    'training_id': fields.Integer(),
+    'event_id': fields.Integer(description='Set for events'),
+    'student_id': fields.Integer(description='Set for enrollments'),
+    'changed_at': fields.DateTime(),
+    'data': fields.Raw(description='Current state (TrainingSummary, TrainingEvent or Enrollment), '
+                       'null when the entity no longer exists'),
+})
+
+change_list_model = api.model('ChangeList', {
+    'changes': fields.List(fields.Nested(change_model)),
+    'cursor': fields.Integer(description='Cursor of the last change, pass as since in the next poll'),
+    'has_more': fields.Boolean(description='More changes are waiting, poll again right away'),
+})
+
+# --- Batch ---
+batch_operation_input = api.model('BatchOperationInput', {
+    'op': fields.String(required=True, enum=['create_training', 'update_training', 'enroll',
+                                             'enrollment_action', 'remove_enrollment'],
+                        description='create_training (data: TrainingInput), '
+                                    'update_training (training_id, data: TrainingUpdateInput), '
+                                    'enroll (training_id, data: EnrollmentInput), '
+                                    'enrollment_action (training_id, student_id, data: EnrollmentActionInput), '
+                                    'remove_enrollment (training_id, student_id)'),
+    'training_id': fields.Integer(),
+    'student_id': fields.Integer(),
+    'data': fields.Raw(description='Body of the matching single endpoint'),
+})
+
+batch_input = api.model('BatchInput', {
+    'mode': fields.String(enum=['atomic', 'best-effort'], default='atomic',
+                          description='atomic: all operations or none, '
+                                      'best-effort: failed operations are rolled back, the others committed'),
+    'operations': fields.List(fields.Nested(batch_operation_input), required=True),
+})
+
+batch_operation_result = api.model('BatchOperationResult', {
+    'index': fields.Integer(description='Position of the operation in the request'),
+    'op': fields.String(),
+    'status': fields.Integer(description='HTTP status the single endpoint would have returned, '
+                                         'null when the operation did not run'),
+    'ok': fields.Boolean(description='The operation succeeded'),
+    'error': fields.String(),
+    'result': fields.Raw(description='Response body of the single endpoint'),
+})
+
+batch_result = api.model('BatchResult', {
+    'mode': fields.String(),
+    'committed': fields.Boolean(description='Changes were committed (false when an atomic batch failed)'),
+    'results': fields.List(fields.Nested(batch_operation_result)),
+})
@@ -2,36 +2,44 @@ from flask_restx import Namespace, Resource
 from bcource.admin_api.auth import admin_required
 from bcource.admin_api.serializers import student_model
 from bcource.admin_api.api import api
-from bcource.models import Student, User, Practice
-from sqlalchemy import or_
+from bcource.admin_api.pagination import add_list_arguments, paginated
+from bcource.models import Student, User, Practice, UserSearchToken
+from sqlalchemy import func
+from sqlalchemy.orm import contains_eager, joinedload
 
 ns = Namespace('students', description='Student lookup')
 api.add_namespace(ns)
 
 parser = ns.parser()
 parser.add_argument('q', type=str, help='Search by name or email', location='args')
+add_list_arguments(parser, default_limit=50)
+
+_user = contains_eager(Student.user)
+student_loads = {
+    'fullname': [_user], 'email': [_user], 'phone_number': [_user],
+    'studenttype': [joinedload(Student.studenttype)],
+    'studentstatus': [joinedload(Student.studentstatus)],
+}
 
 
 @ns.route('/')
 class StudentList(Resource):
     @ns.doc('search_students')
     @ns.expect(parser)
-    @ns.marshal_list_with(student_model)
+    @ns.response(200, 'Success', [student_model])
     @admin_required
     def get(self):
-        """Search students by name or email."""
+        """Search students by name or email (best matches first), one page of at most 200 at a time."""
         args = parser.parse_args()
         practice = Practice.default_row()
 
         query = Student.query.join(User).filter(Student.practice_id == practice.id)
 
-        q = args.get('q')
-        if q:
-            like = f'%{q}%'
-            query = query.filter(or_(
-                User.first_name.ilike(like),
-                User.last_name.ilike(like),
-                User.email.ilike(like),
-            ))
+        # names are empty until the profile is completed, the keyset comparison needs a value
+        order = [func.coalesce(User.last_name, ''), func.coalesce(User.first_name, '')]
+        clause, rank = UserSearchToken.match(args.get('q'))
+        if clause is not None:
+            query = query.filter(clause)
+            order.insert(0, rank)
 
-        return query.order_by(User.last_name, User.first_name).limit(50).all()
+        return paginated(query, student_model, args, Student.id, order=order, loads=student_loads, maximum=200)
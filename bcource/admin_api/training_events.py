@@ -2,22 +2,30 @@ from flask_restx import Resource, abort
 from bcource.admin_api.auth import admin_required
 from bcource.admin_api.serializers import training_event_model, training_event_input
 from bcource.admin_api.api import api
+from bcource.admin_api.pagination import add_list_arguments, paginated
 from bcource.admin_api.trainings import ns
 from bcource.models import Training, TrainingEvent, Location, Practice
 from bcource import db
+from sqlalchemy.orm import joinedload
+
+events_parser = add_list_arguments(ns.parser())
+event_loads = {'location_name': [joinedload(TrainingEvent.location)]}
 
 
 @ns.route('/<int:training_id>/events')
 @ns.param('training_id', 'Training ID')
 class TrainingEventList(Resource):
     @ns.doc('list_training_events')
-    @ns.marshal_list_with(training_event_model)
+    @ns.expect(events_parser)
+    @ns.response(200, 'Success', [training_event_model])
     @admin_required
     def get(self, training_id):
-        """List events for a training."""
+        """List events for a training by start time, one page at a time."""
         Training.query.get_or_404(training_id)
-        return TrainingEvent.query.filter_by(training_id=training_id)\
-            .order_by(TrainingEvent.start_time).all()
+        args = events_parser.parse_args()
+        query = TrainingEvent.query.filter_by(training_id=training_id)
+        return paginated(query, training_event_model, args, TrainingEvent.id,
+                         order=(TrainingEvent.start_time,), loads=event_loads)
 
     @ns.doc('create_training_event')
     @ns.expect(training_event_input)
@@ -1,5 +1,6 @@
 from flask_restx import Namespace, Resource
 from bcource.admin_api.auth import admin_required
+from bcource.admin_api.pagination import add_list_arguments, paginated
 from bcource.admin_api.serializers import training_type_model
 from bcource.models import TrainingType, Practice
 
@@ -8,13 +9,18 @@ ns = Namespace('training-types', description='Training type lookup')
 from bcource.admin_api.api import api
 api.add_namespace(ns)
 
+parser = add_list_arguments(ns.parser())
+
 
 @ns.route('/')
 class TrainingTypeList(Resource):
     @ns.doc('list_training_types')
-    @ns.marshal_list_with(training_type_model)
+    @ns.expect(parser)
+    @ns.response(200, 'Success', [training_type_model])
     @admin_required
     def get(self):
-        """List all training types for the current practice."""
+        """List the training types of the current practice by name, one page at a time."""
+        args = parser.parse_args()
         practice = Practice.default_row()
-        return TrainingType.query.filter_by(practice_id=practice.id).order_by(TrainingType.name).all()
+        query = TrainingType.query.filter_by(practice_id=practice.id)
+        return paginated(query, training_type_model, args, TrainingType.id, order=(TrainingType.name,))
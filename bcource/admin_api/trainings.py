@@ -5,8 +5,10 @@ from bcource.admin_api.serializers import (
     training_input, training_update_input,
 )
 from bcource.admin_api.api import api
+from bcource.admin_api.pagination import add_list_arguments, paginated
 from bcource.models import Training, TrainingType, TrainingEvent, Trainer, Location, Practice
 from bcource import db
+from sqlalchemy.orm import joinedload, selectinload
 
 ns = Namespace('trainings', description='Training management')
 api.add_namespace(ns)
@@ -15,16 +17,104 @@ list_parser = ns.parser()
 list_parser.add_argument('active', type=str, choices=('true', 'false'), help='Filter by active status', location='args')
 list_parser.add_argument('q', type=str, help='Search by name', location='args')
 list_parser.add_argument('trainingtype_id', type=int, help='Filter by training type', location='args')
+add_list_arguments(list_parser)
+
+# relations the training summary fields need
+_enrollments = selectinload(Training.trainingenrollments)
+summary_loads = {
+    'trainingtype': [joinedload(Training.trainingtype)],
+    'enrollment_count': [_enrollments],
+    'waitlist_count': [_enrollments],
+    'event_count': [selectinload(Training.trainingevents)],
+}
+
+
+def create_training(data):
+    """Create a training from data (see TrainingList.post), returns the training."""
+    practice = Practice.default_row()
+
+    # Validate training type
+    tt = TrainingType.query.get(data['trainingtype_id'])
+    if not tt or tt.practice_id != practice.id:
+        abort(400, 'Invalid trainingtype_id')
+
+    training = Training()
+    training.name = data['name']
+    training.trainingtype = tt
+    training.practice = practice
+    training.max_participants = data['max_participants']
+    training.active = data.get('active', True)
+    training.apply_policies = data.get('apply_policies', True)
+
+    # Assign trainers
+    for tid in data.get('trainer_ids', []):
+        trainer = Trainer.query.get(tid)
+        if trainer and trainer.practice_id == practice.id:
+            training.trainers.append(trainer)
+
+    db.session.add(training)
+    db.session.flush()  # get training.id for events
+
+    # Create events
+    for ev in data.get('events', []):
+        loc = Location.query.get(ev['location_id'])
+        if not loc or loc.practice_id != practice.id:
+            abort(400, f'Invalid location_id: {ev["location_id"]}')
+
+        event = TrainingEvent(
+            start_time=ev['start_time'],
+            end_time=ev['end_time'],
+            location_id=ev['location_id'],
+            training_id=training.id,
+        )
+        db.session.add(event)
+
+    db.session.commit()
+    return training
+
+
+def update_training(id, data):
+    """Update a training with the fields in data (see TrainingDetail.put), returns the training."""
+    training = Training.query.get_or_404(id)
+    practice = Practice.default_row()
+
+    if 'name' in data:
+        training.name = data['name']
+
+    if 'trainingtype_id' in data:
+        tt = TrainingType.query.get(data['trainingtype_id'])
+        if not tt or tt.practice_id != practice.id:
+            abort(400, 'Invalid trainingtype_id')
+        training.trainingtype = tt
+
+    if 'max_participants' in data:
+        training.max_participants = data['max_participants']
+
+    if 'active' in data:
+        training.active = data['active']
+
+    if 'apply_policies' in data:
+        training.apply_policies = data['apply_policies']
+
+    if 'trainer_ids' in data:
+        training.trainers.clear()
+        for tid in data['trainer_ids']:
+            trainer = Trainer.query.get(tid)
+            if trainer and trainer.practice_id == practice.id:
+                training.trainers.append(trainer)
+
+    db.session.commit()
+    return training
 
 
 @ns.route('/')
 class TrainingList(Resource):
     @ns.doc('list_trainings')
     @ns.expect(list_parser)
-    @ns.marshal_list_with(training_summary_model)
+    @ns.response(200, 'Success', [training_summary_model])
     @admin_required
     def get(self):
-        """List trainings with optional filters."""
+        """List trainings with optional filters, newest first, one page at a time."""
         args = list_parser.parse_args()
         practice = Practice.default_row()
 
@@ -41,7 +131,7 @@ class TrainingList(Resource):
         if args.get('trainingtype_id'):
             query = query.filter_by(trainingtype_id=args['trainingtype_id'])
 
-        return query.order_by(Training.id.desc()).all()
+        return paginated(query, training_summary_model, args, Training.id, descending=True, loads=summary_loads)
 
     @ns.doc('create_training')
     @ns.expect(training_input)
@@ -49,47 +139,7 @@ class TrainingList(Resource):
     @admin_required
     def post(self):
         """Create a new training with optional events and trainer assignments."""
-        data = api.payload
-        practice = Practice.default_row()
-
-        # Validate training type
-        tt = TrainingType.query.get(data['trainingtype_id'])
-        if not tt or tt.practice_id != practice.id:
-            abort(400, 'Invalid trainingtype_id')
-
-        training = Training()
-        training.name = data['name']
-        training.trainingtype = tt
-        training.practice = practice
-        training.max_participants = data['max_participants']
-        training.active = data.get('active', True)
-        training.apply_policies = data.get('apply_policies', True)
-
-        # Assign trainers
-        for tid in data.get('trainer_ids', []):
-            trainer = Trainer.query.get(tid)
-            if trainer and trainer.practice_id == practice.id:
-                training.trainers.append(trainer)
-
-        db.session.add(training)
-        db.session.flush()  # get training.id for events
-
-        # Create events
-        for ev in data.get('events', []):
-            loc = Location.query.get(ev['location_id'])
-            if not loc or loc.practice_id != practice.id:
-                abort(400, f'Invalid location_id: {ev["location_id"]}')
-
-            event = TrainingEvent(
-                start_time=ev['start_time'],
-                end_time=ev['end_time'],
-                location_id=ev['location_id'],
-                training_id=training.id,
-            )
-            db.session.add(event)
-
-        db.session.commit()
-        return training, 201
+        return create_training(api.payload), 201
 
 
 @ns.route('/<int:id>')
@@ -109,37 +159,7 @@ class TrainingDetail(Resource):
     @admin_required
     def put(self, id):
         """Update a training."""
-        training = Training.query.get_or_404(id)
-        data = api.payload
-        practice = Practice.default_row()
-
-        if 'name' in data:
-            training.name = data['name']
-
-        if 'trainingtype_id' in data:
-            tt = TrainingType.query.get(data['trainingtype_id'])
-            if not tt or tt.practice_id != practice.id:
-                abort(400, 'Invalid trainingtype_id')
-            training.trainingtype = tt
-
-        if 'max_participants' in data:
-            training.max_participants = data['max_participants']
-
-        if 'active' in data:
-            training.active = data['active']
-
-        if 'apply_policies' in data:
-            training.apply_policies = data['apply_policies']
-
-        if 'trainer_ids' in data:
-            training.trainers.clear()
-            for tid in data['trainer_ids']:
-                trainer = Trainer.query.get(tid)
-                if trainer and trainer.practice_id == practice.id:
-                    training.trainers.append(trainer)
-
-        db.session.commit()
-        return training
+        return update_training(id, api.payload)
 
 
 @ns.route('/<int:id>/deactivate')
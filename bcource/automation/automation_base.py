@@ -240,6 +240,23 @@ class BaseAutomationTask:
         """
         return item.id
 
+    @classmethod
+    def _get_item_name(cls, item):
+        """
+        Build a human-readable name for an item, used in the job id.
+
+        Args:
+            item: Model instance.
+
+        Returns:
+            str: The name of the item.
+        """
+        if hasattr(item, 'name'):
+            return item.name
+        elif hasattr(item, 'training') and hasattr(item.training, 'name'):
+            return item.training.name
+        return str(cls._get_id(item))
+
     @staticmethod
     def _get_training_type_id(item):
         """Get the training type ID for filtering.
@@ -305,13 +322,7 @@ class BaseAutomationTask:
             logger.debug(f'Skipping past job {automation.name} for {item} (trigger: {when}, missed by {now - when})')
             return None
 
-        # Build a human-readable name for the item
-        if hasattr(item, 'name'):
-            item_name = item.name
-        elif hasattr(item, 'training') and hasattr(item.training, 'name'):
-            item_name = item.training.name
-        else:
-            item_name = str(cls._get_id(item))
+        item_name = cls._get_item_name(item)
 
         str_id = f"{automation.name}/{item_name}/{app_scheduler.flask_app.config.get('ENVIRONMENT')}"
 
@@ -1,15 +1,20 @@
 from bcource.automation.automation_base import BaseAutomationTask, register_automation
 from bcource.models import Training, TrainingEvent, TrainingEnroll, Student,\
-    Practice, User, UserSettings
-from bcource.messages import SendEmail, EmailStudentEnrolledInTraining, EmailAttendeeListReminder
+    Practice, User, UserSettings, AutomationSchedule, AutomationClasses, TrainerNotification, UserMessageCounter
+from bcource.messages import SystemMessage, SendEmail, EmailStudentEnrolledInTraining, EmailAttendeeListReminder
+from collections import namedtuple
+from sqlalchemy import update, select, func
 from datetime import datetime
-from bcource.students.common import deinvite_from_waitlist, invite_from_waitlist
+from bcource.students.common import deinvite_from_waitlist, invite_from_waitlist_bulk
 import logging
+import time
 from bcource import db
 from bcource.models import BeforeAfterEnum
 from bcource.helpers import db_datetime_str
+from bcource.helpers import config_value as cv
 from datetime import timedelta
 from bcource.automation.scheduler import app_scheduler
+from bcource.message_retention import MessageRetention
 
 logger = logging.getLogger(__name__)
 
@@ -50,11 +55,12 @@ class StudentReminderTask(Reminder):
         self.template_kw['training'] = Training().query.get(id)
 
     def execute(self):
+        messages = []
         for enrollment in self.enrollments:
             self.template_kw['user'] = enrollment.student.user
             self.template_kw['enrollment'] = enrollment
-            a = EmailReminderIcal(envelop_to=[enrollment.student.user], CONTENT_TAG=self.automation_name, taglist=['reminder'], **self.template_kw)
-            a.send()
+            messages.append(EmailReminderIcal(envelop_to=[enrollment.student.user], CONTENT_TAG=self.automation_name, taglist=['reminder'], **self.template_kw))
+        SendEmail.send_bulk(messages)
         logger.info(f"Sent student reminders to {len(self.enrollments)} student(s) for training {self.template_kw.get('training', '')}")
 
 @register_automation(
@@ -73,11 +79,12 @@ class TrainerReminderTask(Reminder):
         self.template_kw['training'] = self.training
 
     def execute(self):
+        messages = []
         for user in self.training.trainer_users:
             self.template_kw['user'] = user
             self.template_kw['training'] = self.training
-            a = EmailReminder(envelop_to=[user], CONTENT_TAG=self.automation_name, taglist=['reminder'], **self.template_kw)
-            a.send()
+            messages.append(EmailReminder(envelop_to=[user], CONTENT_TAG=self.automation_name, taglist=['reminder'], **self.template_kw))
+        SendEmail.send_bulk(messages)
         logger.info(f"Sent trainer reminders to {len(self.training.trainer_users)} trainer(s) for training {self.training}")
 
 
@@ -97,12 +104,42 @@ class AutomaticWaitList(BaseAutomationTask):
             deinvite_from_waitlist(enrollment)
             logger.info(f"Expired waitlist invitation for {enrollment.student} in {enrollment.training}")
 
-        waitlist_enrollments_eligeble = enrollment.training.waitlist_enrollments_eligeble()
-        for enrollment in waitlist_enrollments_eligeble:
-            invite_from_waitlist(enrollment)
-            logger.info(f"Invited {enrollment.student} from waitlist for {enrollment.training}")
+        invited = invite_from_waitlist_bulk(enrollment.training)
+        if invited:
+            self.create_expiry_jobs(invited)
+            logger.info(f"Invited {len(invited)} student(s) from waitlist for {enrollment.training}")
 
         return(True)
+
+    @classmethod
+    def create_expiry_jobs(cls, enrollments):
+        """
+        Schedule the invitation expiry jobs for freshly invited enrollments.
+
+        The active AutomaticWaitList schedules are loaded once and a job is
+        created for every enrollment, so invitations do not have to wait for
+        the next renew_automations() cycle.
+
+        Args:
+            enrollments (list): Enrollments with status waitlist-invited.
+
+        Returns:
+            set: Set of job IDs that were created.
+        """
+        automations = AutomationSchedule().query.join(AutomationClasses).filter(
+            AutomationSchedule.active == True,
+            AutomationClasses.class_name == cls.__name__).all()
+
+        jobs = set()
+        for automation in automations:
+            for enrollment in enrollments:
+                item_type_id = cls._get_training_type_id(enrollment)
+                if item_type_id is not None and not cls._is_schedule_allowed(automation, item_type_id):
+                    continue
+                job = cls.create_job(enrollment, automation)
+                if job:
+                    jobs.add(job.id)
+        return jobs
     
     @staticmethod
     def query():
@@ -116,6 +153,11 @@ class AutomaticWaitList(BaseAutomationTask):
     def _get_id(item):
         return item.uuid
 
+    @classmethod
+    def _get_item_name(cls, item):
+        # one invitation per student can be open, key the job on the enrollment
+        return f"{item.training.name}/{item.uuid}"
+
 
 @register_automation(
     description="StudentOpenSpotReminder."
@@ -148,12 +190,13 @@ class StudentOpenSpotReminder(Reminder):
         self.training.apply_policies = False
         db.session.commit()
 
+        messages = []
         for student in self.to:
             user = student.user
             self.template_kw['user'] = user
             self.template_kw['training'] = self.training
-            msg = EmailReminder(envelop_to=[user], CONTENT_TAG=self.automation_name, taglist=['reminder', 'openspot'], **self.template_kw)
-            msg.send()
+            messages.append(EmailReminder(envelop_to=[user], CONTENT_TAG=self.automation_name, taglist=['reminder', 'openspot'], **self.template_kw))
+        SendEmail.send_bulk(messages)
         logger.info(f"Sent open spot reminders to {len(self.to)} student(s) for training {self.training}")
 
 
@@ -288,16 +331,17 @@ class WaitlistReminderTask(Reminder):
             logger.debug(f"No waitlisted students for training {self.id}, skipping")
             return False
 
+        messages = []
         for enrollment in self.enrollments:
             self.template_kw['user'] = enrollment.student.user
             self.template_kw['enrollment'] = enrollment
-            msg = SendEmail(
+            messages.append(SendEmail(
                 envelop_to=[enrollment.student.user],
                 CONTENT_TAG=self.automation_name,
                 taglist=['reminder', 'waitlist'],
                 **self.template_kw
-            )
-            msg.send()
+            ))
+        SendEmail.send_bulk(messages)
 
         logger.info(f"Sent waitlist reminders to {len(self.enrollments)} student(s) for training {self.template_kw.get('training', '')}")
         return True
@@ -334,21 +378,181 @@ class SendAttendeeListTask(Reminder):
             logger.error(f"Cannot execute SendAttendeeListTask: training or enrollments not found for id {self.id}")
             return False
 
+        messages = []
         for user in self.training.trainer_users:
             self.template_kw['user'] = user
             self.template_kw['training'] = self.training
             self.template_kw['enrollments'] = self.enrollments
             self.template_kw['attendees'] = [enrollment.student for enrollment in self.enrollments]
             
-            a = EmailAttendeeListReminder(
+            messages.append(EmailAttendeeListReminder(
                 envelop_to=[user], 
                 CONTENT_TAG=self.automation_name, 
                 taglist=['reminder', 'attendee_list'], 
                 **self.template_kw
-            )
-            a.send()
+            ))
+        SendEmail.send_bulk(messages)
             
         logger.info(f"Sent attendee list reminder to {len(self.training.trainer_users)} trainer(s) for training {self.training.name}")
         return True
 
 
+# pending digest of one trainer, id is the user id
+TrainerDigest = namedtuple('TrainerDigest', ['id', 'due'])
+
+@register_automation(
+    description="Send trainers a digest of their queued notifications."
+)
+class TrainerDigestTask(BaseAutomationTask):
+    """
+    Collapses the pending TrainerNotification rows of a trainer into one 
+    message. A digest is due one cadence (UserSettings.notification_cadence) 
+    after the oldest pending notification, the schedule interval is added to that.
+    A failed delivery is retried with exponential backoff, at most 
+    BCOURSE_TRAINER_DIGEST_MAX_ATTEMPTS times.
+    """
+    def __init__(self, id, automation_name, *args, **kwargs):  # @ReservedAssignment
+        super().__init__(id, automation_name, *args, **kwargs)
+        self.user = User().query.get(id)
+        self.notifications = TrainerNotification.pending(id)
+
+    @staticmethod
+    def query():
+        items = []
+        for user_id, first_date, cadence, attempts, attempt_date in TrainerNotification.due():
+            delay = TrainerNotification.CADENCES.get(cadence or cv('TRAINER_NOTIFICATION_CADENCE'), timedelta(0))
+            due = first_date + delay
+            if attempts:
+                backoff = timedelta(minutes=cv('TRAINER_DIGEST_RETRY_MINUTES') * 2 ** (attempts - 1))
+                due = max(due, attempt_date + backoff)
+            items.append(TrainerDigest(user_id, due))
+        return items
+
+    @staticmethod
+    def get_event_dt(item):
+        return item.due
+
+    @classmethod
+    def _get_item_name(cls, item):
+        return f"trainer-{item.id}"
+
+    @staticmethod
+    def _when(automation, event_dt):
+        when = BaseAutomationTask._when(automation, event_dt)
+        # overdue digests are sent right away instead of being skipped, query() only returns
+        # undelivered notifications and holds failed ones back until their retry is due
+        return max(when, datetime.utcnow() + timedelta(seconds=1))
+
+    def render_body(self):
+        trainings = {}
+        for notification in self.notifications:
+            name = notification.training.name if notification.training else "Other"
+            trainings.setdefault(name, []).append(notification)
+
+        body = f"<p>{len(self.notifications)} update(s) for your trainings:</p>"
+        for name, notifications in trainings.items():
+            items = "".join([f"<li><strong>{db_datetime_str(n.created_date, '%a %d %b %H:%M')}</strong> {n.body}</li>"
+                             for n in notifications])
+            body += f"<h5>{name}</h5><ul>{items}</ul>"
+        return body
+
+    def execute(self):
+        if not self.user or not self.notifications:
+            logger.debug(f"No pending notifications for trainer {self.id}")
+            return False
+
+        # counted in a transaction of its own, so a delivery that fails is retried with backoff
+        db.session.execute(update(TrainerNotification).where(
+            TrainerNotification.id.in_([n.id for n in self.notifications])
+            ).values(attempts=TrainerNotification.attempts + 1, attempt_date=datetime.utcnow()))
+        db.session.commit()
+
+        tags = ['digest']
+        for notification in self.notifications:
+            tags.extend([tag for tag in notification.tags.split(',') if tag])
+
+        message_cls = SendEmail if any(n.email for n in self.notifications) else SystemMessage
+        msg = message_cls(envelop_to=[self.user],
+                          body=self.render_body(),
+                          subject=f"Training updates ({len(self.notifications)})",
+                          taglist=list(dict.fromkeys(tags)))
+
+        # marked in the same transaction as the digest message
+        db.session.execute(update(TrainerNotification).where(
+            TrainerNotification.id.in_([n.id for n in self.notifications])
+            ).values(sent_date=datetime.utcnow()))
+        msg.send()
+
+        logger.info(f"Sent digest of {len(self.notifications)} notification(s) to trainer {self.user}")
+        return True
+
+
+# the single daily run of a maintenance task, due is midnight (UTC) of today
+DailyRun = namedtuple('DailyRun', ['id', 'due'])
+
+class DailyMaintenanceTask(BaseAutomationTask):
+    """
+    Maintenance task that runs once a day, the schedule interval (after) is 
+    the time of day, e.g. 3 hours for 03:00 UTC. Subclasses implement execute().
+    """
+    @staticmethod
+    def query():
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        return [DailyRun(0, today)]
+
+    @staticmethod
+    def get_event_dt(item):
+        return item.due
+
+    @classmethod
+    def _get_item_name(cls, item):
+        return "all"
+
+
+@register_automation(
+    description="Recount unread messages and repair drifted unread counters."
+)
+class UnreadCountReconcileTask(DailyMaintenanceTask):
+    """
+    Safety net for UserMessageCounter, recounts the unread messages once a day.
+    """
+    def execute(self):
+        start = time.monotonic()
+        fixed = UserMessageCounter.reconcile(db.session)
+        logger.info(f"Reconciled unread counters: {fixed} corrected in {time.monotonic() - start:.2f}s")
+        return True
+
+
+@register_automation(
+    description="Archive and purge messages past their retention."
+)
+class MessageRetentionTask(DailyMaintenanceTask):
+    """
+    Runs MessageRetention once a day. The run is logged with the rows moved 
+    and the time taken.
+    """
+    def execute(self):
+        report = MessageRetention().run()
+        logger.info(f"Message retention: {report['messages_archived']} message(s) archived to {report.get('archive')}, "
+                    f"{report['recipients_purged']} recipient row(s) and {report['bodies_purged']} unused bodies purged, "
+                    f"{report['deleted_purged']} deleted recipient row(s) purged in {report['batches']} batch(es), "
+                    f"{report['seconds']}s")
+        return True
+
+
+@register_automation(
+    description="Create the missing student records of users."
+)
+class StudentReconcileTask(DailyMaintenanceTask):
+    """
+    Student records are created at registration and confirmation 
+    (students/signals.py). This daily run creates the ones still missing, 
+    e.g. for accounts made by an admin.
+    """
+    def execute(self):
+        start = time.monotonic()
+        users = db.session.scalar(select(func.count()).select_from(User))
+        created = Student.create_missing()
+        logger.info(f"Student reconciliation: {created} missing student record(s) created for {users} user(s) "
+                    f"in {time.monotonic() - start:.2f}s")
+        return True
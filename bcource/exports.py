@@ -0,0 +1,176 @@
+"""
+Streaming CSV and XLSX exports.
+
+The views pass a header and a generator of rows (built from a query executed
+with yield_per), export_response() encodes the rows while the response is
+sent. Only one yield_per batch of rows and one output chunk are in memory at
+a time, whatever the size of the export, and the first bytes go out before
+the query is exhausted.
+
+XLSX files are written with zipfile to the response stream (no seeking), the
+sheet uses inline strings so no shared string table has to be built first.
+"""
+from bcource.helpers import config_value as cv
+from flask import Response, stream_with_context
+from xml.sax.saxutils import escape
+from datetime import date, datetime
+import csv
+import io
+import re
+import zipfile
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# characters not allowed in XML 1.0
+_xml_invalid = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+# text a spreadsheet would run as a formula when the CSV is opened, phone numbers (+31 6 ...) excepted
+_csv_formula = re.compile(r'^(?:[=@\t\r]|[+-](?![\d ()-]+$))')
+
+
+def export_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M')
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return 'yes' if value else 'no'
+    return value
+
+
+def _csv_value(value):
+    value = export_value(value)
+    if isinstance(value, str) and _csv_formula.match(value):
+        return "'" + value
+    return value
+
+
+def csv_chunks(header, rows, chunk_size=64 * 1024):
+    """Encode rows as CSV, yields chunks of about chunk_size bytes."""
+    buffer = io.StringIO()
+    # the BOM makes Excel open the file as UTF-8
+    buffer.write('\ufeff')
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkSink(object):
+    """Write only file object for zipfile, the bytes written are taken out with take()."""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+_XLSX_PARTS = {
+    '[Content_Types].xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>',
+    'xl/_rels/workbook.xml.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>',
+}
+
+_XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{name}" sheetId="1" r:id="rId1"/></sheets></workbook>')
+
+
+def _xlsx_cell(value):
+    value = export_value(value)
+    if isinstance(value, (int, float)):
+        return f'<c><v>{value}</v></c>'
+    text = escape(_xml_invalid.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _xlsx_row(row):
+    return ('<row>' + ''.join(_xlsx_cell(value) for value in row) + '</row>').encode('utf-8')
+
+
+def xlsx_chunks(sheet_name, header, rows, chunk_size=64 * 1024):
+    """Encode rows as a one sheet XLSX workbook, yields chunks of about chunk_size bytes."""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in _XLSX_PARTS.items():
+            workbook.writestr(name, content)
+        workbook.writestr('xl/workbook.xml', _XLSX_WORKBOOK.format(name=escape(sheet_name[:31], {'"': '&quot;'})))
+
+        with workbook.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            sheet.write(_xlsx_row(header))
+            for row in rows:
+                sheet.write(_xlsx_row(row))
+                if sink.size >= chunk_size:
+                    yield sink.take()
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.take()
+
+
+def export_response(filename, fmt, header, rows):
+    """
+    Streaming download of rows in fmt ('csv' or 'xlsx') as filename.fmt.
+    rows is consumed while the response is sent, within the request context.
+    """
+    if fmt == 'xlsx':
+        chunks = xlsx_chunks(filename, header, rows)
+    else:
+        chunks = csv_chunks(header, rows)
+
+    return Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}.{fmt}"',
+                             'X-Accel-Buffering': 'no'})
+
+
+def export_rows(query, row):
+    """
+    Rows of an export: row(obj) of every result of query, fetched in batches 
+    of BCOURSE_EXPORT_YIELD_PER. Instances are not kept by the session (its 
+    identity map is weak) once the row is written.
+    """
+    for obj in query.yield_per(cv('EXPORT_YIELD_PER')):
+        yield row(obj)
@@ -1,4 +1,13 @@
 from flask import request, g
+from bcource.helpers import TTLCache, config_value as cv
+
+# facet options and count rows per practice, see cached_facets()
+facet_cache = TTLCache(maxsize=128)
+
+
+def cached_facets(key, load):
+    """load(key) cached per process for BCOURSE_FACET_CACHE_TTL seconds, key should include the practice."""
+    return facet_cache.get(key, load, cv('FACET_CACHE_TTL'))
 
 
 class Filters():
@@ -7,6 +16,8 @@ class Filters():
         self.filters = []
         self.filter_ids = 0
         self.filter_dict = {}
+        self.facet_rows = None
+        self.facet_columns = ()
         
         if g.is_mobile == True:
             self.filters_checked = False
@@ -34,9 +45,12 @@ class Filters():
         
         return None
     
-    def process_filters(self):    
+    def process_filters(self, args=None):
+        if args is None:
+            args = request.args
+
         for filter in self.filters:
-            items =  request.args.getlist(filter.id)
+            items =  args.getlist(filter.id)
             
             if len(items):
                 self.filters_checked = True
@@ -46,16 +60,53 @@ class Filters():
                 filter.item_check(item)
 
                 
-        show_submit = request.args.get('show_submit', None)
-        show = request.args.get('show', None)
+        show_submit = args.get('show_submit', None)
+        show = args.get('show', None)
         
         if  show_submit == str("noshow") or show_submit == None and not self.filters_checked and not show :
             self.show = False
         else:
             self.show = True
 
+        if self.facet_rows is not None:
+            self.apply_counts()
+
         return(self)
 
+    def facet_counts(self, rows, columns):
+        """
+        Rows of a grouped count query, (value of filter columns[0], ..., count), 
+        the item counts are set from them by process_filters().
+        """
+        self.facet_rows = rows
+        self.facet_columns = columns
+
+    def apply_counts(self):
+        """
+        Set the count of every item of the facet_columns filters: the rows 
+        with that item that match the items checked in the other filters. A 
+        filter without checked items matches all rows, or only its 
+        unchecked_value when it has one.
+        """
+        selected = []
+        for id in self.facet_columns:
+            filter = self.get_filter(id)
+            checked = {str(item) for item in filter.get_items_checked()} if filter else set()
+            if not checked and filter and filter.unchecked_value is not None:
+                checked = {str(filter.unchecked_value)}
+            selected.append(checked or None)
+
+        for i, id in enumerate(self.facet_columns):
+            filter = self.get_filter(id)
+            if filter is None:
+                continue
+            counts = {}
+            for row in self.facet_rows:
+                if all(values is None or str(row[j]) in values for j, values in enumerate(selected) if j != i):
+                    counts[str(row[i])] = counts.get(str(row[i]), 0) + row[-1]
+            for item in filter:
+                item.count = counts.get(str(item.id), 0)
+
     def __repr__(self)->str:
         return f'<{self.__class__.__name__} name="{self.name}, filters="{self.filters}">'
 
@@ -77,6 +128,8 @@ class Filter():
         self.name = name
         self.filter_items = []
         self.filter_items_dict = {}
+        # value the facet counts of the other filters use when no item is checked, None is all
+        self.unchecked_value = None
     
     def add_filter_item(self, id, name):
         item = FilterItem(id,name)
@@ -113,6 +166,7 @@ class FilterItem():
         self.name = name
         self.id = id
         self.checked = False
+        self.count = None
         
     def __repr__(self)->str:
         return f'<{self.__class__.__name__} id = {self.id} name="{self.name}, checked="{self.checked}">'
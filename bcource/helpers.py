@@ -18,6 +18,12 @@ import nh3
 from jinja2.filters import do_mark_safe
 from datetime import timedelta, datetime
 from copy import deepcopy
+import hashlib
+import html
+import re
+import threading
+import time
+import unicodedata
 
 
 
@@ -34,9 +40,124 @@ def has_trainer_role():
         from bcource.errors import HTTPExceptionMustHaveTwoFactorEnabled
         raise(HTTPExceptionMustHaveTwoFactorEnabled())
     
+class ContentCache(object):
+    """
+    Small per-process LRU keyed by the sha1 of the content, so large html 
+    strings are not kept around as keys.
+    """
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, content, func):
+        key = hashlib.sha1(content.encode('utf-8')).digest()
+        try:
+            self._data.move_to_end(key)
+            return self._data[key]
+        except KeyError:
+            value = func(content)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return value
+
+_sanitize_cache = ContentCache()
+
+class TTLCache(object):
+    """
+    Small per-process LRU of which the entries expire after ttl seconds, so 
+    other processes' changes show up without invalidation. Keys are any 
+    hashable.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, func, ttl):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and entry[0] > now:
+                self._data.move_to_end(key)
+                return entry[1]
+        value = func(key)
+        with self._lock:
+            self._data[key] = (now + ttl, value)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+def sanitize_html(txt):
+    """nh3.clean() memoized by content hash."""
+    if not txt:
+        return txt
+    return _sanitize_cache.get(txt, nh3.clean)
+
+# message search: common Dutch and English words are not indexed
+SEARCH_STOPWORDS = frozenset("""
+    a an and are as at be by for from has have in is it of on or that the this to was were will with you your
+    aan af al als bij dan dat de der die dit door een en er had heb het hij ik in is je jij maar me met mij
+    na naar niet nog of om ook op te tot u uw van voor was wat we wel wij ze zijn
+    """.split())
+# light stemming shared by Dutch and English: trainingen, trainings and training all index as "train"
+SEARCH_SUFFIXES = ('ingen', 'ings', 'ing', 'en', 'es', 's')
+SEARCH_TOKEN_MAX = 64
+
+_search_word = re.compile(r"[^\W_]+")
+_search_cache = ContentCache(maxsize=256)
+
+# letters the utf8mb4_0900_ai_ci collation compares equal to these, which NFKD does not decompose
+# (casefold() already turns ß into ss): tokens are primary keys, two spellings must fold to one
+_search_fold_letters = str.maketrans({'æ': 'ae', 'œ': 'oe', 'ø': 'o', 'đ': 'd', 'ł': 'l', 'ħ': 'h', 'ŧ': 't'})
+
+def search_fold(text):
+    """Casefold text and strip accents (é -> e, ß -> ss, ø -> o), as the database collation compares."""
+    decomposed = unicodedata.normalize('NFKD', text.casefold().translate(_search_fold_letters))
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def search_stem(word):
+    for suffix in SEARCH_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+def _search_tokens(text):
+    tokens = {}
+    for word in _search_word.findall(search_fold(text)):
+        if len(word) < 2 or word in SEARCH_STOPWORDS:
+            continue
+        token = search_stem(word)[:SEARCH_TOKEN_MAX]
+        tokens[token] = tokens.get(token, 0) + 1
+    return tokens
+
+def search_tokens(text, is_html=False):
+    """
+    Search tokens of text as {token: occurrences}: html stripped, folded, 
+    stop words dropped and stemmed. Memoized by content hash.
+    """
+    if not text:
+        return {}
+    if is_html:
+        return _search_cache.get(text, lambda content: _search_tokens(html.unescape(nh3.clean(content, tags=set()))))
+    return _search_tokens(text)
+
+def name_search_terms(*texts):
+    """
+    Folded words of names, an email or a typed lookup, in order and without 
+    duplicates. Unlike search_tokens() nothing is stemmed or dropped, "van" 
+    and "de" are part of a name.
+    """
+    terms = (word[:SEARCH_TOKEN_MAX] for text in texts if text for word in _search_word.findall(search_fold(text)))
+    return list(dict.fromkeys(terms))
+
 def nh3_save(txt):
-    attributes = deepcopy(nh3.ALLOWED_ATTRIBUTES)
-    return do_mark_safe(nh3.clean(txt))
+    return do_mark_safe(sanitize_html(txt))
 
 def message_date(db_datetime_notz, mobile_date=False):
     dt = db_datetime(db_datetime_notz)
@@ -0,0 +1,252 @@
+"""
+iCalendar attachments for training e-mails.
+
+The VEVENT blocks of a training (times, location, organizer, status and
+summary) are the same for every recipient, only the attendee, UID, SEQUENCE
+and DTSTAMP differ. TrainingCalendar serializes the shared part once per
+training and variant and keeps it in a small per-process LRU keyed by the
+training id and the update_datetime of the training, its events and their
+locations, so an edit of any of those builds a fresh skeleton.
+
+UserCalendarFeed builds the personal subscription feed of a user from the
+same cached skeletons.
+"""
+from bcource import db
+from bcource.helpers import db_datetime
+from bcource.helpers import config_value as cv
+from bcource.models import (TrainingEnroll, Training, TrainingEvent, Trainer, Student, Location,
+                            training_trainers_association)
+from collections import OrderedDict
+from icalendar import Calendar, Event, vCalAddress, vText
+from sqlalchemy import select, func, union_all
+from sqlalchemy.orm import selectinload, joinedload
+import datetime as dt
+import hashlib
+import zoneinfo
+
+CRLF = b'\r\n'
+BEGIN_VEVENT = b'BEGIN:VEVENT' + CRLF
+END_VEVENT = b'END:VEVENT' + CRLF
+
+
+def _strip_component(data):
+    """Return the content lines of a serialized component without its BEGIN/END lines."""
+    lines = data.split(CRLF)
+    # lines[0] is BEGIN:..., lines[-2] END:... and lines[-1] the empty tail
+    return CRLF.join(lines[1:-2]) + CRLF
+
+
+class TrainingCalendar(object):
+    """
+    Serialized calendar skeleton of one training, see TrainingCalendar.get().
+    """
+
+    VARIANTS = {
+        'confirmed': dict(method="REQUEST", status="CONFIRMED", partstat="ACCEPTED", summary="{name}"),
+        'waitlist': dict(method="REQUEST", status="TENTATIVE", partstat="TENTATIVE", summary="{name} (Waiting List)"),
+        'cancelled': dict(method="CANCEL", status="CANCELLED", partstat="DECLINED", summary="CANCELLED: {name}"),
+    }
+
+    MAXSIZE = 256
+    _cache = OrderedDict()
+
+    def __init__(self, training, variant):
+        options = self.VARIANTS[variant]
+        self.partstat = options['partstat']
+
+        cal = Calendar()
+        cal.add("prodid", "-//Gnarst B.V.//Bcourse//EN")
+        cal.add("version", "2.0")
+        cal.add('summary', training.name)
+        cal.add('method', options['method'])
+        self.header = b'BEGIN:VCALENDAR' + CRLF + _strip_component(cal.to_ical())
+
+        self.events = []
+        self.event_ids = []
+        for db_event in training.trainingevents:
+            event = Event()
+            event.add('dtstart', db_datetime(db_event.start_time))
+            event.add('dtend', db_datetime(db_event.end_time))
+            event.add('status', options['status'])
+            organizer = vCalAddress('mailto:noreply@bcourse.nl')
+            organizer.params['CN'] = vText('Bcourse')
+            event.add('organizer', organizer)
+            event.add('location', db_event.location.ical_adress)
+            event.add('summary', options['summary'].format(name=training.name))
+            self.events.append(_strip_component(event.to_ical()))
+            self.event_ids.append(db_event.id)
+
+    @staticmethod
+    def cache_key(training, variant):
+        return (variant, training.id, training.update_datetime,
+                tuple((e.id, e.update_datetime, e.location_id, e.location.update_datetime)
+                      for e in training.trainingevents))
+
+    @classmethod
+    def get(cls, training, variant):
+        """Return the cached skeleton of training, building it when the training or its events changed."""
+        key = cls.cache_key(training, variant)
+        try:
+            cls._cache.move_to_end(key)
+            return cls._cache[key]
+        except KeyError:
+            calendar = cls(training, variant)
+            cls._cache[key] = calendar
+            if len(cls._cache) > cls.MAXSIZE:
+                cls._cache.popitem(last=False)
+            return calendar
+
+    @classmethod
+    def clear(cls):
+        cls._cache.clear()
+
+    def attendee_lines(self, user, uid, sequence):
+        event = Event()
+        event.add('dtstamp', dt.datetime.now(tz=zoneinfo.ZoneInfo('Europe/Amsterdam')))
+        event.add('uid', uid)
+        event.add('SEQUENCE', sequence)
+        attendee = vCalAddress(f'mailto:{user.email}')
+        attendee.params['CN'] = vText(user.fullname)
+        attendee.params['PARTSTAT'] = vText(self.partstat)
+        attendee.params['RSVP'] = vText('FALSE')
+        event.add('attendee', attendee)
+        return _strip_component(event.to_ical())
+
+    def to_ical(self, user, uid, sequence):
+        """Serialize the calendar for one attendee."""
+        recipient = self.attendee_lines(user, uid, sequence)
+        parts = [self.header]
+        for event in self.events:
+            parts.extend((BEGIN_VEVENT, event, recipient, END_VEVENT))
+        parts.append(b'END:VCALENDAR' + CRLF)
+        return b''.join(parts)
+
+    def vevents(self, uid_prefix, extra=b''):
+        """VEVENT blocks with a UID per event, as used by the subscription feed."""
+        for event_id, event in zip(self.event_ids, self.events):
+            uid = b'UID:' + vText(f'{uid_prefix}-{event_id}@bcourse').to_ical() + CRLF
+            yield BEGIN_VEVENT + event + uid + extra + END_VEVENT
+
+
+def enrollment_ical(enrollment, variant):
+    """Calendar attachment of an enrollment, uses (and bumps) the enrollment's ical sequence."""
+    calendar = TrainingCalendar.get(enrollment.training, variant)
+    return calendar.to_ical(enrollment.student.user, enrollment.uuid, enrollment.sequence_next)
+
+
+class UserCalendarFeed(object):
+    """
+    Personal calendar feed of a user: the trainings the user is enrolled in
+    and the trainings the user teaches, limited to trainings with events that
+    ended at most BCOURSE_ICAL_FEED_DAYS ago.
+
+    etag() is one aggregate query over the rows the feed is built from, the
+    serialized feed is cached per user together with the etag it was built for.
+    """
+
+    # statuses that are published, with the calendar variant; other enrollments are left out
+    VARIANTS = {'enrolled': 'confirmed', 'waitlist-invited': 'waitlist', 'waitlist': 'waitlist'}
+
+    MAXSIZE = 512
+    _cache = OrderedDict()
+
+    def __init__(self, user):
+        self.user = user
+
+    def recent_trainings(self):
+        since = dt.datetime.utcnow() - dt.timedelta(days=cv('ICAL_FEED_DAYS'))
+        return select(TrainingEvent.training_id).where(TrainingEvent.end_time >= since)
+
+    def feed_rows(self):
+        """(training_id, changed) of every enrollment and taught training in the feed."""
+        recent = self.recent_trainings()
+        enrolled = (select(TrainingEnroll.training_id.label('training_id'),
+                           TrainingEnroll.update_datetime.label('changed'))
+                    .join(Student, Student.id == TrainingEnroll.student_id)
+                    .where(Student.user_id == self.user.id, TrainingEnroll.training_id.in_(recent),
+                           TrainingEnroll.status.in_(self.VARIANTS)))
+
+        taught = (select(training_trainers_association.c.training_id.label('training_id'),
+                         Trainer.update_datetime.label('changed'))
+                  .join(Trainer, Trainer.id == training_trainers_association.c.trainer_id)
+                  .where(Trainer.user_id == self.user.id,
+                         training_trainers_association.c.training_id.in_(recent)))
+
+        return union_all(enrolled, taught).subquery()
+
+    def etag(self):
+        rows = self.feed_rows()
+        stmt = (select(func.count(), func.max(rows.c.changed), func.max(Training.update_datetime),
+                       func.max(TrainingEvent.update_datetime), func.max(Location.update_datetime))
+                .select_from(rows)
+                .join(Training, Training.id == rows.c.training_id)
+                .outerjoin(TrainingEvent, TrainingEvent.training_id == Training.id)
+                .outerjoin(Location, Location.id == TrainingEvent.location_id))
+
+        state = db.session.execute(stmt).one()
+        return hashlib.sha1(f'{self.user.id}:{tuple(state)}'.encode('utf-8')).hexdigest()
+
+    def build(self):
+        recent = self.recent_trainings()
+        events = selectinload(Training.trainingevents).joinedload(TrainingEvent.location)
+
+        enrollments = db.session.scalars(
+            select(TrainingEnroll)
+            .join(Student, Student.id == TrainingEnroll.student_id)
+            .where(Student.user_id == self.user.id, TrainingEnroll.training_id.in_(recent),
+                   TrainingEnroll.status.in_(self.VARIANTS))
+            .options(selectinload(TrainingEnroll.training).options(events))).all()
+
+        taught = db.session.scalars(
+            select(Training)
+            .join(Training.trainers)
+            .where(Trainer.user_id == self.user.id, Training.id.in_(recent))
+            .options(events)).unique().all()
+
+        cal = Calendar()
+        cal.add("prodid", "-//Gnarst B.V.//Bcourse//EN")
+        cal.add("version", "2.0")
+        cal.add("method", "PUBLISH")
+        cal.add("x-wr-calname", "Bcourse")
+        parts = [b'BEGIN:VCALENDAR' + CRLF, _strip_component(cal.to_ical())]
+
+        stamp = Event()
+        stamp.add('dtstamp', dt.datetime.now(tz=zoneinfo.ZoneInfo('Europe/Amsterdam')))
+        dtstamp = _strip_component(stamp.to_ical())
+
+        for enrollment in enrollments:
+            variant = self.VARIANTS.get(enrollment.status)
+            if variant is None:
+                # expired, declined and other statuses without a seat are not published
+                continue
+            calendar = TrainingCalendar.get(enrollment.training, variant)
+            parts.extend(calendar.vevents(enrollment.uuid, dtstamp))
+
+        for training in taught:
+            calendar = TrainingCalendar.get(training, 'confirmed')
+            parts.extend(calendar.vevents(f'training-{training.id}', dtstamp))
+
+        parts.append(b'END:VCALENDAR' + CRLF)
+        return b''.join(parts)
+
+    def to_ical(self, etag=None):
+        """Serialized feed, rebuilt only when the etag changed since the cached copy."""
+        if etag is None:
+            etag = self.etag()
+
+        # the cache is shared by the request threads, another one may evict the entry at any point
+        try:
+            self._cache.move_to_end(self.user.id)
+            cached_etag, data = self._cache[self.user.id]
+            if cached_etag == etag:
+                return data
+        except KeyError:
+            pass
+
+        data = self.build()
+        # popped first so the new entry is added at the end
+        self._cache.pop(self.user.id, None)
+        self._cache[self.user.id] = (etag, data)
+        if len(self._cache) > self.MAXSIZE:
+            self._cache.popitem(last=False)
+        return data
@@ -0,0 +1,185 @@
+"""
+Message retention.
+
+Retention policies are set per MessageTag (retention_days). A message expires
+when it is older than the longest retention of its tags; tags without a policy
+and messages without tags use BCOURSE_MESSAGE_RETENTION_DAYS, and 0 (as policy
+or default) keeps a message. Expired messages are
+written to a gzip compressed JSONL archive and then deleted together with
+their recipient, tag and search rows; bodies no other message uses go too.
+Recipient rows the user deleted more than BCOURSE_MESSAGE_DELETED_RETENTION_DAYS
+ago are purged without archiving.
+
+Work is done in message id ranges of BCOURSE_RETENTION_BATCH_SIZE, one
+transaction per range with a pause of BCOURSE_RETENTION_SLEEP seconds in
+between, so row locks stay short. A run stops after BCOURSE_RETENTION_MAX_BATCHES
+ranges and continues from the start on the next run.
+"""
+from bcource import db
+from bcource.helpers import config_value as cv
+from bcource.models import (Message, MessageBody, MessageTag, MessageSearchToken, UserMessageAssociation,
+                            UserMessageCounter, message_tag_association)
+from flask import current_app
+from sqlalchemy import select, delete, update, func
+from sqlalchemy.orm import selectinload
+from datetime import datetime, timedelta
+import gzip
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MessageRetention(object):
+    """One retention run, see run()."""
+
+    def __init__(self, now=None, archive_dir=None):
+        self.now = now or datetime.utcnow()
+        self.archive_dir = archive_dir or cv('MESSAGE_ARCHIVE_DIR') or \
+            os.path.join(current_app.instance_path, 'message-archive')
+        self.archive_path = None
+        self.batch_size = cv('RETENTION_BATCH_SIZE')
+        self.sleep = cv('RETENTION_SLEEP')
+        self.max_batches = cv('RETENTION_MAX_BATCHES')
+        self.default_days = cv('MESSAGE_RETENTION_DAYS')
+        self.deleted_days = cv('MESSAGE_DELETED_RETENTION_DAYS')
+        self.report = dict(messages_archived=0, recipients_purged=0, deleted_purged=0,
+                           bodies_purged=0, batches=0, seconds=0.0)
+
+    def policies(self):
+        """{tag_id: retention_days} of the tags with a policy."""
+        return dict(db.session.execute(select(MessageTag.id, MessageTag.retention_days)
+                                       .where(MessageTag.retention_days != None)).all())
+
+    def expired(self, rows, tag_rows, policies):
+        """
+        Ids of the messages in rows (id, created_date) past their retention.
+        Every tag counts, a tag without a policy with the default retention.
+        """
+        keep = {}
+        for message_id, tag_id in tag_rows:
+            days = policies.get(tag_id, self.default_days)
+            # None: kept, one tag that keeps its messages keeps the message
+            keep[message_id] = None if not days or keep.get(message_id, 0) is None else \
+                max(keep.get(message_id, 0), days)
+
+        expired = []
+        for message_id, created_date in rows:
+            days = keep.get(message_id, self.default_days)
+            if days and created_date.replace(tzinfo=None) < self.now - timedelta(days=days):
+                expired.append(message_id)
+        return expired
+
+    def archive(self, message_ids):
+        """Append the expired messages to the archive file of this run."""
+        messages = db.session.scalars(select(Message).where(Message.id.in_(message_ids))
+                                      .options(selectinload(Message.tags), selectinload(Message.message_body))
+                                      .order_by(Message.id)).all()
+        recipients = {}
+        for row in db.session.execute(select(UserMessageAssociation.message_id, UserMessageAssociation.user_id,
+                                             UserMessageAssociation.message_read,
+                                             UserMessageAssociation.message_deleted)
+                                      .where(UserMessageAssociation.message_id.in_(message_ids))):
+            recipients.setdefault(row.message_id, []).append(dict(
+                user_id=row.user_id,
+                read=row.message_read.isoformat() if row.message_read else None,
+                deleted=row.message_deleted.isoformat() if row.message_deleted else None))
+
+        if self.archive_path is None:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            self.archive_path = os.path.join(self.archive_dir, f"messages-{self.now:%Y%m%dT%H%M%S}.jsonl.gz")
+
+        with gzip.open(self.archive_path, 'at', encoding='utf-8') as archive:
+            for message in messages:
+                archive.write(json.dumps(dict(
+                    id=message.id,
+                    envelop_from_id=message.envelop_from_id,
+                    in_reply_to_id=message.in_reply_to_id,
+                    created_date=message.created_date.isoformat() if message.created_date else None,
+                    subject=message.subject,
+                    body=message.body,
+                    tags=[tag.tag for tag in message.tags],
+                    recipients=recipients.get(message.id, []))) + "\n")
+        # the archive is only appended to, a failed purge leaves duplicates but never loses a message.
+        # The rows are deleted with bulk statements, the loaded instances must not be used afterwards
+        for message in messages:
+            db.session.expunge(message.message_body)
+            db.session.expunge(message)
+
+    def purge(self, message_ids):
+        unread = dict(db.session.execute(
+            select(UserMessageAssociation.user_id, func.count())
+            .where(UserMessageAssociation.message_id.in_(message_ids),
+                   UserMessageAssociation.message_read == None,
+                   UserMessageAssociation.message_deleted == None)
+            .group_by(UserMessageAssociation.user_id)).all())
+        UserMessageCounter.adjust(db.session, {user_id: -count for user_id, count in unread.items()})
+
+        body_ids = set(db.session.scalars(select(Message.body_id).where(Message.id.in_(message_ids))))
+
+        db.session.execute(update(Message).where(Message.in_reply_to_id.in_(message_ids))
+                           .values(in_reply_to_id=None))
+        self.report['recipients_purged'] += db.session.execute(
+            delete(UserMessageAssociation).where(UserMessageAssociation.message_id.in_(message_ids))).rowcount
+        db.session.execute(delete(message_tag_association).where(message_tag_association.c.message_id.in_(message_ids)))
+        db.session.execute(delete(MessageSearchToken).where(MessageSearchToken.message_id.in_(message_ids)))
+        db.session.execute(delete(Message).where(Message.id.in_(message_ids)))
+
+        in_use = set(db.session.scalars(select(Message.body_id).where(Message.body_id.in_(body_ids))))
+        if body_ids - in_use:
+            self.report['bodies_purged'] += db.session.execute(
+                delete(MessageBody).where(MessageBody.id.in_(body_ids - in_use))).rowcount
+
+    def purge_deleted(self, low, high):
+        """Recipient rows in the message id range [low, high] the user deleted long enough ago."""
+        if not self.deleted_days:
+            return
+        cutoff = self.now - timedelta(days=self.deleted_days)
+        self.report['deleted_purged'] += db.session.execute(delete(UserMessageAssociation).where(
+            UserMessageAssociation.message_id.between(low, high),
+            UserMessageAssociation.message_deleted != None,
+            UserMessageAssociation.message_deleted < cutoff)).rowcount
+
+    def run(self):
+        """Run the retention in id ranges, returns the report of the run."""
+        start = time.monotonic()
+        policies = self.policies()
+
+        # nothing created after the shortest retention can expire
+        shortest = min([days for days in list(policies.values()) + [self.default_days, self.deleted_days] if days],
+                       default=None)
+        if shortest is None:
+            return self.report
+        last_id = db.session.scalar(select(func.max(Message.id))
+                                    .where(Message.created_date < self.now - timedelta(days=shortest)))
+
+        low = 0
+        while last_id and low < last_id and self.report['batches'] < self.max_batches:
+            rows = db.session.execute(select(Message.id, Message.created_date)
+                                      .where(Message.id > low, Message.id <= last_id)
+                                      .order_by(Message.id).limit(self.batch_size)).all()
+            if not rows:
+                break
+            high = rows[-1].id
+
+            tag_rows = db.session.execute(select(message_tag_association.c.message_id,
+                                                 message_tag_association.c.messagetag_id)
+                                          .where(message_tag_association.c.message_id.between(rows[0].id, high))).all()
+            expired = self.expired(rows, tag_rows, policies)
+            if expired:
+                self.archive(expired)
+                self.purge(expired)
+                self.report['messages_archived'] += len(expired)
+            self.purge_deleted(rows[0].id, high)
+            db.session.commit()
+
+            self.report['batches'] += 1
+            low = high
+            if self.sleep:
+                time.sleep(self.sleep)
+
+        self.report['seconds'] = round(time.monotonic() - start, 2)
+        self.report['archive'] = self.archive_path
+        return self.report
@@ -1,56 +1,134 @@
 from bcource import db, security
-from bcource.models import Content, Message
+from bcource.models import Content, Message, TrainerNotification
 from flask_mailman import EmailMultiAlternatives
-from bs4 import BeautifulSoup
-from icalendar import Calendar, Event, vCalAddress, vText
-from bcource.helpers import db_datetime, format_phone_number
+from html.parser import HTMLParser
+from bcource.helpers import format_phone_number
+from bcource.ical import enrollment_ical
 from bcource.helpers import config_value as cv
-import datetime as dt
-import zoneinfo
+from bcource.helpers import ContentCache
+from flask import g, has_app_context
+from contextlib import contextmanager
+from functools import partial
 import logging
+import re
 
 logger = logging.getLogger(__name__)
 
 
-def cleanhtml(raw_html):
-    """Convert HTML to plain text with better formatting preservation."""
-    soup = BeautifulSoup(raw_html, "html.parser")
-
-    # Convert links to include URL in plain text
-    for a in soup.find_all('a'):
-        href = a.get('href')
-        if href:
-            # Replace link with text and URL
-            a.replace_with(f'{a.get_text()} ({href})')
-
-    # Add newlines before/after block elements for better readability
-    for br in soup.find_all('br'):
-        br.replace_with('\n')
-
-    for p in soup.find_all('p'):
-        p.insert_before('\n')
-        p.insert_after('\n')
-
-    for div in soup.find_all('div'):
-        div.insert_after('\n')
-
-    for h in soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6']):
-        h.insert_before('\n')
-        h.insert_after('\n')
+class HTMLToText(HTMLParser):
+    """
+    Streaming html to plain text converter: links keep their url, block
+    elements and line breaks become newlines and list items get a bullet.
+    """
+    BLOCK_TAGS = {'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+    SKIP_TAGS = {'script', 'style'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._link = None
+        self._href = None
+        self._skip = 0
+
+    def _out(self, text):
+        (self._link if self._link is not None else self.parts).append(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip += 1
+        elif tag == 'br':
+            self._out('\n')
+        elif tag in self.BLOCK_TAGS:
+            self._out('\n')
+        elif tag == 'li':
+            self._out('\n  • ')
+        elif tag == 'a':
+            self._href = dict(attrs).get('href')
+            self._link = []
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in self.BLOCK_TAGS or tag == 'div':
+            self._out('\n')
+        elif tag == 'a' and self._link is not None:
+            text = ''.join(self._link)
+            self._link = None
+            self.parts.append(f'{text} ({self._href})' if self._href else text)
+
+    def handle_data(self, data):
+        if not self._skip:
+            self._out(data)
+
+    def text(self):
+        self.close()
+        if self._link is not None:
+            self.parts.extend(self._link)
+            self._link = None
+        return ''.join(self.parts)
+
+
+_MULTI_NEWLINE = re.compile(r'\n\s*\n\s*\n+')
+_MULTI_SPACE = re.compile(r'[ \t]+')
+_BLANK_LINE = re.compile(r'\n[ \t]+\n')
+
+def _html_to_text(raw_html):
+    parser = HTMLToText()
+    parser.feed(raw_html)
+    text = parser.text()
 
-    for li in soup.find_all('li'):
-        li.insert_before('\n  • ')
+    # Clean up multiple newlines but preserve paragraph structure
+    text = _MULTI_NEWLINE.sub('\n\n', text)  # Max 2 consecutive newlines
+    text = _MULTI_SPACE.sub(' ', text)  # Multiple spaces to single space
+    text = _BLANK_LINE.sub('\n\n', text)  # Whitespace-only lines to empty lines
+    return text.strip()
 
-    # Get text and clean up excessive whitespace
-    text = soup.get_text()
+_cleanhtml_cache = ContentCache()
 
-    # Clean up multiple newlines but preserve paragraph structure
-    import re
-    text = re.sub(r'\n\s*\n\s*\n+', '\n\n', text)  # Max 2 consecutive newlines
-    text = re.sub(r'[ \t]+', ' ', text)  # Multiple spaces to single space
-    text = text.strip()
+def cleanhtml(raw_html):
+    """Convert HTML to plain text with better formatting preservation."""
+    if not raw_html:
+        return ''
+    return _cleanhtml_cache.get(raw_html, _html_to_text)
+
+def _outbox():
+    """The list collecting the messages of a deferred_messages() block, None when they go out directly."""
+    return g.get('deferred_messages') if has_app_context() else None
+
+
+@contextmanager
+def deferred_messages():
+    """
+    Collect the messages sent in the block (and the notify() callbacks) 
+    instead of delivering them. Yields the outbox: pass it to 
+    send_deferred() once the changes the messages are about are committed, 
+    or drop it when they are rolled back.
+    """
+    previous = g.get('deferred_messages')
+    g.deferred_messages = outbox = []
+    try:
+        yield outbox
+    finally:
+        g.deferred_messages = previous
+
+
+def notify(callback, *args):
+    """Call callback(*args) now, or after the commit inside a deferred_messages() block."""
+    outbox = _outbox()
+    if outbox is None:
+        return callback(*args)
+    outbox.append(partial(callback, *args))
+
+
+def send_deferred(outbox):
+    """Deliver the messages and callbacks collected by deferred_messages()."""
+    messages = [msg for msg in outbox if isinstance(msg, SystemMessage)]
+    if messages:
+        SystemMessage.send_bulk(messages)
+    for callback in outbox:
+        if not isinstance(callback, SystemMessage):
+            callback()
 
-    return text
 
 class SystemMessage(object):
     
@@ -60,6 +138,7 @@ class SystemMessage(object):
                  CONTENT_TAG=None,
                  body=None,
                  subject=None,
+                 in_reply_to=None,
                  **kwargs):
         
 
@@ -102,6 +181,7 @@ class SystemMessage(object):
 
         self.envelop_from = envelop_from
         self.envelop_to = envelop_to
+        self.in_reply_to = in_reply_to
         
         
     def render_subject(self):
@@ -110,25 +190,77 @@ class SystemMessage(object):
     def render_body(self):
         return self.body
         
+    def db_message(self):
+        return dict(envelop_from=self.envelop_from,
+                    envelop_to=self.envelop_to,
+                    body=self.render_body(),
+                    subject=self.render_subject(),
+                    in_reply_to=self.in_reply_to,
+                    tags=self.taglist)
+
     def send(self):
+        outbox = _outbox()
+        if outbox is not None:
+            outbox.append(self)
+            return None
         logging.info (f'Send message center-message ({self.CONTENT_TAG}) to {self.envelop_to}')
-        Message.create_db_message(db_session=db.session,
-                                  envelop_from=self.envelop_from,
-                                  envelop_to=self.envelop_to,
-                                  body=self.render_body(),
-                                  subject=self.render_subject(),
-                                  tags=self.taglist)
+        return Message.create_db_message(db_session=db.session, **self.db_message())
+
+    def send_to_trainers(self, training=None):
+        """
+        Deliver a trainer notification according to each recipient's cadence:
+        recipients with immediate delivery get the message now, for the others 
+        it is queued as a TrainerNotification for the TrainerDigestTask.
+        """
+        queued = []
+        if TrainerNotification.digest_active():
+            queued = [user for user in self.envelop_to if TrainerNotification.cadence(user) != 'immediate']
+
+        for user in queued:
+            db.session.add(TrainerNotification(user_id=user.id,
+                                               training_id=training.id if training else None,
+                                               subject=self.render_subject(),
+                                               body=self.render_body(),
+                                               tags=",".join(self.taglist),
+                                               email=isinstance(self, SendEmail)))
+
+        immediate = [user for user in self.envelop_to if user not in queued]
+        if immediate:
+            self.envelop_to = immediate
+            self.send()
+        else:
+            logging.info (f'Queued message ({self.CONTENT_TAG}) for the digest of {queued}')
+            db.session.commit()
+
+    @staticmethod
+    def send_bulk(messages):
+        """
+        Send a batch of messages: e-mails go out per message, the message 
+        center copies are stored together with a single commit.
+        """
+        for msg in messages:
+            if isinstance(msg, SendEmail):
+                msg.send_email()
+
+        logging.info (f'Send {len(messages)} message center-message(s)')
+        return Message.create_db_messages(db.session, [msg.db_message() for msg in messages])
 
 
 class SendEmail(SystemMessage):
     message_tag = "email"
     
     def send(self):
+        if _outbox() is not None:
+            return super().send()
+        self.send_email()
+        return super().send()
+
+    def send_email(self):
 
         if not SendEmail.message_tag in self.taglist:
             self.taglist.append(SendEmail.message_tag)
 
-
+        # Resolved once per send, not per recipient
         envelop_from_system = security.datastore.find_user(email=cv('SYSTEM_USER'))
         # If system user has no name, fullname returns email - avoid duplicate email format
         if envelop_from_system.fullname == envelop_from_system.email:
@@ -136,6 +268,16 @@ class SendEmail(SystemMessage):
         else:
             email_from = f'{envelop_from_system.fullname} <{envelop_from_system.email}>'
 
+        # Build reply-to from config if set
+        reply_to = []
+        from flask import current_app
+        reply_to_addr = current_app.config.get('MAIL_DEFAULT_REPLY_TO')
+        if reply_to_addr:
+            reply_to = [reply_to_addr]
+
+        # Recipients grouped by language, body and subject are rendered once per language
+        rendered = {}
+
         for user in self.envelop_to:
             # Skip users who have opted out of transactional emails
             if hasattr(user, 'usersettings') and user.usersettings and not user.usersettings.msg_transactional_emails:
@@ -148,30 +290,17 @@ class SendEmail(SystemMessage):
             else:
                 email_str = f'{user.fullname} <{user.email}>'
 
-            # Resolve per-user body and subject based on language preference
             if self.CONTENT_TAG and self.CONTENT_TAG != 'mail-a-form':
                 user_lang = getattr(getattr(user, 'usersettings', None), 'language', None) or 'en'
-                per_user_body = Content.get_tag(self.CONTENT_TAG, lang=user_lang, **self.kwargs)
-                per_user_subject = Content.get_subject(self.CONTENT_TAG, lang=user_lang, **self.kwargs)
             else:
-                per_user_body = self.body
-                per_user_subject = self.subject
-
-            # Get HTML body
-            html_body = self.email_render_body(per_user_body)
-
-            # Generate plain text version from HTML
-            text_body = self.email_render_text_body(html_body)
+                user_lang = None
 
-            # Build reply-to from config if set
-            reply_to = []
-            from flask import current_app
-            reply_to_addr = current_app.config.get('MAIL_DEFAULT_REPLY_TO')
-            if reply_to_addr:
-                reply_to = [reply_to_addr]
+            if user_lang not in rendered:
+                rendered[user_lang] = self.render_language(user_lang)
+            subject, html_body, text_body = rendered[user_lang]
 
             # Create multipart message with plain text body
-            msg = EmailMultiAlternatives(subject=cleanhtml(per_user_subject),
+            msg = EmailMultiAlternatives(subject=subject,
                                          body=text_body,
                                          from_email=email_from,
                                          to=[email_str],
@@ -190,19 +319,34 @@ class SendEmail(SystemMessage):
 
             msg.send()
 
-        super().send()
+    def render_language(self, lang):
+        """Return (subject, html body, text body) for one language, None means the default body."""
+        if lang is None:
+            body, subject = self.body, self.subject
+        else:
+            body, subject = Content.render(self.CONTENT_TAG, lang=lang, **self.kwargs)
+
+        html_body = self.email_render_body(body)
+        return cleanhtml(subject), html_body, self.email_render_text_body(html_body)
 
     def process_attachment(self, msg):
         return(msg)
 
     def email_render_body(self, body=None):
         """Render email body with professional footer."""
-        from flask import url_for
-
         # Get the base body content
         if body is None:
             body = self.body
 
+        return body + self.email_footer()
+
+    def email_footer(self):
+        """Footer html, the account url is resolved once per message."""
+        if getattr(self, '_footer', None) is not None:
+            return self._footer
+
+        from flask import url_for
+
         # Generate footer
         try:
             account_url = url_for('user_bp.index', _external=True)
@@ -226,8 +370,8 @@ class SendEmail(SystemMessage):
   <a href="https://bcourse.nl/account/">Manage your account settings</a>
 </p>
 '''
-
-        return body + footer
+        self._footer = footer
+        return footer
 
     def email_render_text_body(self, html_body):
         """Convert HTML body to plain text for multipart email."""
@@ -353,41 +497,8 @@ class EmailStudentEnrolledInTrainingWaitlist(SendEmail):
         enrollment = self.kwargs['enrollment']
         if not enrollment:
             raise Exception(f"'enrollment' cannot be Null")
-        
-        user = enrollment.student.user
-        training = enrollment.training
-
-        cal = Calendar()
-        cal.add("prodid", "-//Gnarst B.V.//Bcourse//EN")
-        cal.add("version", "2.0")
-        cal.add('summary', training.name)
-        cal.add('method', "REQUEST")
-
-
-        for db_event in training.trainingevents:
-
-            event = Event()
-            event.add('dtstart', db_datetime(db_event.start_time))
-            event.add('dtend', db_datetime(db_event.end_time))
-            event.add('dtstamp', dt.datetime.now(tz=zoneinfo.ZoneInfo('Europe/Amsterdam')))
-            event.add('uid', enrollment.uuid)
-            event.add('SEQUENCE', enrollment.sequence_next)
-            event.add('status', "TENTATIVE")
-            organizer = vCalAddress('mailto:noreply@bcourse.nl')
-            organizer.params['CN'] = vText('Bcourse')
-            event.add('organizer', organizer)
-            attendee = vCalAddress(f'mailto:{user.email}')
-            attendee.params['CN'] = vText(user.fullname)
-            attendee.params['PARTSTAT'] = vText('TENTATIVE')
-            attendee.params['RSVP'] = vText('FALSE')
-            event.add('attendee', attendee)
-            event.add('location', db_event.location.ical_adress)
-            event.add('summary', f'{training.name} (Waiting List)')
-            cal.add_component(event)
-            
-        cal.to_ical()
-        
-        msg.attach(f'{training.name}.ics', cal.to_ical(), 'text/calendar')
+
+        msg.attach(f'{enrollment.training.name}.ics', enrollment_ical(enrollment, 'waitlist'), 'text/calendar')
 
 class EmailStudentEnrolledWaitlist(SendEmail):
     message_tag = "wait list"
@@ -402,41 +513,8 @@ class EmailStudentEnrolledInTraining(SendEmail):
         enrollment = self.kwargs['enrollment']
         if not enrollment:
             raise Exception(f"'enrollment' cannot be Null")
-        
-        user = enrollment.student.user
-        training = enrollment.training
-
-        cal = Calendar()
-        cal.add("prodid", "-//Gnarst B.V.//Bcourse//EN")
-        cal.add("version", "2.0")
-        cal.add('summary', training.name)
-        cal.add('method', "REQUEST")
-
-
-        for db_event in training.trainingevents:
-
-            event = Event()
-            event.add('dtstart', db_datetime(db_event.start_time))
-            event.add('dtend', db_datetime(db_event.end_time))
-            event.add('dtstamp', dt.datetime.now(tz=zoneinfo.ZoneInfo('Europe/Amsterdam')))
-            event.add('uid', enrollment.uuid)
-            event.add('SEQUENCE', enrollment.sequence_next)
-            event.add('status', "CONFIRMED")
-            organizer = vCalAddress('mailto:noreply@bcourse.nl')
-            organizer.params['CN'] = vText('Bcourse')
-            event.add('organizer', organizer)
-            attendee = vCalAddress(f'mailto:{user.email}')
-            attendee.params['CN'] = vText(user.fullname)
-            attendee.params['PARTSTAT'] = vText('ACCEPTED')
-            attendee.params['RSVP'] = vText('FALSE')
-            event.add('attendee', attendee)
-            event.add('location', db_event.location.ical_adress)
-            event.add('summary', training.name)
-            cal.add_component(event)
-            
-        cal.to_ical()
-        
-        msg.attach(f'{training.name}.ics', cal.to_ical(), 'text/calendar')
+
+        msg.attach(f'{enrollment.training.name}.ics', enrollment_ical(enrollment, 'confirmed'), 'text/calendar')
 
 class EmailStudentDerolledInTraining(SendEmail):
     message_tag = "derolled"
@@ -449,42 +527,8 @@ class EmailStudentDerolledInTraining(SendEmail):
         enrollment = self.kwargs['enrollment']
         if not enrollment:
             raise Exception(f"'enrollment' cannot be Null")
-        
-        user = enrollment.student.user
-        training = enrollment.training
-        
-        cal = Calendar()
-        cal.add("prodid", "-//Gnarst B.V.//Bcourse//EN")
-        cal.add("version", "2.0")
-        cal.add('summary', training.name)
-        cal.add('method', "CANCEL")
-        
-        for db_event in training.trainingevents:
-            
-            uuid = enrollment.uuid
-            
-            event = Event()
-            event.add('dtstart', db_datetime(db_event.start_time))
-            event.add('dtend', db_datetime(db_event.end_time))
-            event.add('dtstamp', dt.datetime.now(tz=zoneinfo.ZoneInfo('Europe/Amsterdam')))
-            event.add('uid', uuid)
-            event.add('SEQUENCE', enrollment.sequence_next)
-            event.add('status', "CANCELLED")
-            organizer = vCalAddress('mailto:noreply@bcourse.nl')
-            organizer.params['CN'] = vText('Bcourse')
-            event.add('organizer', organizer)
-            attendee = vCalAddress(f'mailto:{user.email}')
-            attendee.params['CN'] = vText(user.fullname)
-            attendee.params['PARTSTAT'] = vText('DECLINED')
-            attendee.params['RSVP'] = vText('FALSE')
-            event.add('attendee', attendee)
-            event.add('location', db_event.location.ical_adress)
-            event.add('summary', f"CANCELLED: {enrollment.training.name}")
-            cal.add_component(event)
-            
-        cal.to_ical()
-        
-        msg.attach(f'{enrollment.training.name} canceled.ics', cal.to_ical(), 'text/calendar')
+
+        msg.attach(f'{enrollment.training.name} canceled.ics', enrollment_ical(enrollment, 'cancelled'), 'text/calendar')
 
 class EmailStudentStatusActive(SendEmail):
     message_tag = "active"
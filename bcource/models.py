@@ -2,7 +2,7 @@ import datetime
 from typing import List
 from sqlalchemy.dialects.mysql import LONGTEXT
 
-from sqlalchemy import Integer, String, Double,Date, ForeignKey, Table, Column, Text, TIMESTAMP, Boolean, DateTime, UniqueConstraint, Interval,  and_
+from sqlalchemy import Integer, String, Double,Date, ForeignKey, Table, Column, Text, TIMESTAMP, Boolean, DateTime, UniqueConstraint, Interval,  and_, LargeBinary
 from sqlalchemy.orm import Mapped, mapped_column, relationship, declared_attr, backref
 from sqlalchemy.sql import func
 from flask_security.models import sqla as sqla
@@ -10,12 +10,16 @@ from bcource import db, security
 from flask_security import hash_password, RoleMixin
 from flask import render_template_string
 from bcource.helpers import config_value as cv
-from bcource.helpers import genpwd
+from bcource.helpers import genpwd, sanitize_html, search_tokens, name_search_terms, TTLCache
 from flask import current_app, session
-from sqlalchemy import or_
+from sqlalchemy import or_, event, update, select, case, bindparam, literal
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy import orm
+from sqlalchemy.exc import IntegrityError
 import nh3
+import hashlib
+import zlib
+import secrets
 from enum import Enum
 from datetime import timedelta
 import logging
@@ -67,8 +71,12 @@ class Practice(db.Model):
     )
 
     @classmethod
-    def default_row(cls, practice=None):
-
+    def current(cls, practice=None):
+        """
+        The practice selected in the session, or the practice with shortname 
+        practice (default DEFAULT_PRACTICE_SHORTNAME). Read only, None when 
+        it does not exist; default_row() creates it.
+        """
         obj = None
         
         if (practice == None and session and session.get('practice')):
@@ -83,6 +91,12 @@ class Practice(db.Model):
                 practice = cv('DEFAULT_PRACTICE_SHORTNAME')
                 
             obj = cls().query.filter(cls.shortname==practice).first()
+        return obj
+
+    @classmethod
+    def default_row(cls, practice=None):
+
+        obj = cls.current(practice)
         
         if not obj:
             obj = cls(name=cv('DEFAULT_PRACTICE'),
@@ -95,7 +109,8 @@ class GetAll(object):
     @classmethod
     def get_all(cls, practice=None):
         if not practice:
-            practice = Practice.default_row().shortname
+            current = Practice.current()
+            practice = current.shortname if current else cv('DEFAULT_PRACTICE_SHORTNAME')
             
         return cls().query.join(Practice).filter(
                                     Practice.shortname==practice
@@ -234,10 +249,20 @@ class TrainingEnroll(db.Model):
     ical_sequence: Mapped[int] = mapped_column(Integer(), nullable=True)
 
 
-    __table_args__ = (db.UniqueConstraint("student_id", "training_id"),)
+    __table_args__ = (db.UniqueConstraint("student_id", "training_id"),
+                      db.Index("ix_training_enroll_waitlist_queue", "training_id", "status",
+                               "waitlist_opt_out", "waitlist_position"),)
 
     status: Mapped[str] = mapped_column(String(256), nullable=False)
 
+    # 1-based position in the waitlist queue of the training, NULL when the
+    # enrollment is not on the waitlist. Maintained by _waitlist_before_flush().
+    waitlist_position: Mapped[int] = mapped_column(Integer(), nullable=True)
+
+    # Denormalized copy of "UserSettings.msg_transactional_emails == False" so
+    # next-eligible lookups do not have to join Student/User/UserSettings.
+    waitlist_opt_out: Mapped[bool] = mapped_column(Boolean(), default=False, nullable=False, server_default="0")
+
     student_id: Mapped[int] = mapped_column(ForeignKey("student.id"), primary_key=True)
     student: Mapped["Student"] = relationship(backref=backref("studentenrollments"))
 
@@ -253,6 +278,32 @@ class TrainingEnroll(db.Model):
 
     paid: Mapped[bool] = mapped_column(Boolean(), default=False, nullable=False, server_default="0")
 
+    @classmethod
+    def compact_waitlist(cls, session, training_id, positions, skip=()):
+        """
+        Close the gaps left in the waitlist queue of a training by entries 
+        that held the given positions, using a single UPDATE. Instances 
+        already loaded in the session are updated to match.
+        """
+        positions = sorted(p for p in positions if p != None)
+        if not positions:
+            return
+
+        shift = sum(case((cls.waitlist_position > p, 1), else_=0) for p in positions)
+        session.execute(update(cls).where(
+            cls.training_id==training_id,
+            cls.status=='waitlist',
+            cls.waitlist_position > positions[0]
+            ).values(waitlist_position=cls.waitlist_position - shift
+            ).execution_options(synchronize_session=False))
+
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, cls) and obj not in skip and obj.training_id == training_id \
+                    and obj.status == 'waitlist' and obj.waitlist_position != None:
+                gaps = len([p for p in positions if p < obj.waitlist_position])
+                if gaps:
+                    orm.attributes.set_committed_value(obj, 'waitlist_position', obj.waitlist_position - gaps)
+
     @hybrid_property
     def sequence_next(self):
         if self.ical_sequence == None:
@@ -312,32 +363,34 @@ class Training(db.Model):
 
     def _cal_enrollments(self):
         if self._spots_enrolled == None:
-            self._spots_enrolled = TrainingEnroll.query.join(Training).filter(
-                                TrainingEnroll.training_id==self.id, or_(TrainingEnroll.status == 'enrolled', 
-                                                                         TrainingEnroll.status == 'waitlist-invited')
+            self._spots_enrolled = TrainingEnroll.query.filter(
+                                TrainingEnroll.training_id==self.id, 
+                                TrainingEnroll.status.in_(['enrolled', 'waitlist-invited'])
                                 ).count()
 
-        if self._spots_waitlist == None:
-            self._spots_waitlist = TrainingEnroll.query.join(Training).join(Student).join(
-                            Student.user
-                        ).outerjoin(UserSettings, UserSettings.user_id == User.id).filter(
-                            TrainingEnroll.training_id==self.id,
-                            TrainingEnroll.status.in_(['waitlist']),
-                            or_(UserSettings.msg_transactional_emails == True, UserSettings.id == None)
-                        ).order_by(TrainingEnroll.enrole_date).all()  
-                                                
-        self._spots_waitlist_count = len(self._spots_waitlist)
-
         spots_available = self.max_participants - self._spots_enrolled
         self._spots_available = spots_available
 
-        i=0
-        while i < spots_available and i < len(self._spots_waitlist):
-            enrollment = self._spots_waitlist[i]
-            i += 1
-            self.student_allowed[enrollment.student.id]=enrollment
+        if self._spots_waitlist == None:
+            waitlist = TrainingEnroll.query.filter(
+                            TrainingEnroll.training_id==self.id,
+                            TrainingEnroll.status=='waitlist',
+                            TrainingEnroll.waitlist_opt_out==False)
 
-        logger.info(f'Training: "{self}" _spots_enrolled: {self._spots_enrolled} _spots_waitlist: {self._spots_waitlist} _student_allowed: {self.student_allowed} _spots_available: {self._spots_available}'  )
+            self._spots_waitlist_count = waitlist.count()
+            
+            # only the head of the queue can be invited, seek just those rows 
+            self._spots_waitlist = []
+            if spots_available > 0:
+                self._spots_waitlist = waitlist.order_by(TrainingEnroll.waitlist_position, 
+                                                         TrainingEnroll.enrole_date
+                                                         ).limit(spots_available).all()
+
+        for enrollment in self._spots_waitlist:
+            self.student_allowed[enrollment.student_id]=enrollment
+
+        logger.debug('Training id=%s _spots_enrolled: %s _spots_waitlist_count: %s _spots_available: %s',
+                     self.id, self._spots_enrolled, self._spots_waitlist_count, self._spots_available)
         
         
     def waitlist_enrollments_eligeble(self):
@@ -557,6 +610,64 @@ class StudentType(db.Model, GetAll):
         db.session.commit()
         return(obj)
 
+
+class ReferenceVersion(db.Model):
+    """
+    Version stamp of the reference data of a practice (training types,
+    locations, policies, student statuses and types), bumped by every flush
+    that changes one of them. bcource.reference_data reloads its cached
+    copy of a practice when the stamp differs.
+    """
+    practice_id: Mapped[int] = mapped_column(ForeignKey("practice.id", ondelete="CASCADE"), primary_key=True)
+    version: Mapped[int] = mapped_column(Integer(), default=0, nullable=False)
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} practice_id={self.practice_id} version={self.version}>'
+
+
+REFERENCE_MODELS = (Practice, TrainingType, Location, Policy, StudentStatus, StudentType)
+# collections that are part of the reference data, other collections (a practice's students, a
+# training type's trainings) change all the time and do not bump the version
+REFERENCE_COLLECTIONS = {TrainingType: ('policies',), Policy: ('trainingtypes',)}
+
+
+def _reference_changed(session, obj):
+    if obj not in session.dirty:
+        return True
+    if session.is_modified(obj, include_collections=False):
+        return True
+    return any(orm.attributes.get_history(obj, attr).has_changes() for attr in REFERENCE_COLLECTIONS.get(type(obj), ()))
+
+
+def _reference_practice_ids(obj):
+    """Practices of obj, before and after the pending change."""
+    if isinstance(obj, Practice):
+        return {obj.id} - {None}
+    state = orm.attributes.instance_state(obj)
+    ids = set(state.attrs.practice_id.history.sum())
+    ids.update(practice.id for practice in state.attrs.practice.history.sum() if practice is not None)
+    return ids - {None}
+
+
+@event.listens_for(orm.Session, "before_flush")
+def _reference_version_before_flush(session, flush_context, instances):
+    """Bump the ReferenceVersion of every practice of which reference data changes in this flush."""
+    practice_ids = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Practice) and obj in session.deleted:
+            continue
+        if isinstance(obj, REFERENCE_MODELS) and _reference_changed(session, obj):
+            practice_ids |= _reference_practice_ids(obj)
+
+    for practice_id in practice_ids:
+        with session.no_autoflush:
+            stamp = session.get(ReferenceVersion, practice_id)
+        if stamp is None:
+            session.add(ReferenceVersion(practice_id=practice_id, version=1))
+        else:
+            stamp.version = ReferenceVersion.version + 1
+
+
 class Student(db.Model):
     
     __table_args__ = (
@@ -610,19 +721,334 @@ class Student(db.Model):
     def __repr__(self) -> str:
         return f'<{self.__class__.__name__} id={self.id} user_id={self.user_id}>'
 
+    # system accounts that never get a student record
+    NO_STUDENT_EMAILS = ("do-not-reply@bcourse.nl", "not-reply@bcourse.nl")
+
+    @classmethod
+    def create_default(cls, user):
+        """Add a student record with the default type, status and practice for user, without committing."""
+        student = cls(user=user,
+                      studentstatus=StudentStatus.default_row(),
+                      studenttype=StudentType.default_row(),
+                      practice=Practice.default_row())
+        db.session.add(student)
+        return student
+
+    @classmethod
+    def missing_user_ids(cls):
+        return db.session.scalars(select(User.id).where(
+            ~User.students.any(), User.email.not_in(cls.NO_STUDENT_EMAILS))).all()
+
+    @classmethod
+    def create_missing(cls):
+        """
+        Create the student records of users that have none (registered before 
+        the signal handlers existed, created by an admin, ...). Returns the 
+        number of records created.
+        """
+        user_ids = cls.missing_user_ids()
+        if not user_ids:
+            return 0
+
+        studentstatus, studenttype, practice = StudentStatus.default_row(), StudentType.default_row(), Practice.default_row()
+        db.session.execute(cls.__table__.insert(), [dict(user_id=user_id,
+                                                         studentstatus_id=studentstatus.id,
+                                                         studenttype_id=studenttype.id,
+                                                         practice_id=practice.id) for user_id in user_ids])
+        db.session.commit()
+        return len(user_ids)
+
 class UserMessageAssociation(db.Model):
     __tablename__ = "user_message"
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"), primary_key=True)
     message_id: Mapped[int] = mapped_column(ForeignKey("message.id", ondelete="CASCADE"), primary_key=True)
 
-    message_deleted: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)  
-    message_read: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)    
+    # active_history: the old value is needed by _message_counter_before_flush()
+    message_deleted: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True, active_history=True)
+    message_read: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True, active_history=True)
 
     message: Mapped["Message"] = relationship(back_populates="envelop_to"
                                               )
     user: Mapped["User"] = relationship(back_populates="messages")
 
 
+    @property
+    def unread(self):
+        return self.message_read == None and self.message_deleted == None
+
+
+class UserMessageCounter(db.Model):
+    """
+    Unread message count per user. Changes to user_message adjust it in the 
+    same transaction: ORM changes through _message_counter_before_flush(), 
+    bulk inserts and UPDATEs call adjust() themselves. UnreadCountReconcileTask
+    repairs any drift with reconcile().
+    """
+    __tablename__ = "user_message_counter"
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"), primary_key=True)
+    unread_count: Mapped[int] = mapped_column(Integer(), default=0, nullable=False, server_default="0")
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} user_id={self.user_id} unread_count={self.unread_count}>'
+
+    @classmethod
+    def lock(cls, session, user_id):
+        """Lock the counter row of a user for the rest of the transaction."""
+        return session.execute(select(cls.__table__.c.unread_count).where(
+            cls.__table__.c.user_id == user_id).with_for_update()).scalar()
+
+    @classmethod
+    def adjust(cls, session, deltas):
+        """
+        Add deltas ({user_id: n}) to the counters with one upsert, missing rows 
+        are created. Concurrent transactions add to the same row, none of them 
+        reads the count first.
+        """
+        deltas = {user_id: n for user_id, n in deltas.items() if n}
+        if not deltas:
+            return
+
+        table = cls.__table__
+        if db.engine.dialect.name == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            stmt = insert(table)
+            stmt = stmt.on_duplicate_key_update(unread_count=table.c.unread_count + stmt.inserted.unread_count)
+        else:
+            # SQLite (development and tests)
+            from sqlalchemy.dialects.sqlite import insert
+            stmt = insert(table)
+            stmt = stmt.on_conflict_do_update(index_elements=[table.c.user_id],
+                                              set_={'unread_count': table.c.unread_count + stmt.excluded.unread_count})
+        session.execute(stmt, [{'user_id': user_id, 'unread_count': n} for user_id, n in deltas.items()])
+        UserChange.log(session, 'unread', [(user_id, None, None) for user_id in deltas])
+
+        for user_id in deltas:
+            counter = session.identity_map.get(orm.util.identity_key(cls, user_id))
+            if counter is not None:
+                session.expire(counter)
+
+    @classmethod
+    def reconcile(cls, session):
+        """
+        Recount unread messages for every user and fix counters that drifted.
+        Counts and counters are read in one transaction (one snapshot), the 
+        differences are added with adjust() so changes committed meanwhile 
+        are not overwritten. Returns the number of counters that were corrected.
+        """
+        table = cls.__table__
+        actual = dict(session.execute(
+            select(UserMessageAssociation.user_id, func.count())
+            .where(UserMessageAssociation.message_read == None,
+                   UserMessageAssociation.message_deleted == None)
+            .group_by(UserMessageAssociation.user_id)).all())
+        stored = dict(session.execute(select(table.c.user_id, table.c.unread_count)).all())
+
+        fixes = {user_id: actual.get(user_id, 0) - stored.get(user_id, 0) for user_id in stored.keys() | actual.keys()}
+        fixes = {user_id: delta for user_id, delta in fixes.items() if delta}
+        cls.adjust(session, fixes)
+        session.commit()
+        return len(fixes)
+
+
+class UserChange(db.Model):
+    """
+    Short-lived change log of per-user events (unread count changed, 
+    enrollment status changed) read by the server-sent events feed 
+    (bcource/user/change_feed.py). Rows are pruned after BCOURSE_CHANGE_LOG_TTL seconds.
+    """
+    __tablename__ = "user_change"
+    __table_args__ = (db.Index("ix_user_change_created_date", "created_date"),)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    kind: Mapped[str] = mapped_column(String(32), nullable=False)
+    ref_id: Mapped[int] = mapped_column(Integer(), nullable=True)
+    value: Mapped[str] = mapped_column(String(64), nullable=True)
+    created_date: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self.id} user_id={self.user_id} {self.kind}>'
+
+    @classmethod
+    def log(cls, session, kind, changes):
+        """Append changes, a list of (user_id, ref_id, value), with one INSERT."""
+        if changes:
+            session.execute(cls.__table__.insert(), [dict(user_id=user_id, kind=kind, ref_id=ref_id, value=value)
+                                                     for user_id, ref_id, value in changes])
+
+    @classmethod
+    def log_enrollments(cls, session, enrollments):
+        """Log the status of enrollments, a list of (student_id, training_id, status)."""
+        if not enrollments:
+            return
+        student_ids = {student_id for student_id, _, _ in enrollments if student_id != None}
+        if not student_ids:
+            return
+        users = dict(session.execute(select(Student.id, Student.user_id).where(
+            Student.id.in_(student_ids))).all())
+        cls.log(session, 'enrollment', [(users[student_id], training_id, status)
+                                        for student_id, training_id, status in enrollments
+                                        if users.get(student_id) != None])
+
+
+class EntityChange(db.Model):
+    """
+    Append-only log of created, updated and deleted trainings, training
+    events and enrollments, read by the admin API change feed
+    (/admin-api/changes). Logged by _entity_change_after_flush(); code
+    that changes these tables with Core statements logs with
+    EntityChange.log(). The rows are kept in session.info until the
+    transaction commits, so a rolled back transaction or savepoint takes
+    no ids. The id is the feed's cursor.
+    """
+    __tablename__ = "entity_change"
+    __table_args__ = (db.Index("ix_entity_change_practice_id", "practice_id", "id"),)
+
+    ENTITIES = {'Training': 'training', 'TrainingEvent': 'event', 'TrainingEnroll': 'enrollment'}
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    practice_id: Mapped[int] = mapped_column(Integer(), nullable=True)
+    entity: Mapped[str] = mapped_column(String(16), nullable=False)
+    op: Mapped[str] = mapped_column(String(8), nullable=False)
+    training_id: Mapped[int] = mapped_column(Integer(), nullable=True)
+    # TrainingEvent.id of an event, TrainingEnroll.student_id of an enrollment
+    ref_id: Mapped[int] = mapped_column(Integer(), nullable=True)
+    created_date: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self.id} {self.entity} {self.op} training_id={self.training_id} ref_id={self.ref_id}>'
+
+    @classmethod
+    def log(cls, session, changes, practices=None):
+        """
+        Log changes, a list of (entity, op, training_id, ref_id), in the
+        current transaction or savepoint. They are inserted with one INSERT
+        when the transaction commits and dropped when the transaction or
+        savepoint rolls back. practices ({training_id: practice_id}) saves
+        the lookup of the trainings' practices.
+        """
+        if not changes:
+            return
+        practices = dict(practices or {})
+        missing = {training_id for _, _, training_id, _ in changes
+                   if training_id != None and training_id not in practices}
+        if missing:
+            practices.update(session.execute(select(Training.id, Training.practice_id).where(
+                Training.id.in_(missing))).all())
+        if isinstance(session, orm.scoped_session):
+            session = session()
+        transaction = session.get_nested_transaction() or session.get_transaction()
+        session.info.setdefault('entity_changes', []).extend(
+            (transaction, dict(practice_id=practices.get(training_id), entity=entity, op=op,
+                               training_id=training_id, ref_id=ref_id))
+            for entity, op, training_id, ref_id in changes)
+
+
+def _entity_change_key(obj):
+    if isinstance(obj, Training):
+        return obj.id, None
+    if isinstance(obj, TrainingEvent):
+        return obj.training_id, obj.id
+    return obj.training_id, obj.student_id
+
+
+@event.listens_for(orm.Session, "after_flush")
+def _entity_change_after_flush(session, flush_context):
+    """Log the trainings, events and enrollments this flush created, updated or deleted."""
+    changes = []
+    practices = {}
+    for objects, op in ((session.new, 'created'), (session.dirty, 'updated'), (session.deleted, 'deleted')):
+        for obj in objects:
+            entity = EntityChange.ENTITIES.get(type(obj).__name__)
+            if entity is None:
+                continue
+            if op == 'updated' and not session.is_modified(obj, include_collections=False):
+                continue
+            if isinstance(obj, Training):
+                practices[obj.id] = obj.practice_id
+            changes.append((entity, op, *_entity_change_key(obj)))
+
+    EntityChange.log(session, changes, practices)
+
+
+def _within_transaction(transaction, ancestor):
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+@event.listens_for(orm.Session, "after_soft_rollback")
+def _entity_change_after_soft_rollback(session, previous_transaction):
+    """Drop the changes logged in the rolled back transaction or savepoint."""
+    pending = session.info.get('entity_changes')
+    if pending:
+        session.info['entity_changes'] = [(transaction, row) for transaction, row in pending
+                                          if not _within_transaction(transaction, previous_transaction)]
+
+
+@event.listens_for(orm.Session, "before_commit")
+def _entity_change_before_commit(session):
+    """Insert the changes logged in the transaction that commits."""
+    if session.get_nested_transaction() is not None:
+        # a released savepoint, its changes wait for the transaction
+        return
+    # the last flush runs after this hook, log its changes now
+    session.flush()
+    pending = session.info.pop('entity_changes', None)
+    if pending:
+        session.execute(EntityChange.__table__.insert(), [row for _, row in pending])
+
+
+@event.listens_for(orm.Session, "after_transaction_end")
+def _entity_change_after_transaction_end(session, transaction):
+    """A transaction closed without commit (session.close()) leaves nothing behind."""
+    if transaction.parent is None:
+        session.info.pop('entity_changes', None)
+
+
+@event.listens_for(orm.Session, "before_flush")
+def _message_counter_before_flush(session, flush_context, instances):
+    """Keep UserMessageCounter in step with user_message rows changed through the ORM."""
+    deltas = {}
+
+    for obj in session.new:
+        if isinstance(obj, UserMessageAssociation) and obj.unread:
+            deltas[obj.user_id] = deltas.get(obj.user_id, 0) + 1
+
+    for obj in session.dirty:
+        if isinstance(obj, UserMessageAssociation):
+            was = []
+            for attr in ('message_read', 'message_deleted'):
+                history = orm.attributes.get_history(obj, attr)
+                was.append(history.deleted[0] if history.deleted else 
+                           history.unchanged[0] if history.unchanged else None)
+            was_unread = was[0] == None and was[1] == None
+            if was_unread != obj.unread:
+                deltas[obj.user_id] = deltas.get(obj.user_id, 0) + (1 if obj.unread else -1)
+
+    for obj in session.deleted:
+        if isinstance(obj, UserMessageAssociation) and obj.unread:
+            deltas[obj.user_id] = deltas.get(obj.user_id, 0) - 1
+
+    UserMessageCounter.adjust(session, deltas)
+
+
+@event.listens_for(orm.Session, "before_flush")
+def _enrollment_change_before_flush(session, flush_context, instances):
+    """Log enrollment status changes for the server-sent events feed."""
+    changes = []
+    for obj in session.new | session.dirty:
+        if isinstance(obj, TrainingEnroll) and orm.attributes.get_history(obj, 'status').has_changes():
+            changes.append((_student_id(obj), _training_id(obj), obj.status))
+
+    for obj in session.deleted:
+        if isinstance(obj, TrainingEnroll):
+            changes.append((_student_id(obj), _training_id(obj), None))
+
+    UserChange.log_enrollments(session, changes)
+
+
 message_tag_association = Table(
     "message_tag_message",
     db.Model.metadata,
@@ -640,6 +1066,9 @@ class MessageTag(db.Model):
     )
     hidden: Mapped[bool] = mapped_column(Boolean(), default=False)
 
+    # messages with this tag are archived and purged after this many days, see message_retention.py
+    retention_days: Mapped[int] = mapped_column(Integer(), nullable=True)
+
     created_date: Mapped[datetime.datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now()
     )
@@ -659,11 +1088,115 @@ class MessageTag(db.Model):
             db.session.add(tag)
             db.session.commit()
         return (tag)
-    
+
+    # in-process cache of tag name -> id, tags are never renamed or removed
+    _tag_ids = {}
+
+    @classmethod
+    def get_tag_ids(cls, tag_names):
+        """
+        Resolve tag names to ids with the in-process cache. Names that are 
+        not cached are fetched in one query, unknown tags are created.
+        """
+        missing = {name for name in tag_names if name not in cls._tag_ids}
+        if missing:
+            for tag_id, tag_name in db.session.execute(select(cls.id, cls.tag).where(cls.tag.in_(missing))):
+                cls._tag_ids[tag_name] = tag_id
+            for tag_name in missing - cls._tag_ids.keys():
+                cls._tag_ids[tag_name] = cls.get_tag(tag_name).id
+
+        return {name: cls._tag_ids[name] for name in tag_names}
+    
+class MessageBody(db.Model):
+    """
+    Message bodies are stored once per distinct content, keyed by the sha256 
+    of the (sanitized) html. Bodies of at least BCOURSE_MESSAGE_BODY_COMPRESS_MIN 
+    bytes are stored zlib-compressed in data instead of body.
+    """
+    __tablename__ = "message_body"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    hash: Mapped[str] = mapped_column(String(64), nullable=False, unique=True)
+    body: Mapped[str] = mapped_column(Text(), nullable=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary(), nullable=True)
+    compressed: Mapped[bool] = mapped_column(Boolean(), default=False, nullable=False, server_default="0")
+    # the stored html already went through sanitize_html(), display can use it as is
+    sanitized: Mapped[bool] = mapped_column(Boolean(), default=False, nullable=False, server_default="0")
+
+    created_date: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} id={self.id} hash="{self.hash[:12]}" compressed={self.compressed}>'
+
+    @property
+    def text(self):
+        if self.compressed:
+            return zlib.decompress(self.data).decode('utf-8')
+        return self.body
+
+    @staticmethod
+    def content_hash(body):
+        return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+    @property
+    def safe_text(self):
+        if self.sanitized:
+            return self.text
+        return sanitize_html(self.text)
+
+    @classmethod
+    def from_text(cls, body, compress_min=0, sanitized=True):
+        obj = cls(hash=cls.content_hash(body), sanitized=sanitized)
+        encoded = body.encode('utf-8')
+        if compress_min and len(encoded) >= compress_min:
+            obj.data = zlib.compress(encoded)
+            obj.compressed = True
+        else:
+            obj.body = body
+        return obj
+
+    @classmethod
+    def get_ids(cls, db_session, bodies):
+        """
+        Return {body: message_body.id} for the given bodies. Bodies that 
+        are already stored are found by hash in one query, new ones are 
+        inserted without committing.
+        """
+        hashes = {body: cls.content_hash(body) for body in bodies}
+        ids = dict(db_session.execute(select(cls.hash, cls.id).where(cls.hash.in_(set(hashes.values())))).all())
+
+        compress_min = cv('MESSAGE_BODY_COMPRESS_MIN', strict=False, default=0)
+        new = {}
+        for body, content_hash in hashes.items():
+            if content_hash not in ids and content_hash not in new:
+                new[content_hash] = cls.from_text(body, compress_min)
+
+        if new:
+            try:
+                with db_session.begin_nested():
+                    db_session.add_all(new.values())
+            except IntegrityError:
+                # stored by a concurrent writer in the meantime, resolve one by one
+                for content_hash, obj in list(new.items()):
+                    try:
+                        with db_session.begin_nested():
+                            db_session.add(cls.from_text(obj.text, compress_min))
+                    except IntegrityError:
+                        pass
+                    new[content_hash] = db_session.execute(select(cls).where(cls.hash == content_hash)).scalar_one()
+            ids.update({content_hash: obj.id for content_hash, obj in new.items()})
+
+        return {body: ids[content_hash] for body, content_hash in hashes.items()}
+
+
 class Message(db.Model):
     id: Mapped[int] = mapped_column(primary_key=True)
     subject: Mapped[str] = mapped_column(String(256), nullable=False)
-    body: Mapped[str] = mapped_column((Text()), nullable=False)
+
+    # bodies live in message_body and are only loaded when accessed
+    body_id: Mapped[int] = mapped_column(ForeignKey("message_body.id"), nullable=False)
+    message_body: Mapped["MessageBody"] = relationship(lazy="select")
     
     envelop_from_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"))
     envelop_from: Mapped["User"] = relationship(backref=backref("sent_messages", uselist=False, cascade="all, delete"), single_parent=True)
@@ -671,6 +1204,10 @@ class Message(db.Model):
     
     in_reply_to_id: Mapped[int] = mapped_column(ForeignKey("message.id"), nullable=True)
     in_reply_to: Mapped["Message"] = relationship(single_parent=True)
+
+    # id of the first message of the conversation, NULL for that first message itself.
+    # Set from in_reply_to by create_db_messages(), a thread is one indexed lookup (see thread()).
+    thread_root_id: Mapped[int] = mapped_column(Integer(), nullable=True, index=True)
     
     created_date: Mapped[datetime.datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now()
@@ -683,6 +1220,34 @@ class Message(db.Model):
     def __repr__(self) -> str:
         return f'<{self.__class__.__name__} id={self.id} subject="{self.shorten(self.subject)}">'
 
+    @property
+    def body(self):
+        return self.message_body.text
+
+    @property
+    def thread_id(self):
+        return self.thread_root_id or self.id
+
+    @classmethod
+    def thread(cls, thread_id, user):
+        """
+        Select of (Message, UserMessageAssociation) for the messages in thread 
+        thread_id that user sent or received, oldest first. The association 
+        is None for messages the user only sent. The sender is loaded in the 
+        same query, bodies are not loaded.
+        """
+        return (select(cls, UserMessageAssociation)
+                .outerjoin(UserMessageAssociation, and_(UserMessageAssociation.message_id == cls.id,
+                                                        UserMessageAssociation.user_id == user.id))
+                .where(or_(cls.id == thread_id, cls.thread_root_id == thread_id),
+                       or_(cls.envelop_from_id == user.id, UserMessageAssociation.user_id != None))
+                .options(orm.joinedload(cls.envelop_from))
+                .order_by(cls.created_date, cls.id))
+
+    @property
+    def safe_body(self):
+        return self.message_body.safe_text
+
     @staticmethod
     def shorten(data, text_length=30):
         return (data[:text_length] + '..') if len(data) > text_length else data
@@ -690,31 +1255,203 @@ class Message(db.Model):
 
     @classmethod
     def create_db_message(cls, db_session, envelop_from, envelop_to, subject, body, in_reply_to=None, tags=[]):
-        tagobjs = []
-        for tag in tags:
-            tagobjs.append(MessageTag.get_tag(tag))
-            
-        
-        message = cls(envelop_from_id=envelop_from.id,
-                      subject=subject, 
-                      body=nh3.clean(body))
-        # body=body)
-        
-        if in_reply_to:
-            message.in_reply_to = in_reply_to
-        
-        for user in envelop_to:
-            association = UserMessageAssociation()
-            association.user = user
-            message.envelop_to.append(association)
+        return cls.create_db_messages(db_session, [dict(envelop_from=envelop_from,
+                                                        envelop_to=envelop_to,
+                                                        subject=subject,
+                                                        body=body,
+                                                        in_reply_to=in_reply_to,
+                                                        tags=tags)])[0]
+
+    @classmethod
+    def create_db_messages(cls, db_session, messages):
+        """
+        Store many messages with a single commit. Each item of messages is a 
+        dict with the create_db_message() arguments. Recipient and tag rows 
+        are written with one executemany INSERT each.
+        """
+        tag_ids = MessageTag.get_tag_ids({tag for m in messages for tag in m.get('tags') or []})
+
+        bodies = [sanitize_html(m['body']) for m in messages]
+        body_ids = MessageBody.get_ids(db_session, bodies)
+
+        objs = []
+        for m, body in zip(messages, bodies):
+            message = cls(envelop_from_id=m['envelop_from'].id,
+                          subject=m['subject'], 
+                          body_id=body_ids[body])
+            if m.get('in_reply_to'):
+                message.in_reply_to = m['in_reply_to']
+                message.thread_root_id = m['in_reply_to'].thread_id
+            objs.append(message)
+
+        db_session.add_all(objs)
+        db_session.flush()
+
+        recipients = []
+        message_tags = []
+        for message, m in zip(objs, messages):
+            for user_id in dict.fromkeys([user.id for user in m['envelop_to']]):
+                recipients.append({'user_id': user_id, 'message_id': message.id})
+            for tag in dict.fromkeys(m.get('tags') or []):
+                message_tags.append({'messagetag_id': tag_ids[tag], 'message_id': message.id})
+
+        if recipients:
+            db_session.execute(UserMessageAssociation.__table__.insert(), recipients)
+            deltas = {}
+            for recipient in recipients:
+                deltas[recipient['user_id']] = deltas.get(recipient['user_id'], 0) + 1
+            UserMessageCounter.adjust(db_session, deltas)
+        if message_tags:
+            db_session.execute(message_tag_association.insert(), message_tags)
+
+        MessageSearchToken.index(db_session, [(message.id, message.subject, body) for message, body in zip(objs, bodies)])
 
-        for tag in tagobjs:
-            message.tags.append(tag)
-            
-        db_session.add(message)
         db_session.commit()
-        return(message)
-        
+        return(objs)
+
+
+class MessageSearchToken(db.Model):
+    """
+    Inverted index of message subjects and bodies (token -> message), 
+    written by Message.create_db_messages(). Tokens come from 
+    helpers.search_tokens(), weight is the number of occurrences with 
+    subject occurrences counting SUBJECT_WEIGHT times.
+
+    search() uses a MySQL FULLTEXT index instead when BCOURSE_MESSAGE_SEARCH_FULLTEXT
+    is set and the database is MySQL.
+    """
+    __tablename__ = "message_search_token"
+    __table_args__ = (db.Index("ix_message_search_token_message_id", "message_id"),)
+
+    SUBJECT_WEIGHT = 3
+
+    token: Mapped[str] = mapped_column(String(64), primary_key=True)
+    message_id: Mapped[int] = mapped_column(ForeignKey("message.id", ondelete="CASCADE"), primary_key=True)
+    weight: Mapped[int] = mapped_column(Integer(), default=1, nullable=False)
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} "{self.token}" message_id={self.message_id} weight={self.weight}>'
+
+    @classmethod
+    def index(cls, db_session, messages):
+        """Index messages, a list of (message_id, subject, html body), with one INSERT."""
+        rows = []
+        for message_id, subject, body in messages:
+            weights = dict(search_tokens(body, is_html=True))
+            for token, n in search_tokens(subject).items():
+                weights[token] = weights.get(token, 0) + n * cls.SUBJECT_WEIGHT
+            rows.extend({'token': token, 'message_id': message_id, 'weight': weight} 
+                        for token, weight in weights.items())
+        if rows:
+            db_session.execute(cls.__table__.insert(), rows)
+
+    @staticmethod
+    def fulltext():
+        """
+        MATCH on the FULLTEXT indexes, MySQL only. Compressed bodies are NULL 
+        in message_body.body, with BCOURSE_MESSAGE_BODY_COMPRESS_MIN set the 
+        token index is used.
+        """
+        return cv('MESSAGE_SEARCH_FULLTEXT', strict=False, default=False) and db.engine.dialect.name == 'mysql' \
+            and not cv('MESSAGE_BODY_COMPRESS_MIN', strict=False, default=0)
+
+    @classmethod
+    def search(cls, user_q):
+        """
+        Subquery (message_id, rank) of the messages matching every search 
+        term of user_q, higher rank first is the best match.
+        """
+        if cls.fulltext():
+            from sqlalchemy.dialects.mysql import match
+            subject = match(Message.subject, against=user_q).in_natural_language_mode()
+            body = match(MessageBody.body, against=user_q).in_natural_language_mode()
+            return (select(Message.id.label('message_id'), (subject * cls.SUBJECT_WEIGHT + body).label('rank'))
+                    .join(MessageBody, MessageBody.id == Message.body_id)
+                    .where(or_(subject > 0, body > 0))).subquery()
+
+        tokens = list(search_tokens(user_q))
+        if not tokens:
+            # only stop words or punctuation, match the subject as typed
+            return (select(Message.id.label('message_id'), literal(0).label('rank'))
+                    .where(Message.subject.like(f"%{user_q}%"))).subquery()
+
+        return (select(cls.message_id, func.sum(cls.weight).label('rank'))
+                .where(cls.token.in_(tokens))
+                .group_by(cls.message_id)
+                .having(func.count() == len(tokens))).subquery()
+
+
+class TrainerNotification(db.Model):
+    """
+    Trainer notification queued for the digest. Rows with sent_date NULL are
+    pending, TrainerDigestTask collapses them per trainer into one message
+    and sets sent_date.
+    """
+    __tablename__ = "trainer_notification"
+    __table_args__ = (db.Index("ix_trainer_notification_pending", "sent_date", "user_id"),)
+
+    # digest delay per cadence, "immediate" skips the queue
+    CADENCES = {'hourly': timedelta(hours=1), 'daily': timedelta(days=1)}
+    DIGEST_TASK = "TrainerDigestTask"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    user: Mapped["User"] = relationship()
+    training_id: Mapped[int] = mapped_column(ForeignKey("training.id", ondelete="SET NULL"), nullable=True)
+    training: Mapped["Training"] = relationship()
+
+    subject: Mapped[str] = mapped_column(String(256), nullable=False)
+    body: Mapped[str] = mapped_column(Text(), nullable=False)
+    tags: Mapped[str] = mapped_column(String(256), default="", nullable=False)
+    # the notification would have been e-mailed, the digest is e-mailed too
+    email: Mapped[bool] = mapped_column(Boolean(), default=False, nullable=False, server_default="0")
+
+    created_date: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+    sent_date: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    # digest deliveries tried, pending rows are given up after BCOURSE_TRAINER_DIGEST_MAX_ATTEMPTS
+    attempts: Mapped[int] = mapped_column(Integer(), default=0, nullable=False, server_default="0")
+    attempt_date: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} id={self.id} user_id={self.user_id} subject="{Message.shorten(self.subject)}">'
+
+    @staticmethod
+    def cadence(user):
+        settings = getattr(user, 'usersettings', None)
+        cadence = settings.notification_cadence if settings and settings.notification_cadence else cv('TRAINER_NOTIFICATION_CADENCE')
+        return cadence if cadence in TrainerNotification.CADENCES else 'immediate'
+
+    @classmethod
+    def digest_active(cls):
+        """Notifications are only queued while an active digest schedule exists."""
+        return db.session.query(AutomationSchedule.id).join(AutomationClasses).filter(
+            AutomationSchedule.active == True,
+            AutomationClasses.class_name == cls.DIGEST_TASK).first() is not None
+
+    @classmethod
+    def _pending(cls):
+        return and_(cls.sent_date == None, cls.attempts < cv('TRAINER_DIGEST_MAX_ATTEMPTS'))
+
+    @classmethod
+    def pending(cls, user_id):
+        return cls.query.filter(cls.user_id == user_id, cls._pending()).order_by(cls.id).all()
+
+    @classmethod
+    def due(cls):
+        """
+        (user_id, first pending created_date, cadence, attempts, last attempt_date)
+        of every trainer with pending notifications.
+        """
+        return db.session.execute(
+            select(cls.user_id, func.min(cls.created_date), UserSettings.notification_cadence,
+                   func.max(cls.attempts), func.max(cls.attempt_date))
+            .outerjoin(UserSettings, UserSettings.user_id == cls.user_id)
+            .where(cls._pending())
+            .group_by(cls.user_id, UserSettings.notification_cadence)).all()
+
+
 class User(db.Model, sqla.FsUserMixin):
 
     phone_number: Mapped[str] = mapped_column(String(32), unique=True, nullable=True)
@@ -731,8 +1468,11 @@ class User(db.Model, sqla.FsUserMixin):
     state: Mapped[str] = mapped_column(String(256), nullable=True)
     country: Mapped[str] = mapped_column(String(256), nullable=True)
     birthday: Mapped[datetime.datetime] = mapped_column(Date(), nullable=True)
+    # folded words of first name, last name and email, maintained by _user_search_before_flush()
+    search_key: Mapped[str] = mapped_column(String(255), nullable=True, index=True)
     
     messages: Mapped[List["UserMessageAssociation"]] = relationship(back_populates="user", cascade="all, delete-orphan")
+    search_tokens: Mapped[List["UserSearchToken"]] = relationship(cascade="all, delete-orphan")
 
     @property
     def name(self):
@@ -791,9 +1531,9 @@ class User(db.Model, sqla.FsUserMixin):
 
     @property
     def unread_messages(self):
-        return len(UserMessageAssociation().query.join(User).filter(and_(UserMessageAssociation.user_id==self.id,
-                                                                                    UserMessageAssociation.message_read==None,
-                                                                                    UserMessageAssociation.message_deleted==None)).all())
+        # maintained counter, a primary key read instead of counting user_message rows
+        counter = db.session.get(UserMessageCounter, self.id)
+        return counter.unread_count if counter else 0
     def accessible_by_permission(self, permission):        
         if self.has_role(current_app.config['BCOURSE_SUPER_USER_ROLE']):
             return (True)
@@ -814,6 +1554,73 @@ class User(db.Model, sqla.FsUserMixin):
     def __repr__(self)->str:
         return f'<{self.__class__.__name__} id = {self.id} email="{self.email}">'
 
+
+class UserSearchToken(db.Model):
+    """
+    Words of the name and email of a user (token -> user) for the typeahead 
+    lookups, maintained together with User.search_key by 
+    _user_search_before_flush(). A typed term matches the tokens it is a 
+    prefix of, a range scan of the primary key.
+    """
+    __tablename__ = "user_search_token"
+    __table_args__ = (db.Index("ix_user_search_token_user_id", "user_id"),)
+
+    MAX_TERMS = 4
+
+    token: Mapped[str] = mapped_column(String(64), primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"), primary_key=True)
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} "{self.token}" user_id={self.user_id}>'
+
+    @classmethod
+    def match(cls, user_q):
+        """
+        (clause, rank) to filter and order a query on User by user_q: every 
+        term must start a word of the name or email. Rank 0 are exact word 
+        matches, 1 keys starting with the terms (the first name), 2 matches 
+        further on. (None, None) when user_q has no terms.
+        """
+        terms = name_search_terms(user_q)[:cls.MAX_TERMS]
+        if not terms:
+            return None, None
+
+        clause = and_(*[User.id.in_(select(cls.user_id).where(cls.token.like(f"{term}%"))) for term in terms])
+        exact = and_(*[User.id.in_(select(cls.user_id).where(cls.token == term)) for term in terms])
+        rank = case((exact, 0), (User.search_key.like(f"{' '.join(terms)}%"), 1), else_=2)
+        return clause, rank
+
+
+# typeahead results of user_views.search and students_views.search
+user_search_cache = TTLCache(maxsize=256)
+
+
+@event.listens_for(orm.Session, "before_flush")
+def _user_search_before_flush(session, flush_context, instances):
+    """Keep User.search_key and its UserSearchToken rows in step with the name and email."""
+    changed = False
+    for obj in session.new | session.dirty:
+        if isinstance(obj, User):
+            if obj in session.new or any(orm.attributes.get_history(obj, attr).has_changes()
+                                         for attr in ('first_name', 'last_name', 'email')):
+                terms = name_search_terms(obj.first_name, obj.last_name, obj.email)
+                obj.search_key = " ".join(terms)[:255] or None
+                with session.no_autoflush:
+                    current = {row.token: row for row in obj.search_tokens}
+                for token in current.keys() - set(terms):
+                    obj.search_tokens.remove(current[token])
+                for token in set(terms) - current.keys():
+                    obj.search_tokens.append(UserSearchToken(token=token))
+                changed = True
+            elif orm.attributes.get_history(obj, 'roles').has_changes():
+                changed = True
+        elif isinstance(obj, Student) and obj in session.new:
+            changed = True
+
+    if changed or any(isinstance(obj, (User, Student)) for obj in session.deleted):
+        user_search_cache.clear()
+
+
 permission_role = Table(
     "permission_role",
     db.Model.metadata,
@@ -955,6 +1762,14 @@ class Content(db.Model):
         return ""
 
 
+    @classmethod
+    def render(cls, tag, lang=None, **kwargs):
+        """Return (body, subject) of a tag for one language with a single lookup."""
+        content = cls.get_subject(tag, obj=True, lang=lang)
+        body = render_template_string(content.text, **kwargs) if content.text else ""
+        subject = render_template_string(content.subject, **kwargs) if content.subject else ""
+        return body, subject
+
     def update(self):
         db.session.commit()
 
@@ -1007,6 +1822,17 @@ class UserSettings(db.Model):
     emergency_contact: Mapped[str] = mapped_column(Text(), nullable=True)
     language: Mapped[str] = mapped_column(String(8), default="en", nullable=False, server_default="en")
 
+    # trainer notifications: "immediate", "hourly" or "daily" digest, NULL follows BCOURSE_TRAINER_NOTIFICATION_CADENCE
+    notification_cadence: Mapped[str] = mapped_column(String(16), nullable=True)
+
+    # secret for the personal calendar feed url, created on first use
+    calendar_token: Mapped[str] = mapped_column(String(64), nullable=True, unique=True)
+
+    def get_calendar_token(self, reset=False):
+        if reset or not self.calendar_token:
+            self.calendar_token = secrets.token_urlsafe(32)
+        return self.calendar_token
+
     update_datetime: Mapped[datetime.datetime] = mapped_column(
         server_default=func.now(),
         onupdate=func.now(),
@@ -1079,6 +1905,80 @@ class AutomationSchedule(db.Model):
     )
 
 
+def _training_id(enrollment):
+    if enrollment.training_id == None and enrollment.training != None:
+        return enrollment.training.id
+    return enrollment.training_id
+
+
+def _student_id(enrollment):
+    if enrollment.student_id == None and enrollment.student != None:
+        return enrollment.student.id
+    return enrollment.student_id
+
+
+@event.listens_for(orm.Session, "before_flush")
+def _waitlist_before_flush(session, flush_context, instances):
+    """
+    Keep the waitlist queue of TrainingEnroll compact: enrollments that join
+    the waitlist are appended to the tail, enrollments that leave it (status
+    change or delete) close the gap by shifting the entries behind them. 
+    Also keeps TrainingEnroll.waitlist_opt_out in sync with UserSettings.
+    """
+    joined = {}
+    left = {}
+
+    for obj in session.new:
+        if isinstance(obj, TrainingEnroll):
+            if obj.student != None and obj.student.user != None and obj.student.user.usersettings != None:
+                obj.waitlist_opt_out = not obj.student.user.usersettings.msg_transactional_emails
+            if obj.status == 'waitlist':
+                joined.setdefault(_training_id(obj), []).append(obj)
+
+    for obj in session.new | session.dirty:
+        if isinstance(obj, UserSettings):
+            history = orm.attributes.get_history(obj, 'msg_transactional_emails')
+            user_id = obj.user.id if obj.user_id == None and obj.user != None else obj.user_id
+            if history.has_changes() and user_id != None:
+                session.execute(update(TrainingEnroll).where(
+                    TrainingEnroll.student_id.in_(select(Student.id).where(Student.user_id==user_id))
+                    ).values(waitlist_opt_out=obj.msg_transactional_emails == False
+                    ).execution_options(synchronize_session=False))
+
+    for obj in session.dirty:
+        if isinstance(obj, TrainingEnroll):
+            history = orm.attributes.get_history(obj, 'status')
+            if not history.has_changes():
+                continue
+            old_status = history.deleted[0] if history.deleted else None
+            if old_status == 'waitlist' and obj.status != 'waitlist':
+                left.setdefault(_training_id(obj), []).append(obj)
+            elif old_status != 'waitlist' and obj.status == 'waitlist':
+                joined.setdefault(_training_id(obj), []).append(obj)
+
+
+    for obj in session.deleted:
+        if isinstance(obj, TrainingEnroll) and obj.status == 'waitlist':
+            left.setdefault(obj.training_id, []).append(obj)
+
+    for training_id, enrollments in left.items():
+        TrainingEnroll.compact_waitlist(session, training_id, 
+                                        [e.waitlist_position for e in enrollments], skip=enrollments)
+        for enrollment in enrollments:
+            if enrollment not in session.deleted:
+                enrollment.waitlist_position = None
+
+    for training_id, enrollments in joined.items():
+        leaving = [e.student_id for e in left.get(training_id, []) if e.student_id != None]
+        tail = session.execute(select(func.max(TrainingEnroll.waitlist_position)).where(
+                    TrainingEnroll.training_id==training_id,
+                    TrainingEnroll.status=='waitlist',
+                    TrainingEnroll.student_id.not_in(leaving))).scalar() or 0
+        for enrollment in enrollments:
+            tail += 1
+            enrollment.waitlist_position = tail
+
+
 def role_student_default():
     return Practice().query.filter(Practice.name==cv('BCOURSE_DEFAULT_STUDENT_ROLE')).first()
 
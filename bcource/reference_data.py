@@ -0,0 +1,139 @@
+"""
+Per-process cache of the reference data of a practice: training types,
+locations, policies, student statuses and types, and the policy names of
+each training type.
+
+The data is cached as read only snapshots (column values only, no session,
+no relationships) next to the ReferenceVersion stamp it was loaded at.
+Every flush that changes reference data bumps the stamp (see
+models._reference_version_before_flush), so edits through Flask-Admin or
+the admin API show up in all processes. Checking the stamp is one primary
+key query, done once per request per practice.
+
+The snapshots are for reading: forms that assign one of these entities to
+a relationship (QuerySelectField) keep using queried instances.
+"""
+from bcource import db
+from bcource.helpers import config_value as cv
+from bcource.models import (Practice, ReferenceVersion, TrainingType, Location, Policy, StudentStatus, StudentType,
+                            policy_association)
+from flask import g, session, has_request_context
+from sqlalchemy import select, func, inspect
+import threading
+
+
+class Snapshot(object):
+    """Read only copy of the column values of a model instance."""
+
+    __slots__ = ('_model', '_values')
+
+    def __init__(self, obj):
+        object.__setattr__(self, '_model', type(obj))
+        object.__setattr__(self, '_values', {attr.key: getattr(obj, attr.key)
+                                             for attr in inspect(obj).mapper.column_attrs})
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(f'{self._model.__name__} snapshot has no attribute {name!r}') from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{self._model.__name__} snapshot is read only')
+
+    def __eq__(self, other):
+        return isinstance(other, Snapshot) and (self._model, self.id) == (other._model, other.id)
+
+    def __hash__(self):
+        return hash((self._model, self.id))
+
+    def __str__(self):
+        return self._model.__str__(self)
+
+    def __repr__(self):
+        return self._model.__repr__(self)
+
+
+class ReferenceData(object):
+    """The reference data of one practice at one version, see reference_data()."""
+
+    def __init__(self, practice_id, version):
+        self.practice_id = practice_id
+        self.version = version
+
+        def snapshots(model):
+            return tuple(Snapshot(obj) for obj in db.session.scalars(
+                select(model).where(model.practice_id == practice_id).order_by(model.name, model.id)))
+
+        self.trainingtypes = snapshots(TrainingType)
+        self.locations = snapshots(Location)
+        self.policies = snapshots(Policy)
+        self.studentstatuses = snapshots(StudentStatus)
+        self.studenttypes = snapshots(StudentType)
+
+        policy_names = {}
+        for trainingtype_id, name in db.session.execute(
+                select(policy_association.c.trainingtype_id, Policy.name)
+                .join(Policy, Policy.id == policy_association.c.policy_id)
+                .join(TrainingType, TrainingType.id == policy_association.c.trainingtype_id)
+                .where(TrainingType.practice_id == practice_id)):
+            policy_names.setdefault(trainingtype_id, set()).add(name)
+        self._policy_names = {key: frozenset(names) for key, names in policy_names.items()}
+
+    def policy_names(self, trainingtype_id):
+        """Names of the policies of a training type (the cached trainingtype.policies)."""
+        return self._policy_names.get(trainingtype_id, frozenset())
+
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def _current_version(practice):
+    """(practice id, version) of practice: a Practice id, a shortname or None for the current practice."""
+    if practice is None and session and session.get('practice'):
+        try:
+            practice = int(session.get('practice'))
+        except (TypeError, ValueError):
+            pass
+    if practice is None:
+        practice = cv('DEFAULT_PRACTICE_SHORTNAME')
+
+    q = select(Practice.id, func.coalesce(ReferenceVersion.version, 0)).outerjoin(
+        ReferenceVersion, ReferenceVersion.practice_id == Practice.id)
+    if isinstance(practice, int):
+        q = q.where(Practice.id == practice)
+    else:
+        q = q.where(Practice.shortname == practice)
+    row = db.session.execute(q.limit(1)).first()
+    return tuple(row) if row else (None, 0)
+
+
+def reference_version(practice=None):
+    """
+    (practice id, version) of practice, read once per request. The practice
+    id is None when the practice does not exist.
+    """
+    if not has_request_context():
+        return _current_version(practice)
+    versions = g.setdefault('reference_versions', {})
+    if practice not in versions:
+        versions[practice] = _current_version(practice)
+    return versions[practice]
+
+
+def reference_data(practice=None):
+    """
+    ReferenceData of practice: a Practice id, a shortname or None for the
+    practice of the session (as Practice.current()). Loaded when the
+    practice's ReferenceVersion changed since the cached copy.
+    """
+    practice_id, version = reference_version(practice)
+    with _lock:
+        data = _cache.get(practice_id)
+    if data is None or data.version != version:
+        data = ReferenceData(practice_id, version)
+        if practice_id is not None:
+            with _lock:
+                _cache[practice_id] = data
+    return data
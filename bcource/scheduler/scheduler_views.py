@@ -7,15 +7,16 @@ from flask_security import current_user, auth_required
 from bcource.scheduler.scheduler_forms import SchedulerTrainingEnrollForm
 from bcource.training.training_forms import TrainingDerollForm
 from bcource import menu_structure, db
-from bcource.helpers import admin_has_role, get_url, safe_redirect
+from bcource.helpers import admin_has_role, get_url, safe_redirect, config_value as cv
 from bcource.models import User, Student, Practice, Training, TrainingType, TrainingEvent, TrainingEnroll, Content
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, select, func
 from sqlalchemy.orm import joinedload
 import bcource.messages as system_msg
 from bcource.students.common import deroll_common, enroll_common, enroll_from_waitlist, invite_from_waitlist
 from datetime import datetime
 import pytz
-from bcource.filters import Filters
+from bcource.filters import Filters, cached_facets
+from bcource.reference_data import reference_data
 from bcource.user.user_status import UserProfileChecks
 from bcource.students.student_policies import TrainingBookingPolicy, can_student_book_trainings, CancelationPolicy
 from bcource.helper_app_context import b_pagination
@@ -48,26 +49,94 @@ def has_student_role():
 scheduler_bp.before_request(has_student_role)
 
 
+def _training_facet_rows(shortname, user=None):
+    """
+    (trainingtype_id, name, has_past, has_future, count) of the active 
+    trainings of a practice, grouped; only the trainings user is enrolled in 
+    when given, like the "my" filter of training_query().
+    """
+    time_now = datetime.now(tz=pytz.timezone('UTC'))
+    events = select(TrainingEvent.training_id,
+                    (func.min(TrainingEvent.start_time) < time_now).label('has_past'),
+                    (func.max(TrainingEvent.start_time) > time_now).label('has_future')
+                    ).group_by(TrainingEvent.training_id).subquery()
+
+    q = (select(TrainingType.id, TrainingType.name, events.c.has_past, events.c.has_future, func.count())
+         .select_from(Training).join(TrainingType).join(events, events.c.training_id == Training.id)
+         .join(Practice, Practice.id == Training.practice_id)
+         .where(Practice.shortname == shortname, Training.active == True))
+    if user:
+        q = q.where(Training.id.in_(select(TrainingEnroll.training_id).join(Student)
+                                    .where(Student.user_id == user.id)))
+    return db.session.execute(q.group_by(TrainingType.id, TrainingType.name, events.c.has_past, events.c.has_future))
+
+
+def _period_rows(facet_rows):
+    """(trainingtype_id, period, count) of _training_facet_rows()."""
+    rows = []
+    for trainingtype_id, _name, has_past, has_future, count in facet_rows:
+        # a training that started and has events to come is in both periods, like in training_query()
+        if has_future:
+            rows.append((trainingtype_id, '0', count))
+        if has_past:
+            rows.append((trainingtype_id, '1', count))
+    return rows
+
+
+def training_facets(user=None):
+    """
+    Training types with trainings still to start and the (trainingtype_id, 
+    period, my, count) rows of one grouped query over the active trainings of 
+    the current practice, period '1' past and '0' upcoming. Cached per 
+    practice; with a user the rows are split into the trainings the user is 
+    enrolled in (my is the user id) and the others (my is 0) with one more, 
+    uncached, query.
+    """
+    practice = Practice.current()
+    shortname = practice.shortname if practice else cv('DEFAULT_PRACTICE_SHORTNAME')
+
+    def load(key):
+        facet_rows = _training_facet_rows(shortname).all()
+        training_types = {trainingtype_id: name for trainingtype_id, name, has_past, _has_future, _count
+                          in facet_rows if not has_past}
+        return dict(training_type=sorted(training_types.items(), key=lambda item: item[1]),
+                    rows=_period_rows(facet_rows))
+
+    facets = cached_facets(('trainings', shortname), load)
+
+    mine = {}
+    if user:
+        for trainingtype_id, period, count in _period_rows(_training_facet_rows(shortname, user)):
+            mine[(trainingtype_id, period)] = count
+    rows = []
+    for trainingtype_id, period, count in facets['rows']:
+        # the cached rows may be older than the user's enrollments
+        rows.append((trainingtype_id, period, 0, max(count - mine.get((trainingtype_id, period), 0), 0)))
+    rows.extend((trainingtype_id, period, user.id, count) for (trainingtype_id, period), count in mine.items())
+    return dict(facets, rows=rows)
+
+
 def make_filters(user=None):
 
     filters = Filters("Training Filters")
+    facets = training_facets(user)
+
     past_training_filter = filters.new_filter("period", _("Period"))
     past_training_filter.add_filter_item( 1, _("Past Trainings"))
+    # unchecked the list shows the upcoming trainings
+    past_training_filter.unchecked_value = '0'
     
 
-    time_now = datetime.now(tz=pytz.timezone('UTC'))
     training_type_filter = filters.new_filter("training_type", _("Training Types"))
-    for training_type in TrainingType().query.join(Training).join(TrainingEvent).join(Practice, Practice.id==Training.practice_id).filter(and_(
-                        Practice.shortname==Practice.default_row().shortname,
-                        ~Training.trainingevents.any(TrainingEvent.start_time < time_now)
-                        )).all():
-        training_type_filter.add_filter_item( training_type.id, training_type.name)
+    for id, name in facets['training_type']:
+        training_type_filter.add_filter_item( id, name)
 
     if user:
         user_training_filter = filters.new_filter("my", _("User"))
         user_training_filter.add_filter_item( user.id, user.fullname)
         
 
+    filters.facet_counts(facets['rows'], ('training_type', 'period', 'my'))
     return(filters)
 
             
@@ -161,9 +230,7 @@ def mytraining():
     deroll_form.url.data = get_url(deroll_form, 'scheduler_bp.index')
     
     search_on_id = request.args.get('id')
-    traingingtypes = TrainingType().query.join(Practice).filter(and_(
-                        Practice.shortname==Practice.default_row().shortname)
-                        ).all()
+    traingingtypes = reference_data().trainingtypes
                         
     filters = make_filters(user=current_user).process_filters()
     filters.get_filter("my").get_item(current_user.id).checked = True
@@ -193,9 +260,7 @@ def index():
     deroll_form.url.data = get_url(deroll_form, 'scheduler_bp.index')
     
     search_on_id = request.args.get('id')
-    traingingtypes = TrainingType().query.join(Practice).filter(and_(
-                        Practice.shortname==Practice.default_row().shortname)
-                        ).all()
+    traingingtypes = reference_data().trainingtypes
                         
     filters = make_filters(user=current_user).process_filters()
     trainings_select = training_query(filters, search_on_id=search_on_id, user=current_user)
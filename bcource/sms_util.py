@@ -7,7 +7,7 @@ from botocore.exceptions import ClientError, BotoCoreError
 from flask import current_app
 from flask_security import SmsSenderBaseClass
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import wraps, lru_cache
 
 logger = logging.getLogger(__name__)
 
@@ -249,3 +249,25 @@ class AwsSnsSender(SmsSenderBaseClass):
         success, error = send_sms(to_number, msg)
         if not success:
             raise Exception(f"Failed to send SMS: {error}")
+
+
+@lru_cache(maxsize=4096)
+def validate_phone_number_cached(phone_number, region=None):
+    """
+    validate_phone_number() memoized per process, for bulk validation. A 
+    number without country code is read as a number of region (e.g. "NL").
+
+    Returns:
+        tuple: (is_valid: bool, formatted_number: str or None, error_message: str or None)
+    """
+    phone_number = phone_number.strip()
+    if phone_number.startswith('00'):
+        phone_number = '+' + phone_number[2:]
+    elif region and not phone_number.startswith('+'):
+        import phonenumbers
+        try:
+            phone_number = phonenumbers.format_number(phonenumbers.parse(phone_number, region),
+                                                      phonenumbers.PhoneNumberFormat.E164)
+        except phonenumbers.phonenumberutil.NumberParseException as e:
+            return False, None, str(e)
+    return validate_phone_number(phone_number)
@@ -1,4 +1,5 @@
 from bcource.students.students_views import students_bp
 
 import bcource.students.students_admin
-import bcource.students.student_training_view
\ No newline at end of file
+import bcource.students.student_training_view
+import bcource.students.signals
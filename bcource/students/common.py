@@ -1,8 +1,8 @@
 from flask import flash, redirect, abort
 from datetime  import datetime
 import pytz
-from bcource.models import Training, TrainingEnroll, TrainingEvent, Student, Practice
-from sqlalchemy import and_
+from bcource.models import Training, TrainingEnroll, TrainingEvent, Student, Practice, UserChange, EntityChange
+from sqlalchemy import and_, update
 from bcource import db
 import bcource.messages as system_msg
 from bcource.sms_util import send_sms
@@ -27,7 +27,7 @@ def deinvite_from_waitlist(enrollment: TrainingEnroll):
         body=f"<p>The waitlist invitation for {enrollment.student.user.fullname} has expired for training: {enrollment.training.name}</p>",
         subject=f"Waitlist Invitation Expired - {enrollment.training.name}",
         taglist=['waitlist', 'expired']
-    ).send()
+    ).send_to_trainers(enrollment.training)
 
     db.session.commit()
     
@@ -48,6 +48,23 @@ def invite_from_waitlist(enrollment: TrainingEnroll):
     system_msg.EmailStudentEnrolledInTrainingInvited(envelop_to=enrollment.student.user,
                                                   enrollment=enrollment).send()
 
+    system_msg.notify(_send_invite_sms, enrollment)
+
+    # Notify trainers that a user has been invited from the waitlist
+    system_msg.SystemMessage(
+        envelop_to=enrollment.training.trainer_users,
+        body=f"<p>{enrollment.student.user.fullname} has been invited from the waitlist for training: {enrollment.training.name}</p>",
+        subject=f"Waitlist Invitation Sent - {enrollment.training.name}",
+        taglist=['waitlist', 'invited']
+    ).send_to_trainers(enrollment.training)
+
+    db.session.commit()
+    logger.info(f'invited user: {enrollment.student.user} from training: {enrollment.training}')
+
+    return (True)
+
+
+def _send_invite_sms(enrollment: TrainingEnroll):
     # Send SMS notification if user has a phone number
     if enrollment.student.user.phone_number:
         # Remove unicode characters to avoid SMS length limitations (70 chars for unicode vs 160 for ASCII)
@@ -59,18 +76,65 @@ def invite_from_waitlist(enrollment: TrainingEnroll):
         else:
             logger.error(f'Failed to send SMS to {enrollment.student.user.fullname}: {error}')
 
-    # Notify trainers that a user has been invited from the waitlist
-    system_msg.SystemMessage(
-        envelop_to=enrollment.training.trainer_users,
-        body=f"<p>{enrollment.student.user.fullname} has been invited from the waitlist for training: {enrollment.training.name}</p>",
-        subject=f"Waitlist Invitation Sent - {enrollment.training.name}",
-        taglist=['waitlist', 'invited']
-    ).send()
 
+def invite_from_waitlist_bulk(training: Training):
+    """
+    Invite all eligible students at the head of the waitlist of a training.
+    
+    The invitees are selected with one query and moved to waitlist-invited 
+    with one UPDATE in one transaction. Notifications are sent after the 
+    commit and the trainers receive a single summary message.
+    
+    Returns the list of invited enrollments.
+    """
+    enrollments = []
+    for enrollment in training.waitlist_enrollments_eligeble():
+        # Skip users with transactional emails disabled, as invite_from_waitlist() does
+        user = enrollment.student.user
+        if hasattr(user, 'usersettings') and user.usersettings and not user.usersettings.msg_transactional_emails:
+            logger.info(f'Skipping waitlist invitation for {user} - transactional emails disabled')
+            continue
+        enrollments.append(enrollment)
+    if not enrollments:
+        return []
+
+    positions = [enrollment.waitlist_position for enrollment in enrollments]
+    result = db.session.execute(update(TrainingEnroll).where(
+        TrainingEnroll.training_id == training.id,
+        TrainingEnroll.student_id.in_([enrollment.student_id for enrollment in enrollments]),
+        TrainingEnroll.status == "waitlist"
+        ).values(status="waitlist-invited", invite_date=datetime.utcnow(), waitlist_position=None))
+
+    if result.rowcount != len(enrollments):
+        logger.warning(f'invite_from_waitlist_bulk: {len(enrollments)} selected but {result.rowcount} updated for training: {training}')
+
+    TrainingEnroll.compact_waitlist(db.session, training.id, positions, skip=enrollments)
+    UserChange.log_enrollments(db.session, [(enrollment.student_id, training.id, "waitlist-invited")
+                                            for enrollment in enrollments])
+    EntityChange.log(db.session, [('enrollment', 'updated', training.id, enrollment.student_id)
+                                  for enrollment in enrollments],
+                     practices={training.id: training.practice_id})
     db.session.commit()
-    logger.info(f'invited user: {enrollment.student.user} from training: {enrollment.training}')
 
-    return (True)
+    messages = []
+    for enrollment in enrollments:
+        messages.append(system_msg.EmailStudentEnrolledInTrainingInvited(envelop_to=enrollment.student.user,
+                                                                         enrollment=enrollment))
+
+    system_msg.SystemMessage.send_bulk(messages)
+    for enrollment in enrollments:
+        system_msg.notify(_send_invite_sms, enrollment)
+
+    names = "".join([f"<li>{enrollment.student.user.fullname}</li>" for enrollment in enrollments])
+    system_msg.SystemMessage(
+        envelop_to=training.trainer_users,
+        body=f"<p>{len(enrollments)} student(s) have been invited from the waitlist for training: {training.name}</p><ul>{names}</ul>",
+        subject=f"Waitlist Invitations Sent - {training.name}",
+        taglist=['waitlist', 'invited']
+    ).send_to_trainers(training)
+
+    logger.info(f'invited {len(enrollments)} user(s) from the waitlist of training: {training}')
+    return enrollments
 
 
 def enroll_from_waitlist(enrollment: TrainingEnroll):
@@ -93,7 +157,7 @@ def enroll_from_waitlist(enrollment: TrainingEnroll):
         body=f"<p>{enrollment.student.user.fullname} has accepted the waitlist invitation and is now enrolled in training: {enrollment.training.name}</p>",
         subject=f"Waitlist Invitation Accepted - {enrollment.training.name}",
         taglist=['waitlist', 'enrolled', 'accepted']
-    ).send()
+    ).send_to_trainers(enrollment.training)
     
     db.session.commit()
         
@@ -171,14 +235,14 @@ def enroll_common(training, user):
 
     if waitlist:
         system_msg.EmailStudentEnrolledInTrainingWaitlist(envelop_to=user, enrollment=enroll).send()
-        system_msg.EmailStudentEnrolledWaitlist(envelop_to=training.trainer_users, enrollment=enroll).send()
+        system_msg.EmailStudentEnrolledWaitlist(envelop_to=training.trainer_users, enrollment=enroll).send_to_trainers(training)
 
     else:
         a = system_msg.EmailStudentEnrolledInTraining(envelop_to=user, 
                                                   enrollment=enroll)
         a.send()
                                                   
-        system_msg.EmailStudentEnrolled(envelop_to=training.trainer_users, enrollment=enroll).send()
+        system_msg.EmailStudentEnrolled(envelop_to=training.trainer_users, enrollment=enroll).send_to_trainers(training)
 
         db.session.commit()
 
@@ -204,7 +268,7 @@ def deroll_common(training, user, admin=False):
                 fullname=user.fullname, trainingname=training.name), 'error')
         return False
 
-    system_msg.EmailStudentDerolled(envelop_to=training.trainer_users, enrollment=training_enroll).send()
+    system_msg.EmailStudentDerolled(envelop_to=training.trainer_users, enrollment=training_enroll).send_to_trainers(training)
     system_msg.EmailStudentDerolledInTraining(envelop_to=user, enrollment=training_enroll).send()
     flash(_("%(username)s successfully removed from the training: %(trainingname)s", username=user.fullname, 
         trainingname=training.name))
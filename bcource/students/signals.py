@@ -0,0 +1,34 @@
+"""
+Student records for new accounts.
+
+Every user needs a Student row to show up in the trainers' student list and
+to enroll. The rows are created when an account is registered or confirmed,
+StudentReconcileTask creates the ones missing for accounts made elsewhere
+(admin, api).
+"""
+from flask_security.signals import user_registered, user_confirmed
+from bcource.models import Student
+from bcource import db
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_student(user):
+    """Add the default student record of user when it has none, the caller commits."""
+    if user.students or user.email in Student.NO_STUDENT_EMAILS:
+        return None
+    logger.info(f'Create student record for {user}')
+    return Student.create_default(user)
+
+
+@user_registered.connect
+def _student_on_register(sender, user, **kwargs):
+    ensure_student(user)
+    db.session.commit()
+
+
+@user_confirmed.connect
+def _student_on_confirm(sender, user, **kwargs):
+    if ensure_student(user):
+        db.session.commit()
@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm, RecaptchaField
+from flask_wtf.file import FileField, FileAllowed
 from flask import current_app
 from flask_babel import _
 from flask import url_for
@@ -195,3 +196,18 @@ class UserDeleteForm(FlaskForm):
     submit = MySubmitField(_l('Update'), 
             render_kw={"class_": "btn btn-outline-dark position-relative form-control mt-1"},
             divclass="col-md-12")
+
+class StudentImportForm(FlaskForm):
+    file = FileField(_l('CSV file'), [FileAllowed(['csv', 'txt'], _l('Upload a .csv file'))])
+    # set when an import continues in a next request, see students_views.import_students()
+    upload = MyHiddenField('upload')
+    next_line = MyHiddenField('next_line')
+
+    dry_run = MyBooleanField(
+        _l('Dry run, only validate the file'),
+        default=True,
+        render_kw={"class": "form-check-input"})
+
+    submit = MySubmitField(_l('Import'),
+            render_kw={"class_": "btn btn-outline-dark position-relative form-control mt-1"},
+            divclass="col-md-12")
@@ -0,0 +1,293 @@
+"""
+CSV bulk import of students.
+
+Every row creates a User with its Student record (default practice) and
+UserSettings. Rows are read in chunks of BCOURSE_IMPORT_CHUNK_SIZE; a chunk
+is validated with one lookup per table (existing emails and phone numbers,
+Postalcodes addresses) and inserted with one commit. A dry run validates
+everything and writes nothing.
+
+Rows of an existing email are skipped, so an import can simply be run again.
+StudentImport.run() also stops after BCOURSE_IMPORT_MAX_SECONDS and reports
+the line to continue from (next_line), the view keeps the uploaded file and
+that position so a large file is imported over several requests. Uploads
+hold personal data: the view removes them after a dry run, a completed or a
+failed import, and expire_uploads() removes abandoned ones.
+"""
+from bcource import db
+from bcource.helpers import config_value as cv
+from bcource.models import User, Student, StudentStatus, StudentType, UserSettings, Practice, Postalcodes, Role
+from bcource.sms_util import validate_phone_number_cached
+from flask import current_app
+from flask_security import naive_utcnow
+from sqlalchemy import select, func, tuple_
+from sqlalchemy.exc import SQLAlchemyError
+from email_validator import validate_email, EmailNotValidError
+from datetime import datetime
+import csv
+import io
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# accepted column names, the header of the file may use any case and spaces for underscores
+IMPORT_COLUMNS = ('email', 'first_name', 'last_name', 'phone_number', 'gender', 'birthday',
+                  'street', 'house_number', 'house_number_extention', 'postal_code', 'city', 'country',
+                  'studenttype', 'studentstatus', 'language')
+IMPORT_REQUIRED = ('email', 'first_name', 'last_name')
+
+BIRTHDAY_FORMATS = ('%Y-%m-%d', '%d-%m-%Y', '%d/%m/%Y')
+
+
+def remove_upload(path):
+    """Remove an uploaded import file, a concurrent request may have removed it already."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def expire_uploads(directory):
+    """Remove uploads not used for BCOURSE_IMPORT_UPLOAD_MAX_AGE seconds, imports that were abandoned."""
+    if not os.path.isdir(directory):
+        return
+    oldest = time.time() - cv('IMPORT_UPLOAD_MAX_AGE')
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.stat().st_mtime < oldest:
+            remove_upload(entry.path)
+            logger.info(f"Removed abandoned student import {entry.name}")
+
+
+class StudentImport(object):
+    """One import (or dry run) of a CSV file, see run()."""
+
+    def __init__(self, content, dry_run=True, start_line=2):
+        self.content = content
+        self.dry_run = dry_run
+        self.start_line = start_line
+        self.chunk_size = cv('IMPORT_CHUNK_SIZE')
+        self.max_seconds = cv('IMPORT_MAX_SECONDS')
+        self.region = cv('IMPORT_PHONE_REGION')
+        self.report = dict(dry_run=dry_run, rows=0, created=0, existing=0, errors=[], warnings=[],
+                           next_line=start_line, done=False, seconds=0.0)
+
+    def error(self, line, message):
+        self.report['errors'].append((line, message))
+
+    def warning(self, line, message):
+        self.report['warnings'].append((line, message))
+
+    def reader(self):
+        content = self.content.lstrip('\ufeff')
+        try:
+            dialect = csv.Sniffer().sniff(content[:4096], delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.DictReader(io.StringIO(content), dialect=dialect)
+        fields = {name: name.strip().lower().replace(' ', '_') for name in reader.fieldnames or []}
+        missing = [column for column in IMPORT_REQUIRED if column not in fields.values()]
+        if missing:
+            raise ValueError(f"missing columns: {', '.join(missing)}")
+        unknown = [name for name, column in fields.items() if column not in IMPORT_COLUMNS]
+        if unknown:
+            self.warning(1, f"ignored columns: {', '.join(unknown)}")
+
+        for row in reader:
+            yield reader.line_num, {fields[name]: (value or '').strip()
+                                    for name, value in row.items() if name in fields and fields[name] in IMPORT_COLUMNS}
+
+    def chunks(self):
+        chunk = []
+        for line, row in self.reader():
+            if line < self.start_line:
+                continue
+            chunk.append((line, row))
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def lookups(self):
+        """Student types, statuses and defaults of the practice, by lowercased name."""
+        practice = Practice.default_row()
+        self.practice = practice
+        self.studenttypes = {t.name.lower(): t for t in StudentType.get_all(practice.shortname)}
+        self.studentstatuses = {s.name.lower(): s for s in StudentStatus.get_all(practice.shortname)}
+        self.default_studenttype = StudentType.default_row()
+        self.default_studentstatus = StudentStatus.default_row()
+        self.student_role = Role.query.filter_by(name='student').first()
+        self.seen_emails = set()
+        self.seen_phones = set()
+        self.postalcodes_available = True
+
+    def addresses(self, rows):
+        """{(postcode, huisnummer): Postalcodes} of the rows with a postal code, one query on the postalcodes bind."""
+        keys = {(row['postal_code'].replace(' ', '').upper(), row['house_number'])
+                for _line, row in rows if row.get('postal_code') and row.get('house_number')}
+        if not keys or not self.postalcodes_available:
+            return {}
+        try:
+            found = db.session.scalars(select(Postalcodes).where(
+                tuple_(Postalcodes.postcode, Postalcodes.huisnummer).in_(keys))).all()
+        except SQLAlchemyError as e:
+            logger.warning(f"postalcodes lookup failed, addresses are not checked: {e}")
+            self.postalcodes_available = False
+            db.session.rollback()
+            return {}
+        return {(address.postcode, address.huisnummer): address for address in found}
+
+    def validate(self, line, row, existing_phones, addresses):
+        """Validated column values of a row for a new user, None when the row has errors."""
+        values = {}
+        try:
+            values['email'] = validate_email(row['email'], check_deliverability=False).normalized.lower()
+        except EmailNotValidError as e:
+            self.error(line, f"email {row['email']!r}: {e}")
+            return None
+
+        for column in ('first_name', 'last_name'):
+            if not row.get(column):
+                self.error(line, f"{column} is required")
+                return None
+            values[column] = row[column][:128]
+
+        if row.get('phone_number'):
+            is_valid, phone_number, message = validate_phone_number_cached(row['phone_number'], self.region)
+            if not is_valid:
+                self.error(line, f"phone number {row['phone_number']!r}: {message}")
+                return None
+            if phone_number in existing_phones or phone_number in self.seen_phones:
+                self.error(line, f"phone number {phone_number} is already used")
+                return None
+            values['phone_number'] = phone_number
+
+        if row.get('gender'):
+            gender = row['gender'][:1].upper()
+            if gender not in ('F', 'M', 'O'):
+                self.error(line, f"gender {row['gender']!r} is not F, M or O")
+                return None
+            values['gender'] = gender
+
+        if row.get('birthday'):
+            for fmt in BIRTHDAY_FORMATS:
+                try:
+                    values['birthday'] = datetime.strptime(row['birthday'], fmt).date()
+                    break
+                except ValueError:
+                    continue
+            else:
+                self.error(line, f"birthday {row['birthday']!r} is not a date (YYYY-MM-DD)")
+                return None
+
+        for column in ('street', 'house_number', 'house_number_extention', 'postal_code', 'city', 'country'):
+            if row.get(column):
+                values[column] = row[column]
+
+        if values.get('postal_code'):
+            values['postal_code'] = values['postal_code'].replace(' ', '').upper()
+            address = addresses.get((values['postal_code'], values.get('house_number')))
+            if address:
+                values.setdefault('street', address.straat)
+                values.setdefault('city', address.woonplaats)
+            elif self.postalcodes_available and values.get('house_number'):
+                self.warning(line, f"address {values['postal_code']} {values['house_number']} not found")
+
+        values['studenttype'] = self.default_studenttype
+        if row.get('studenttype'):
+            values['studenttype'] = self.studenttypes.get(row['studenttype'].lower())
+            if values['studenttype'] is None:
+                self.error(line, f"unknown student type {row['studenttype']!r}")
+                return None
+
+        values['studentstatus'] = self.default_studentstatus
+        if row.get('studentstatus'):
+            values['studentstatus'] = self.studentstatuses.get(row['studentstatus'].lower())
+            if values['studentstatus'] is None:
+                self.error(line, f"unknown student status {row['studentstatus']!r}")
+                return None
+
+        values['language'] = current_app.config['LANGUAGE_DEFAULT']
+        if row.get('language'):
+            if row['language'].lower() not in current_app.config['LANGUAGES']:
+                self.error(line, f"unknown language {row['language']!r}")
+                return None
+            values['language'] = row['language'].lower()
+
+        return values
+
+    def create(self, values):
+        studenttype = values.pop('studenttype')
+        studentstatus = values.pop('studentstatus')
+        language = values.pop('language')
+
+        user = User(active=True, confirmed_at=naive_utcnow(), fs_uniquifier=uuid.uuid4().hex, **values)
+        if self.student_role:
+            user.roles.append(self.student_role)
+        db.session.add(user)
+        db.session.add(Student(user=user, practice=self.practice,
+                               studenttype=studenttype, studentstatus=studentstatus))
+        db.session.add(UserSettings(user=user, language=language))
+
+    def import_chunk(self, chunk):
+        emails = {row['email'].lower() for _line, row in chunk if row.get('email')}
+        existing_emails = set(db.session.scalars(select(func.lower(User.email)).where(
+            func.lower(User.email).in_(emails)))) if emails else set()
+
+        phones = set()
+        for _line, row in chunk:
+            if row.get('phone_number'):
+                is_valid, phone_number, _message = validate_phone_number_cached(row['phone_number'], self.region)
+                if is_valid:
+                    phones.add(phone_number)
+        existing_phones = set(db.session.scalars(select(User.phone_number).where(
+            User.phone_number.in_(phones)))) if phones else set()
+
+        addresses = self.addresses(chunk)
+
+        for line, row in chunk:
+            self.report['rows'] += 1
+            email = row.get('email', '').lower()
+            if email in existing_emails:
+                self.report['existing'] += 1
+                continue
+            if email and email in self.seen_emails:
+                self.error(line, f"email {email} is used on an earlier line")
+                continue
+            values = self.validate(line, row, existing_phones, addresses)
+            if values is None:
+                continue
+            self.seen_emails.add(values['email'])
+            if values.get('phone_number'):
+                self.seen_phones.add(values['phone_number'])
+            self.report['created'] += 1
+            if not self.dry_run:
+                self.create(values)
+
+        if not self.dry_run:
+            db.session.commit()
+
+    def run(self):
+        """Import (or validate) the rows from start_line on, returns the report."""
+        start = time.monotonic()
+        try:
+            self.lookups()
+            for chunk in self.chunks():
+                self.import_chunk(chunk)
+                self.report['next_line'] = chunk[-1][0] + 1
+                if not self.dry_run and time.monotonic() - start > self.max_seconds:
+                    break
+            else:
+                self.report['done'] = True
+        except (ValueError, csv.Error) as e:
+            self.error(1, str(e))
+            self.report['done'] = True
+        except Exception:
+            db.session.rollback()
+            raise
+
+        self.report['seconds'] = round(time.monotonic() - start, 2)
+        return self.report
@@ -5,6 +5,7 @@ from flask_security import current_user
 from bcource.models import Student, StudentStatus, StudentType, Practice, Role, User, Training, Student, TrainingEnroll,\
     TrainingEvent, TrainingType, Trainer
 from bcource import db
+from bcource.reference_data import reference_data
 from os import environ
 from bcource.policy import PolicyBase, ValidationRule
 from datetime import datetime, timedelta
@@ -99,7 +100,7 @@ class CancelationPolicy(PolicyBase):
         if not training:
             raise(ValueError(f'kwargs "training" missing in {self.__class__.__name__}'))
     
-        if not self.policy_name in [item.name for item in training.trainingtype.policies]:
+        if not self.policy_name in reference_data(training.trainingtype.practice_id).policy_names(training.trainingtype_id):
             return False
     
         return (True)
@@ -115,7 +116,7 @@ class TrainingBookingPolicy(PolicyBase):
         if not training:
             raise(ValueError(f'kwargs "training" missing in {self.__class__.__name__}'))
 
-        if not self.policy_name in [item.name for item in training.trainingtype.policies]:
+        if not self.policy_name in reference_data(training.trainingtype.practice_id).policy_names(training.trainingtype_id):
             return False
         
         if training.apply_policies == False:
@@ -10,6 +10,7 @@ from bcource.helpers import get_url, safe_redirect
 from bcource.training.training_forms import TrainingDerollForm, TrainingEnrollForm
 from sqlalchemy.orm import joinedload
 from bcource.filters import Filters
+from bcource.reference_data import reference_data
 from bcource import db
 from bcource.helper_app_context import b_pagination
 
@@ -111,9 +112,7 @@ def student_training(id):
     search_on_id = request.args.get('id')
 
     
-    traingingtypes = TrainingType().query.join(Practice).filter(and_(
-                        Practice.shortname==Practice.default_row().shortname)
-                        ).all()
+    traingingtypes = reference_data().trainingtypes
 
     training_select = training_query(filters,user,search_on_id)
     training_pagination = b_pagination(training_select)
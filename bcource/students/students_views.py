@@ -1,23 +1,31 @@
 from flask import Blueprint, render_template, abort, redirect, url_for, flash, request, jsonify
 from flask_security import current_user, naive_utcnow, hash_password
 from flask import current_app as app
-from bcource.helpers import admin_has_role, has_trainer_role, get_url, safe_redirect, add_url_argument
+from bcource.helpers import (admin_has_role, has_trainer_role, get_url, safe_redirect, add_url_argument,
+                             name_search_terms, config_value as cv)
 
 from bcource import menu_structure, db
 from bcource.models import (Student, StudentStatus, StudentType, User, Practice, 
-                            Role, Trainer, UserMessageAssociation, UserSettings, TrainingType, Training, TrainingEnroll, TrainingEvent)
-from bcource.students.student_forms import StudentForm, UserStudentForm, UserDeleteForm, UserDerollForm, UserBackForm
-from sqlalchemy import or_, and_, not_
+                            Role, Trainer, UserMessageAssociation, UserSettings, TrainingType, Training, TrainingEnroll, TrainingEvent,
+                            UserSearchToken, user_search_cache)
+from bcource.students.student_forms import StudentForm, UserStudentForm, UserDeleteForm, UserDerollForm, UserBackForm, StudentImportForm
+from bcource.students.student_import import StudentImport, expire_uploads, remove_upload
+from sqlalchemy import or_, and_, not_, select, func
 import wtforms.validators as validators
 import bcource.messages as bmsg 
 from datetime import datetime 
 import uuid, pytz
+import hashlib
+import os
+import re
 
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, contains_eager
+from bcource.exports import export_response, export_rows
 from bcource.students.common import deroll_common, enroll_common
 from bcource.students.student_policies import CancelationPolicy
 from bcource.training.training_forms import TrainingDerollForm, TrainingEnrollForm
-from bcource.filters import Filters
+from bcource.filters import Filters, cached_facets
+from bcource.reference_data import reference_data
 from flask_babel import lazy_gettext as _l
 from flask_babel import _
 from bcource.helper_app_context import b_pagination
@@ -36,27 +44,48 @@ main_menu = menu_structure.add_menu('Training Administration', role='trainer')
 main_menu.add_menu('User Administration', 'students_bp.index', role='trainer')
 
 
+def student_facets():
+    """
+    Status and type options of the students of the current practice and the 
+    (studentstatus_id, studenttype_id, count) rows of one grouped query, 
+    cached per practice.
+    """
+    practice = Practice.current()
+    shortname = practice.shortname if practice else cv('DEFAULT_PRACTICE_SHORTNAME')
+
+    def load(key):
+        data = reference_data(shortname)
+        return dict(
+            studentstatus=[(status.id, status.name) for status in data.studentstatuses],
+            studenttype=[(student_type.id, student_type.name) for student_type in data.studenttypes],
+            rows=[tuple(row) for row in db.session.execute(
+                select(Student.studentstatus_id, Student.studenttype_id, func.count())
+                .join(Practice, Practice.id == Student.practice_id).where(Practice.shortname == shortname)
+                .group_by(Student.studentstatus_id, Student.studenttype_id))])
+
+    return cached_facets(('students', shortname), load)
+
+
 def make_filters():
     
     
     filters = Filters("Student Filters")
-
+    facets = student_facets()
     
     studentstatus_filter = filters.new_filter("studentstatus", _("Status"))
-    for status_type in StudentStatus.get_all():
-        studentstatus_filter.add_filter_item( status_type.id, status_type.name)
+    for id, name in facets['studentstatus']:
+        studentstatus_filter.add_filter_item( id, name)
 
     studenttype_filter = filters.new_filter("studenttype", _("Type"))
-    for student_type in StudentType.get_all():
-        studenttype_filter.add_filter_item( student_type.id, student_type.name)
+    for id, name in facets['studenttype']:
+        studenttype_filter.add_filter_item( id, name)
 
+    filters.facet_counts(facets['rows'], ('studentstatus', 'studenttype'))
     return(filters)
 
 
 def students_query(filters, search_on_id=None):
     
-    orphan_users()
-
 
     if search_on_id:
         q = Student().query.filter(Student.id == search_on_id)
@@ -87,33 +116,12 @@ def students_query(filters, search_on_id=None):
         
         q = q.join(studentstatus)
 
-    q = q.join(User).join(Practice, Practice.id==Student.practice_id).filter(and_(
-                        Practice.shortname==Practice.default_row().shortname)).order_by(User.first_name, User.last_name, User.email)
+    # read only: student records are created at registration (students/signals.py)
+    practice = Practice.current()
+    q = q.join(User).filter(Student.practice_id == (practice.id if practice else None)
+                        ).order_by(User.first_name, User.last_name, User.email)
     return q
 
-# if there are any users that do not have a student record add them.
-def orphan_users():
-    orphan_user_list = db.session.query(User).filter(~User.students.any()).all() #@UndefinedVariable
-    
-    studenttype = StudentType.default_row() #@UndefinedVariable
-    studentstatus = StudentStatus.default_row() #@UndefinedVariable
-    practice = Practice.default_row() #@UndefinedVariable
-    
-    for user in orphan_user_list:
-        if user.email == "do-not-reply@bcourse.nl" or user.email == "not-reply@bcourse.nl":
-            continue    
-            
-        student=Student(user=user, 
-                        studentstatus=studentstatus,
-                        studenttype=studenttype,
-                        practice=practice)
-        
-        db.session.add(student)
-        
-    db.session.commit()
-
-
-
 @students_bp.route('/', methods=['GET'])
 def index():
     
@@ -158,27 +166,82 @@ def email_selection():
                             first_url=request.url))
 
 
+@students_bp.route('/export.<any(csv, xlsx):fmt>', methods=['GET'])
+def export(fmt):
+    filters = make_filters().process_filters()
+    q = students_query(filters).options(contains_eager(Student.user),
+                                        joinedload(Student.studenttype),
+                                        joinedload(Student.studentstatus))
+
+    header = [_('Id'), _('First name'), _('Last name'), _('Email'), _('Phone number'),
+              _('Type'), _('Status'), _('Postal code'), _('City')]
+    row = lambda student: (student.id, student.user.first_name, student.user.last_name, student.user.email,
+                           student.user.phone_number, student.studenttype.name, student.studentstatus.name,
+                           student.user.postal_code, student.user.city)
+    return export_response('students', fmt, header, export_rows(q, row))
+
+
+def attendance_query(student_id=None, start=None, end=None):
+    """
+    Enrollments (status enrolled) of the trainings of the practice that have 
+    ended, with the start and end of each training: (TrainingEnroll, start_time, end_time).
+    """
+    dates = select(TrainingEvent.training_id,
+                   func.min(TrainingEvent.start_time).label('start_time'),
+                   func.max(TrainingEvent.end_time).label('end_time')).group_by(TrainingEvent.training_id).subquery()
+    practice = Practice.current()
+
+    q = TrainingEnroll().query.join(dates, dates.c.training_id == TrainingEnroll.training_id).join(Training).filter(
+        Training.practice_id == (practice.id if practice else None),
+        TrainingEnroll.status == 'enrolled',
+        dates.c.end_time < datetime.now(pytz.utc)).add_columns(dates.c.start_time, dates.c.end_time)
+
+    if student_id:
+        q = q.filter(TrainingEnroll.student_id == student_id)
+    if start:
+        q = q.filter(dates.c.start_time >= start)
+    if end:
+        q = q.filter(dates.c.start_time < end)
+
+    return q.options(contains_eager(TrainingEnroll.training).joinedload(Training.trainingtype),
+                     joinedload(TrainingEnroll.student).joinedload(Student.user)
+                     ).order_by(dates.c.start_time, TrainingEnroll.training_id, TrainingEnroll.student_id)
+
+
+@students_bp.route('/attendance.<any(csv, xlsx):fmt>', methods=['GET'])
+def attendance_export(fmt):
+    try:
+        start, end = [datetime.strptime(request.args[arg], '%Y-%m-%d').replace(tzinfo=pytz.utc)
+                      if request.args.get(arg) else None for arg in ('from', 'to')]
+    except ValueError:
+        abort(400)
+    q = attendance_query(request.args.get('id', type=int), start, end)
+
+    header = [_('Start'), _('End'), _('Training'), _('Training type'), _('Student id'), _('Name'), _('Email'), _('Paid')]
+    row = lambda r: (r.start_time, r.end_time, r.TrainingEnroll.training.name, r.TrainingEnroll.training.trainingtype.name,
+                     r.TrainingEnroll.student_id, r.TrainingEnroll.student.fullname, r.TrainingEnroll.student.email,
+                     r.TrainingEnroll.paid)
+    return export_response('attendance', fmt, header, export_rows(q, row))
+
+
 @students_bp.route('/search',methods=['GET'])
 def search():
-    results = {}
-    results.update({"results": []})
-
     query_term = request.args.get('q')
-    r = []
-    
-    if query_term:
-        r = Student().query.join(Student.user).join(Practice).filter(and_(
-                Practice.shortname==Practice.default_row().shortname), or_( 
-            User.first_name.ilike(f'%{query_term}%'), 
-            User.last_name.ilike(f'%{query_term}%'),
-            User.email.ilike(f'%{query_term}%'))).order_by(User.first_name, User.last_name).all()
-    else:
-        r = Student().query.join(Student.user).join(Practice).filter(
-            Practice.shortname==Practice.default_row().shortname).order_by(User.first_name, User.last_name).all()
-        
-    for student in r:
-        results["results"].append({"id": student.id,  "text":  student.fullname})
-    return jsonify(results)
+    practice = Practice.default_row()
+    limit = max(1, min(request.args.get('limit', cv('USER_SEARCH_LIMIT'), int), 100))
+
+    def lookup(key):
+        q = Student().query.join(Student.user).filter(Student.practice_id == practice.id)
+
+        clause, rank = UserSearchToken.match(query_term)
+        if clause is not None:
+            q = q.filter(clause).order_by(rank)
+
+        r = q.order_by(User.first_name, User.last_name).limit(limit).all()
+        return [{"id": student.id,  "text":  student.fullname} for student in r]
+
+    key = ('student', practice.id, " ".join(name_search_terms(query_term)), limit)
+    return jsonify({"results": user_search_cache.get(key, lookup, cv('USER_SEARCH_CACHE_TTL'))})
 
 @students_bp.route('/delete-user/<int:id>',methods=['GET', 'POST'])
 def delete(id):
@@ -212,6 +275,54 @@ def delete(id):
     return safe_redirect(url)
 
 
+@students_bp.route('/import', methods=['GET', 'POST'])
+def import_students():
+    """
+    CSV import of students. The uploaded file is kept in the instance folder 
+    under its sha1 until it is imported completely, an import that stops after 
+    BCOURSE_IMPORT_MAX_SECONDS continues from the reported line. The file is 
+    removed after a dry run or a failed import, abandoned files after 
+    BCOURSE_IMPORT_UPLOAD_MAX_AGE.
+    """
+    form = StudentImportForm()
+    report = None
+    upload_dir = os.path.join(app.instance_path, 'student-import')
+    expire_uploads(upload_dir)
+
+    if form.validate_on_submit():
+        upload, start_line = form.upload.data, 2
+        if form.file.data:
+            content = form.file.data.read().decode('utf-8-sig', errors='replace')
+            upload = hashlib.sha1(content.encode('utf-8')).hexdigest()
+            os.makedirs(upload_dir, exist_ok=True)
+            with open(os.path.join(upload_dir, f'{upload}.csv'), 'w', encoding='utf-8') as f:
+                f.write(content)
+        elif upload and re.fullmatch(r'[0-9a-f]{40}', upload) and os.path.exists(os.path.join(upload_dir, f'{upload}.csv')):
+            with open(os.path.join(upload_dir, f'{upload}.csv'), encoding='utf-8') as f:
+                content = f.read()
+            # in use, expire_uploads() measures the age from the last request
+            os.utime(os.path.join(upload_dir, f'{upload}.csv'))
+            start_line = int(form.next_line.data or 2)
+        else:
+            flash(_('Select a CSV file to import.'), 'error')
+            return redirect(url_for('students_bp.import_students'))
+
+        upload_path = os.path.join(upload_dir, f'{upload}.csv')
+        try:
+            report = StudentImport(content, dry_run=form.dry_run.data, start_line=start_line).run()
+        except Exception:
+            remove_upload(upload_path)
+            raise
+
+        form.upload.data = upload
+        form.next_line.data = report['next_line']
+        if report['dry_run'] or report['done']:
+            remove_upload(upload_path)
+            form.upload.data = None
+
+    return render_template("students/import.html", form=form, report=report, page_name=_("Import Students"))
+
+
 @students_bp.route('/user-edit/<int:id>',methods=['GET', 'POST'])
 @students_bp.route('/user-edit/',methods=['GET', 'POST'])
 def edit_user(id=None):
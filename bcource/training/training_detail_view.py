@@ -8,11 +8,15 @@ from bcource.students.common import invite_from_waitlist, enroll_common
 from datetime import datetime
 from bcource.training.training_forms import TrainingDerollForm
 from bcource.filters import Filters
+from bcource.students.students_views import student_facets
+from sqlalchemy import select, func, case
 from bcource import db
+from bcource.exports import export_response, export_rows
+from sqlalchemy.orm import joinedload
 import bcource.messages as system_msg
 
 
-def make_filters():
+def make_filters(training=None):
 
 
     filters = Filters("Training Filters")
@@ -20,12 +24,20 @@ def make_filters():
     past_training_filter.add_filter_item( 1, _("Wait List"))
 
     studenttype_filter = filters.new_filter("studenttype", _("Type"))
-    for student_type in StudentType.get_all():
-        studenttype_filter.add_filter_item( student_type.id, student_type.name)
+    for id, name in student_facets()['studenttype']:
+        studenttype_filter.add_filter_item( id, name)
+
+    if training:
+        # (studenttype_id, waitlist, count) of the enrollments of the training in one grouped query
+        waitlist = case((TrainingEnroll.status.ilike("%waitlist%"), '1'), else_='0')
+        filters.facet_counts([tuple(row) for row in db.session.execute(
+            select(Student.studenttype_id, waitlist, func.count()).select_from(TrainingEnroll).join(Student)
+            .where(TrainingEnroll.training_id == training.id)
+            .group_by(Student.studenttype_id, waitlist))], ('studenttype', 'waitlist'))
 
     return (filters)
 
-def enrollement_query(training, filters):
+def enrollment_select(training, filters):
 
 
     if filters.get_item_is_checked("waitlist","1"):
@@ -39,7 +51,10 @@ def enrollement_query(training, filters):
     if filters.get_items_checked('studenttype'):
         q = q.join(Student).filter(Student.studenttype_id.in_(filters.get_items_checked('studenttype')))
 
-    return q.all()
+    return q
+
+def enrollement_query(training, filters):
+    return enrollment_select(training, filters).all()
 
 
 
@@ -171,6 +186,24 @@ def training_email_selection(id):
                             first_url=request.url))
 
 
+@training_bp.route('/training-detail/<int:id>/export.<any(csv, xlsx):fmt>', methods=['GET'])
+def training_export(id, fmt):
+    training = Training().query.get(id)
+    if not training:
+        abort(404)
+
+    filters = make_filters().process_filters()
+    q = enrollment_select(training, filters).options(
+        joinedload(TrainingEnroll.student).joinedload(Student.user),
+        joinedload(TrainingEnroll.student).joinedload(Student.studenttype))
+
+    header = [_('Student id'), _('Name'), _('Email'), _('Phone number'), _('Type'), _('Status'),
+              _('Waitlist position'), _('Enrolled on'), _('Paid')]
+    row = lambda e: (e.student_id, e.student.fullname, e.student.email, e.student.phone_number,
+                     e.student.studenttype.name, e.status, e.waitlist_position, e.enrole_date, e.paid)
+    return export_response(f'enrollments-{training.id}', fmt, header, export_rows(q, row))
+
+
 @training_bp.route('/training-detail/<int:id>',methods=['GET', 'POST'])
 def training_detail(id):
     clear = request.args.getlist('submit_id')
@@ -189,7 +222,7 @@ def training_detail(id):
     if not training:
         abort(404)
     training._cal_enrollments()
-    filters = make_filters().process_filters()
+    filters = make_filters(training).process_filters()
     
     enrolled = enrollement_query(training, filters)
     url = get_url(deroll_form, default='training_bp.overview_list', back_button=True)
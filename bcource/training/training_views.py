@@ -14,6 +14,7 @@ import json
 from datetime import datetime
 import pytz
 from bcource.filters import Filters
+from bcource.reference_data import reference_data
 from bcource.helper_app_context import b_pagination
 
 # Blueprint Configuration
@@ -322,9 +323,7 @@ def overview_list():
     
     search_on_id = request.args.get('id')
 
-    traingingtypes = TrainingType().query.join(Practice).filter(and_(
-                        Practice.shortname==Practice.default_row().shortname)
-                        ).all()
+    traingingtypes = reference_data().trainingtypes
     filters = make_filters().process_filters()
     
     trainings_select = training_query(filters,search_on_id)
@@ -0,0 +1,177 @@
+"""
+Server-sent events feed of per-user changes.
+
+Writers append rows to the user_change table (see UserChange) in the same
+transaction as the change itself. One ChangeFeed per worker process polls that
+table from a single background thread and hands the new rows to the queues of
+the users connected to this worker, so the number of database polls does not
+grow with the number of open connections.
+
+Ids are handed out when a row is inserted, not when it commits: a poll can
+see id 12 while id 11 is still uncommitted. Such skipped ids are read
+again until they show up or BCOURSE_CHANGE_LOG_GAP_SECONDS have passed
+(ids of rolled back transactions never do).
+"""
+from bcource import db
+from bcource.helpers import config_value as cv
+from bcource.models import UserChange, UserMessageCounter
+from sqlalchemy import select, delete, func, or_
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def sse_message(event, data):
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class ChangeFeed(object):
+    """
+    Dispatches user_change rows to the subscribed users of this process.
+    Use ChangeFeed.get(app) for the instance of the current process.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, app):
+        self.app = app
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.last_id = None
+        self.gaps = {}  # id skipped by a poll -> time.monotonic() it was first missed
+        self.last_prune = 0
+        self.thread = None
+        self.pid = os.getpid()
+
+    @classmethod
+    def get(cls, app):
+        # a forked worker starts with a copy of the parent's instance but not its thread
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                cls._instance = cls(app)
+            return cls._instance
+
+    def subscribe(self, user_id):
+        """
+        Register a connection of user_id, returns the queue its events are put 
+        on. None when this process already serves BCOURSE_SSE_MAX_STREAMS 
+        connections or the user BCOURSE_SSE_MAX_STREAMS_PER_USER.
+        """
+        max_streams, max_per_user = cv('SSE_MAX_STREAMS'), cv('SSE_MAX_STREAMS_PER_USER')
+        events = queue.Queue(maxsize=100)
+        with self.lock:
+            connections = self.subscribers.get(user_id, set())
+            if len(connections) >= max_per_user or \
+                    sum(len(c) for c in self.subscribers.values()) >= max_streams:
+                return None
+            self.subscribers.setdefault(user_id, set()).add(events)
+        return events
+
+    def unsubscribe(self, user_id, events):
+        with self.lock:
+            connections = self.subscribers.get(user_id, set())
+            connections.discard(events)
+            if not connections:
+                self.subscribers.pop(user_id, None)
+
+    def start(self):
+        """Start the poll thread of this process if it is not running."""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="change-feed", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    self.poll()
+                    if time.monotonic() - self.last_prune > 60:
+                        self.prune()
+                except Exception as e:
+                    logger.warning(f"change feed poll failed: {e}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+                interval = cv('SSE_POLL_INTERVAL')
+            time.sleep(interval)
+
+    def poll(self):
+        """
+        Read the change log rows added since the last poll and put an event
+        on the queues of the subscribed users. Returns the number of events.
+        """
+        if self.last_id is None:
+            # only changes made after the feed started are of interest
+            self.last_id = db.session.scalar(select(func.max(UserChange.id))) or 0
+            return 0
+
+        now = time.monotonic()
+        expired = now - cv('CHANGE_LOG_GAP_SECONDS')
+        self.gaps = {change_id: seen for change_id, seen in self.gaps.items() if seen > expired}
+
+        new = UserChange.id > self.last_id
+        rows = db.session.execute(select(UserChange.id, UserChange.user_id, UserChange.kind,
+                                         UserChange.ref_id, UserChange.value)
+                                  .where(or_(new, UserChange.id.in_(self.gaps)) if self.gaps else new)
+                                  .order_by(UserChange.id)).all()
+        if not rows:
+            return 0
+
+        ids = {row.id for row in rows}
+        for change_id in ids:
+            self.gaps.pop(change_id, None)
+        last_id = max(self.last_id, rows[-1].id)
+        for change_id in range(self.last_id + 1, last_id):
+            if change_id not in ids:
+                self.gaps[change_id] = now
+        self.last_id = last_id
+
+        with self.lock:
+            subscribed = set(self.subscribers)
+
+        unread = set()
+        events = []
+        for row in rows:
+            if row.user_id not in subscribed:
+                continue
+            if row.kind == 'unread':
+                unread.add(row.user_id)
+            else:
+                events.append((row.user_id, row.kind, dict(training_id=row.ref_id, status=row.value)))
+
+        # several unread changes of a user collapse into one event with the current count
+        if unread:
+            counts = dict(db.session.execute(select(UserMessageCounter.user_id, UserMessageCounter.unread_count)
+                                             .where(UserMessageCounter.user_id.in_(unread))).all())
+            events.extend((user_id, 'unread', dict(unread=counts.get(user_id, 0))) for user_id in unread)
+
+        for user_id, kind, data in events:
+            self.publish(user_id, kind, data)
+        return len(events)
+
+    def publish(self, user_id, kind, data):
+        with self.lock:
+            connections = list(self.subscribers.get(user_id, ()))
+        for events in connections:
+            try:
+                events.put_nowait((kind, data))
+            except queue.Full:
+                # a stalled client misses events, its next reconnect starts with the current state
+                pass
+
+    def prune(self):
+        """Delete change log rows older than BCOURSE_CHANGE_LOG_TTL seconds."""
+        self.last_prune = time.monotonic()
+        cutoff = datetime.utcnow() - timedelta(seconds=cv('CHANGE_LOG_TTL'))
+        result = db.session.execute(delete(UserChange).where(UserChange.created_date < cutoff))
+        db.session.commit()
+        return result.rowcount
@@ -82,6 +82,13 @@ class UserSettingsForm(FlaskForm):
         divclass = "col-md-12 mt-1",
         render_kw={"class": "position-relative form-control form-select"})
 
+    notification_cadence = MySelectField(
+        _l('Trainer notifications'),
+        choices=[('', _l('Default')), ('immediate', _l('Immediately')), 
+                 ('hourly', _l('Hourly digest')), ('daily', _l('Daily digest'))],
+        divclass = "col-md-12 mt-1",
+        render_kw={"class": "position-relative form-control form-select"})
+
     url  = MyHiddenField('url')
     
     # submit = MySubmitField(_l('Submit'), 
@@ -2,7 +2,7 @@ from flask_babel import _
 from flask_babel import lazy_gettext as _l
 from bcource.policy import PolicyBase, HasData, DataIs
 from flask_security import current_user
-from bcource.models import Student, StudentStatus, StudentType, Practice, Role
+from bcource.models import Student, Role
 from bcource import db
 from os import environ
 
@@ -11,17 +11,7 @@ def post_validate_student_status(validator):
         if not current_user.students:
             
             ## this will break if we start using multiple practices
-
-            studenttype = StudentType.default_row() #@UndefinedVariable
-            studentstatus = StudentStatus.default_row() #@UndefinedVariable
-            practice = Practice.default_row() #@UndefinedVariable
-                 
-            student=Student(user=current_user, 
-                            studentstatus=studentstatus,
-                            studenttype=studenttype,
-                            practice=practice)
-            
-            db.session.add(student)
+            Student.create_default(current_user)
             db.session.commit()
             validator.validate()
 
@@ -1,27 +1,36 @@
 import uuid
-from flask import Blueprint, render_template, request, flash, request, redirect, session, url_for, jsonify, current_app
+from flask import Blueprint, render_template, request, flash, request, redirect, session, url_for, jsonify, current_app, abort, Response
 from flask_mailman import EmailMultiAlternatives
 from flask_babel import _
 from flask_security import current_user, logout_user
-from bcource.models import UserSettings, Message, User, UserMessageAssociation, Role, MessageTag, Training, TrainingEnroll, Student
+from bcource.models import (UserSettings, Message, MessageBody, User, UserMessageAssociation, UserMessageCounter, MessageSearchToken, Role, MessageTag, Training, TrainingEnroll, Student, message_tag_association,
+                            UserSearchToken, user_search_cache)
 from flask import current_app as app
 from flask_security import auth_required
 from bcource.user.forms  import AccountDetailsForm, UserSettingsForm, UserMessages, MessageActionform, SupportForm, PublicSupportForm
 from werkzeug.security import generate_password_hash, check_password_hash
 from bcource.helpers import (get_url, safe_redirect, message_date, config_value as cv,
                              is_impersonating, get_original_user, get_impersonated_user,
-                             start_impersonation, stop_impersonation, can_impersonate)
+                             start_impersonation, stop_impersonation, can_impersonate, name_search_terms)
 from bcource.user.user_status import UserProfileChecks, UserProfileSystemChecks
 from bcource import db, menu_structure
 from setuptools._vendor.jaraco.functools import except_
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, select, func
+from sqlalchemy import update as sql_update  # update() is the account-details view
+from werkzeug.datastructures import MultiDict
+from urllib.parse import parse_qsl
+from sqlalchemy.orm import contains_eager
 from datetime import datetime, timezone
 import pytz
+import queue
+import time
 from flask_babel import lazy_gettext as _l
 from bcource.helper_app_context import b_pagination
 from jsonschema import validate, ValidationError
 from bcource.filters import Filters
 from bcource.messages import SendEmail
+from bcource.ical import UserCalendarFeed
+from bcource.user.change_feed import ChangeFeed, sse_message
 # Blueprint Configuration
 user_bp = Blueprint(
     'user_bp', __name__,
@@ -82,12 +91,55 @@ ACTION_JSON = {
       "items": {
         "type": "integer"
       }
+    },
+    "query": {
+      "type": "string"
     }
   },
-  "required": ["action", "message_ids"] 
+  "required": ["action"],
+  "anyOf": [{"required": ["message_ids"]}, {"required": ["query"]}]
 }
 
 
+def bulk_message_action(action, clauses):
+    """
+    Apply an inbox action to every user_message row matching clauses with 
+    one UPDATE. Rows already in the target state are left alone. Returns 
+    the number of rows changed, or None for an unknown action.
+
+    The unread counters of the affected users are locked first and adjusted 
+    by the number of rows that leave or enter the unread state.
+    """
+    now = datetime.now(timezone.utc)
+    match action:
+        case "read":
+            state, values = UserMessageAssociation.message_read == None, dict(message_read=now)
+            unread, delta = UserMessageAssociation.message_deleted == None, -1
+        case "unread":
+            state, values = UserMessageAssociation.message_read != None, dict(message_read=None)
+            unread, delta = UserMessageAssociation.message_deleted == None, 1
+        case "delete":
+            state, values = UserMessageAssociation.message_deleted == None, dict(message_deleted=now)
+            unread, delta = UserMessageAssociation.message_read == None, -1
+        case "undelete":
+            state, values = UserMessageAssociation.message_deleted != None, dict(message_deleted=None)
+            unread, delta = UserMessageAssociation.message_read == None, 1
+        case _:
+            return None
+
+    users = select(UserMessageAssociation.user_id).where(*clauses, state).distinct()
+    db.session.execute(select(UserMessageCounter.user_id)
+                       .where(UserMessageCounter.user_id.in_(users)).with_for_update()).all()
+    changes = db.session.execute(select(UserMessageAssociation.user_id, func.count())
+                                 .where(*clauses, state, unread)
+                                 .group_by(UserMessageAssociation.user_id)).all()
+
+    result = db.session.execute(sql_update(UserMessageAssociation).where(*clauses, state).values(**values),
+                                execution_options={"synchronize_session": False})
+    UserMessageCounter.adjust(db.session, {user_id: delta * count for user_id, count in changes})
+    return result.rowcount
+
+
 @user_bp.route('/messages/api/action', methods=['GET', 'POST'])
 @auth_required()
 def action():
@@ -106,34 +158,38 @@ def action():
         return jsonify(results)
             
     results["echo"] = data
-        
-    messages = UserMessageAssociation().query.join(Message).filter(UserMessageAssociation.user==current_user,
-                                                                       UserMessageAssociation.message_id.in_(data['message_ids'])).all()
-    for message in messages:
-        match data['action']:
-            case "undelete":
-                message.message_deleted = None
-                results["messages"].append(message.message_id)
-            case "unread":
-                message.message_read = None
-                results["messages"].append(message.message_id)
-            case "read":
-                message.message_read = datetime.now(timezone.utc)
-                results["messages"].append(message.message_id)
-            case "delete":
-                message.message_deleted = datetime.now(timezone.utc)
-                results["messages"].append(message.message_id)
-            case _:
-                results['errors'].append(f"unkonwn action {data['action']}")
-                return jsonify(results)
+
+    if 'message_ids' in data:
+        clauses = [UserMessageAssociation.user_id == current_user.id,
+                   UserMessageAssociation.message_id.in_(data['message_ids'])]
+    else:
+        # the query string of the message list, the action applies to everything it shows
+        args = MultiDict(parse_qsl(data['query'].lstrip('?')))
+        filters = make_filters(mailbox='inbox').process_filters(args)
+        clauses = message_filter_clauses(current_user, filters, args.get('q', None))
+
+    changed = bulk_message_action(data['action'], clauses)
+    if changed is None:
+        results['errors'].append(f"unkonwn action {data['action']}")
+        return jsonify(results)
 
     db.session.commit()
     results["results"] = True
     results["action"] = data['action']
+    results["changed"] = changed
+    results["messages"] = data.get('message_ids', [])
     results["unread_messages"] = current_user.unread_messages
     
     return jsonify(results)
 
+def thread_url(message):
+    """Url of the conversation view, None for a message without replies."""
+    if message.thread_root_id == None and not db.session.scalar(
+            select(Message.id).where(Message.thread_root_id == message.id).limit(1)):
+        return None
+    return url_for('user_bp.thread', id=message.id)
+
+
 @user_bp.route('/messages/api/get/<int:id>', methods=['GET', 'POST'])
 @auth_required()
 def get_messages(id):
@@ -152,14 +208,15 @@ def get_messages(id):
             "id": envelop.message.id, 
             "subject": envelop.message.subject,
             "created_date": f'{message_date(envelop.message.created_date, mobile_date=True)}',
-            "body": envelop.message.body,
+            "body": envelop.message.safe_body,
             "tags": [tag.tag for tag in envelop.message.tags ],
             "from": f'{envelop.message.envelop_from}' if not current_app.config["BCOURSE_SYSTEM_USER"] == envelop.message.envelop_from.email else "do-not-reply",
             "to": ", ".join([f'{assoc.user}' for assoc in envelop.message.envelop_to]),
             "show_to": current_user.has_role('trainer'),
             "deleted": f'{message_date(envelop.message_deleted, mobile_date=True)}' if envelop.message_deleted != None else None,
             "read": f'{message_date(envelop.message_read, mobile_date=True)}' if envelop.message_read != None else None,
-            "unread_messages": current_user.unread_messages
+            "unread_messages": current_user.unread_messages,
+            "thread_url": thread_url(envelop.message)
             }
     else:
         # Check if the user is the sender (for sent mailbox)
@@ -171,14 +228,15 @@ def get_messages(id):
                 "id": message.id, 
                 "subject": message.subject,
                 "created_date": f'{message_date(message.created_date, mobile_date=True)}',
-                "body": message.body,
+                "body": message.safe_body,
                 "tags": [tag.tag for tag in message.tags],
                 "from": f'{message.envelop_from}',
                 "to": recipients,
                 "deleted": None,
                 "read": None,
                 "unread_messages": current_user.unread_messages,
-                "is_sent": True
+                "is_sent": True,
+                "thread_url": thread_url(message)
                 }
         
     return jsonify(results)
@@ -201,40 +259,52 @@ def make_filters(mailbox='inbox'):
 
     return(filters)
 
-def make_message_select(filters, user_q=None):
-    
-    
-    q = UserMessageAssociation().query
-    
-    q = q.filter(UserMessageAssociation.user==current_user)
-             
+def message_filter_clauses(user, filters, user_q=None):
+    """
+    WHERE clauses on user_message for the inbox filters of user. Search and 
+    tags are IN subqueries so the same clauses work for the message list 
+    and for bulk UPDATEs.
+    """
+    clauses = [UserMessageAssociation.user_id == user.id]
+
     if filters.get_item_is_checked("read","1") and filters.get_item_is_checked("read","2"):
         pass
     elif filters.get_item_is_checked("read","1"):
-        q = q.filter(UserMessageAssociation.message_read != None)
+        clauses.append(UserMessageAssociation.message_read != None)
 
     elif filters.get_item_is_checked("read","2"):
-        q = q.filter(UserMessageAssociation.message_read == None)
+        clauses.append(UserMessageAssociation.message_read == None)
 
     if filters.get_item_is_checked("read","3"):
-        q = q.filter(UserMessageAssociation.message_deleted != None)
+        clauses.append(UserMessageAssociation.message_deleted != None)
     else:
-        q = q.filter(UserMessageAssociation.message_deleted == None)
-
-    
+        clauses.append(UserMessageAssociation.message_deleted == None)
 
     if user_q:
-        q =  q.join(Message).filter(or_(
-            Message.body.like(f"%{user_q}%"),
-            Message.subject.like(f"%{user_q}%"),
-                                        ))
-    else:
-        q = q.join(Message)
+        clauses.append(UserMessageAssociation.message_id.in_(
+            select(MessageSearchToken.search(user_q).c.message_id)))
 
     items_checked = filters.get_items_checked('tag')
 
     if items_checked:
-        q = q.join(Message.tags).filter(MessageTag.id.in_(items_checked))
+        clauses.append(UserMessageAssociation.message_id.in_(
+            select(message_tag_association.c.message_id).where(
+                message_tag_association.c.messagetag_id.in_(items_checked))))
+
+    return clauses
+
+def make_message_select(filters, user_q=None):
+
+    # the search is joined below for its rank, not filtered on a second time
+    q = UserMessageAssociation().query.filter(*message_filter_clauses(current_user, filters, None))
+
+    # the list only shows message headers, bodies are never loaded here
+    q = q.join(Message).options(contains_eager(UserMessageAssociation.message))
+
+    if user_q:
+        # best matches first
+        ranked = MessageSearchToken.search(user_q)
+        q = q.join(ranked, ranked.c.message_id == Message.id).order_by(ranked.c.rank.desc())
 
     q = q.order_by(Message.created_date.desc())
 
@@ -245,10 +315,8 @@ def make_sent_message_select(filters, user_q=None):
     q = Message.query.filter(Message.envelop_from_id == current_user.id)
     
     if user_q:
-        q = q.filter(or_(
-            Message.body.like(f"%{user_q}%"),
-            Message.subject.like(f"%{user_q}%"),
-        ))
+        ranked = MessageSearchToken.search(user_q)
+        q = q.join(ranked, ranked.c.message_id == Message.id).order_by(ranked.c.rank.desc())
 
     items_checked = filters.get_items_checked('tag')
     if items_checked:
@@ -292,6 +360,61 @@ def messages():
                            page_name=_l("Messages"),
                            pagination=messages)
 
+def thread_page(message_id, user, page=1, per_page=20):
+    """
+    One page of the conversation message_id belongs to, as seen by user. 
+    Returns None when user neither sent nor received message_id.
+    """
+    thread_id = db.session.scalar(
+        select(func.coalesce(Message.thread_root_id, Message.id))
+        .outerjoin(UserMessageAssociation, and_(UserMessageAssociation.message_id == Message.id,
+                                                UserMessageAssociation.user_id == user.id))
+        .where(Message.id == message_id,
+               or_(Message.envelop_from_id == user.id, UserMessageAssociation.user_id != None)))
+    if thread_id is None:
+        return None
+
+    # one extra row tells whether there is a next page, no COUNT(*) needed
+    rows = db.session.execute(Message.thread(thread_id, user)
+                              .offset((page - 1) * per_page).limit(per_page + 1)).all()
+    messages = []
+    for message, envelop in rows[:per_page]:
+        messages.append({
+            "id": message.id,
+            "subject": message.subject,
+            "from": f'{message.envelop_from}' if not current_app.config["BCOURSE_SYSTEM_USER"] == message.envelop_from.email else "do-not-reply",
+            "created_date": f'{message_date(message.created_date, mobile_date=True)}',
+            "read": f'{message_date(envelop.message_read, mobile_date=True)}' if envelop and envelop.message_read != None else None,
+            "is_sent": message.envelop_from_id == user.id,
+            })
+
+    return {"results": True,
+            "thread_id": thread_id,
+            "page": page,
+            "per_page": per_page,
+            "has_next": len(rows) > per_page,
+            "messages": messages}
+
+
+@user_bp.route('/messages/api/thread/<int:id>', methods=['GET'])
+@auth_required()
+def thread_api(id):
+    """Message headers of a conversation, bodies are fetched with get_messages()."""
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+    results = thread_page(id, current_user, page, per_page)
+    return jsonify(results or {"results": False})
+
+
+@user_bp.route('/messages/thread/<int:id>', methods=['GET'])
+@auth_required()
+def thread(id):
+    if thread_page(id, current_user, per_page=1) is None:
+        flash(_("Message does not exists!"), 'error')
+        return redirect(url_for('user_bp.messages'))
+    return render_template("user/thread.html", message_id=id)
+
+
 @user_bp.route('/message', methods=['GET', 'POST'])
 @auth_required()
 def message():
@@ -361,12 +484,19 @@ def message():
         if not envelop_tos:
             flash(_("Could not find users!"))
         else:
+            in_reply_to = None
+            if reply_message_id:
+                in_reply_to = Message.query.join(UserMessageAssociation).filter(
+                    UserMessageAssociation.user_id == current_user.id,
+                    Message.id == reply_message_id).first()
+
             m = SendEmail(envelop_to=envelop_tos, 
                           envelop_from=current_user,
                           has_content=True,
                           body=form.body.data,
                           taglist=['email', 'form'],
-                          subject=form.subject.data)
+                          subject=form.subject.data,
+                          in_reply_to=in_reply_to)
             
             m.send()
             
@@ -379,32 +509,28 @@ def message():
 @user_bp.route('/search',methods=['GET'])
 @auth_required()
 def search():
-    results = {}
-    results.update({"results": []})
-
     query_term = request.args.get('q')
-    
     exclude = request.args.getlist('exclude',int)
-    
-    q = User().query
-    if not current_user.has_role('trainer'):
-        q = q.join(User.roles).filter(Role.name == "trainer")
+    is_trainer = current_user.has_role('trainer')
+    limit = max(1, min(request.args.get('limit', cv('USER_SEARCH_LIMIT'), int), 100))
 
-    if exclude:
-        q = q.filter(~User.id.in_(exclude))
-    
-    if query_term:
-        q = q.filter(or_( 
-            User.first_name.ilike(f'%{query_term}%'), 
-            User.last_name.ilike(f'%{query_term}%'),
-            User.email.ilike(f'%{query_term}%')))
+    def lookup(key):
+        q = User().query
+        if not is_trainer:
+            q = q.join(User.roles).filter(Role.name == "trainer")
 
-    r = q.order_by(User.first_name, User.last_name).all()
-            
-    for user in r:
-        results["results"].append({"id": user.id,  "text":  user.fullname})
-        
-    return jsonify(results)
+        if exclude:
+            q = q.filter(~User.id.in_(exclude))
+
+        clause, rank = UserSearchToken.match(query_term)
+        if clause is not None:
+            q = q.filter(clause).order_by(rank)
+
+        r = q.order_by(User.first_name, User.last_name).limit(limit).all()
+        return [{"id": user.id,  "text":  user.fullname} for user in r]
+
+    key = ('user', is_trainer, tuple(exclude), " ".join(name_search_terms(query_term)), limit)
+    return jsonify({"results": user_search_cache.get(key, lookup, cv('USER_SEARCH_CACHE_TTL'))})
 
 
 @user_bp.route('/account-settings', methods=['GET', 'POST'])
@@ -412,6 +538,10 @@ def search():
 def settings():
     form = UserSettingsForm(obj=current_user.usersettings)
 
+    # the digest setting only applies to trainers
+    if not current_user.trainers:
+        del form.notification_cadence
+
     # Pre-populate fields on GET
     if not form.is_submitted():
         if current_user.usersettings:
@@ -435,6 +565,8 @@ def settings():
             settings.user = current_user
             db.session.add(settings)
         form.populate_obj(settings)
+        if form.notification_cadence is not None:
+            settings.notification_cadence = form.notification_cadence.data or None
         settings.msg_transactional_emails = msg_transactional
         settings.language = language
 
@@ -443,7 +575,85 @@ def settings():
         flash(_("Account Settings are update successfully."))
         return safe_redirect(url)
 
-    return render_template("user/update-settings.html", form=form)
+    calendar_url = None
+    if current_user.usersettings:
+        if not current_user.usersettings.calendar_token:
+            current_user.usersettings.get_calendar_token()
+            db.session.commit()
+        calendar_url = url_for('user_bp.calendar_feed', token=current_user.usersettings.calendar_token, _external=True)
+
+    return render_template("user/update-settings.html", form=form, calendar_url=calendar_url)
+
+
+@user_bp.route('/calendar/reset', methods=['POST'])
+@auth_required()
+def calendar_reset():
+    settings = current_user.usersettings
+    if settings:
+        settings.get_calendar_token(reset=True)
+        db.session.commit()
+        flash(_("Your calendar link has been reset, the old link no longer works."))
+    return redirect(url_for('user_bp.settings'))
+
+
+@user_bp.route('/calendar/<token>.ics', methods=['GET'])
+def calendar_feed(token):
+    """Personal calendar feed, authenticated by the secret token in the url."""
+    settings = UserSettings.query.filter(UserSettings.calendar_token == token).first()
+    if not settings:
+        abort(404)
+
+    feed = UserCalendarFeed(settings.user)
+    etag = feed.etag()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(feed.to_ical(etag), mimetype='text/calendar')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    return response
+
+
+@user_bp.route('/events', methods=['GET'])
+@auth_required()
+def events():
+    """
+    Server-sent events for the current user: "unread" with the unread 
+    message count and "enrollment" with the training id and new status.
+    A stream holds a worker thread, when no stream is available the 
+    response is a 503 (the browser does not retry, the page works without 
+    live updates).
+    """
+    feed = ChangeFeed.get(app._get_current_object())
+    user_id = current_user.id
+    unread = current_user.unread_messages
+    heartbeat, max_seconds = cv('SSE_HEARTBEAT'), cv('SSE_MAX_SECONDS')
+    feed.start()
+
+    # the session is not needed while the stream is open
+    db.session.remove()
+
+    def stream():
+        yield "retry: 5000\n\n"
+        yield sse_message('unread', dict(unread=unread))
+        deadline = time.monotonic() + max_seconds
+        while time.monotonic() < deadline:
+            try:
+                kind, data = subscription.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield sse_message(kind, data)
+
+    # subscribed last, the slot is released when the response is closed, also 
+    # when the stream never started
+    subscription = feed.subscribe(user_id)
+    if subscription is None:
+        return Response("no stream available\n", status=503, mimetype='text/plain')
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(lambda: feed.unsubscribe(user_id, subscription))
+    return response
 
 
 @user_bp.route('/support', methods=['GET', 'POST'])
@@ -482,7 +692,7 @@ def support():
             subject=f"Support Request: {form.subject.data}",
             taglist=['support', 'email']
         )
-        msg.send()
+        request_message = msg.send()
         
         # Also send a copy to the user for their records
         confirmation_msg = SendEmail(
@@ -496,7 +706,8 @@ def support():
             <p>{form.body.data}</p>
             """,
             subject=f"Support Request Received: {form.subject.data}",
-            taglist=['support', 'email']
+            taglist=['support', 'email'],
+            in_reply_to=request_message
         )
         confirmation_msg.send()
         
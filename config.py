@@ -140,6 +140,71 @@ class Config:
     
     BCOURSE_SUPPORT_EMAIL = environ.get("BCOURSE_SUPPORT_EMAIL", 'support@bcourse.nl')
 
+    # Message bodies of at least this many bytes are stored zlib-compressed (0 = never)
+    BCOURSE_MESSAGE_BODY_COMPRESS_MIN = int(environ.get("BCOURSE_MESSAGE_BODY_COMPRESS_MIN", "0"))
+
+    # Default delivery of trainer notifications: "immediate", "hourly" or "daily" digest.
+    # Digests need an active TrainerDigestTask automation schedule, without one delivery is immediate.
+    BCOURSE_TRAINER_NOTIFICATION_CADENCE = environ.get("BCOURSE_TRAINER_NOTIFICATION_CADENCE", "daily")
+    # A failed digest is retried after this many minutes, doubled on every further failure; the
+    # notifications are given up (left unsent) after BCOURSE_TRAINER_DIGEST_MAX_ATTEMPTS deliveries
+    BCOURSE_TRAINER_DIGEST_RETRY_MINUTES = int(environ.get("BCOURSE_TRAINER_DIGEST_RETRY_MINUTES", "5"))
+    BCOURSE_TRAINER_DIGEST_MAX_ATTEMPTS = int(environ.get("BCOURSE_TRAINER_DIGEST_MAX_ATTEMPTS", "5"))
+
+    # Personal calendar feeds list trainings with events that ended at most this many days ago
+    BCOURSE_ICAL_FEED_DAYS = int(environ.get("BCOURSE_ICAL_FEED_DAYS", "90"))
+
+    # Server-sent events (/account/events): change log poll interval of the per-worker feed thread,
+    # keepalive interval, lifetime of one stream (the browser reconnects) and change log retention, in seconds
+    BCOURSE_SSE_POLL_INTERVAL = float(environ.get("BCOURSE_SSE_POLL_INTERVAL", "1.0"))
+    BCOURSE_SSE_HEARTBEAT = int(environ.get("BCOURSE_SSE_HEARTBEAT", "15"))
+    BCOURSE_SSE_MAX_SECONDS = int(environ.get("BCOURSE_SSE_MAX_SECONDS", "60"))
+    BCOURSE_CHANGE_LOG_TTL = int(environ.get("BCOURSE_CHANGE_LOG_TTL", "600"))
+    # An open stream holds a worker thread: streams per worker process (keep well below the gunicorn
+    # --threads) and per user; requests over the limit get a 503 and the page works without live updates
+    BCOURSE_SSE_MAX_STREAMS = int(environ.get("BCOURSE_SSE_MAX_STREAMS", "4"))
+    BCOURSE_SSE_MAX_STREAMS_PER_USER = int(environ.get("BCOURSE_SSE_MAX_STREAMS_PER_USER", "2"))
+    # Change log ids skipped by a poll (their transaction had not committed yet) are read again for this
+    # many seconds, longer than any transaction that writes the change log stays open
+    BCOURSE_CHANGE_LOG_GAP_SECONDS = int(environ.get("BCOURSE_CHANGE_LOG_GAP_SECONDS", "60"))
+
+    # Message search uses the MySQL FULLTEXT indexes when the database is MySQL and this is set,
+    # otherwise (on other databases, and when BCOURSE_MESSAGE_BODY_COMPRESS_MIN is set: compressed
+    # bodies are not in the FULLTEXT index) the message_search_token index
+    BCOURSE_MESSAGE_SEARCH_FULLTEXT = environ.get("BCOURSE_MESSAGE_SEARCH_FULLTEXT", "1") == "1"
+
+    # Typeahead user/student lookups: default number of results and how long (seconds) a worker keeps
+    # the results of a lookup; changes made in the same worker clear them at once
+    BCOURSE_USER_SEARCH_LIMIT = int(environ.get("BCOURSE_USER_SEARCH_LIMIT", "20"))
+    BCOURSE_USER_SEARCH_CACHE_TTL = float(environ.get("BCOURSE_USER_SEARCH_CACHE_TTL", "30"))
+
+    # Filter facet options and counts (student list, scheduler) are cached per practice for this many seconds
+    BCOURSE_FACET_CACHE_TTL = float(environ.get("BCOURSE_FACET_CACHE_TTL", "30"))
+
+    # CSV/XLSX exports are fetched from the database in batches of this many rows while the response streams
+    BCOURSE_EXPORT_YIELD_PER = int(environ.get("BCOURSE_EXPORT_YIELD_PER", "500"))
+
+    # Student CSV import: rows per chunk (one commit each), seconds one request imports before it
+    # reports where to continue, and the country of phone numbers given without country code
+    BCOURSE_IMPORT_CHUNK_SIZE = int(environ.get("BCOURSE_IMPORT_CHUNK_SIZE", "500"))
+    BCOURSE_IMPORT_MAX_SECONDS = float(environ.get("BCOURSE_IMPORT_MAX_SECONDS", "20"))
+    BCOURSE_IMPORT_PHONE_REGION = environ.get("BCOURSE_IMPORT_PHONE_REGION", "NL")
+    # Uploaded import files (personal data) that are not imported within this many seconds are removed
+    BCOURSE_IMPORT_UPLOAD_MAX_AGE = int(environ.get("BCOURSE_IMPORT_UPLOAD_MAX_AGE", "3600"))
+
+    # Message retention (MessageRetentionTask): messages without tags and tags without a MessageTag.retention_days
+    # policy are kept this many days (0 = forever), a message is kept for the longest retention of its tags.
+    # Recipient rows deleted by the user are purged after
+    # BCOURSE_MESSAGE_DELETED_RETENTION_DAYS (0 = never). Expired messages are archived as gzip JSONL
+    # files in BCOURSE_MESSAGE_ARCHIVE_DIR (default: <instance>/message-archive) before they are purged.
+    BCOURSE_MESSAGE_RETENTION_DAYS = int(environ.get("BCOURSE_MESSAGE_RETENTION_DAYS", "0"))
+    BCOURSE_MESSAGE_DELETED_RETENTION_DAYS = int(environ.get("BCOURSE_MESSAGE_DELETED_RETENTION_DAYS", "30"))
+    BCOURSE_MESSAGE_ARCHIVE_DIR = environ.get("BCOURSE_MESSAGE_ARCHIVE_DIR", "")
+    # purge in message id ranges of this size, one transaction each with a pause (seconds) in between
+    BCOURSE_RETENTION_BATCH_SIZE = int(environ.get("BCOURSE_RETENTION_BATCH_SIZE", "500"))
+    BCOURSE_RETENTION_SLEEP = float(environ.get("BCOURSE_RETENTION_SLEEP", "0.2"))
+    BCOURSE_RETENTION_MAX_BATCHES = int(environ.get("BCOURSE_RETENTION_MAX_BATCHES", "1000"))
+
     SECURITY_AUTHORIZE_REQUEST = {'admin.index': [ BCOURSE_SUPER_USER_ROLE, 'cms-admin' ]}
     
     #sheduler
@@ -185,6 +250,18 @@ class Config:
     JWT_EXPIRATION_SECONDS = int(environ.get("JWT_EXPIRATION_SECONDS", "86400"))
     JWT_ALGORITHM = environ.get("JWT_ALGORITHM", "HS256")
 
+    # Admin API list endpoints: page size when no limit is given, and the largest limit accepted
+    ADMIN_API_PAGE_SIZE = int(environ.get("ADMIN_API_PAGE_SIZE", "100"))
+    ADMIN_API_MAX_PAGE_SIZE = int(environ.get("ADMIN_API_MAX_PAGE_SIZE", "500"))
+    # /admin-api/changes stops before a missing change id (a transaction that is still committing)
+    # until the change after it is this old (seconds); the changes are inserted right before the
+    # COMMIT, so it only has to cover a slow commit
+    ADMIN_API_CHANGES_GAP_SECONDS = float(environ.get("ADMIN_API_CHANGES_GAP_SECONDS", "300"))
+    # Largest number of operations in one /admin-api/batch request, and the time (seconds) after
+    # which the operations that are left are not run
+    ADMIN_API_BATCH_MAX_OPERATIONS = int(environ.get("ADMIN_API_BATCH_MAX_OPERATIONS", "500"))
+    ADMIN_API_BATCH_MAX_SECONDS = float(environ.get("ADMIN_API_BATCH_MAX_SECONDS", "60"))
+
 
 settings = Config
 
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Benchmark the message rendering pipeline in messages per second.
+
+Compares the previous BeautifulSoup based html -> text conversion with the
+streaming html.parser converter (cold and memoized) and nh3 sanitizing with
+and without the content-hash cache. Runs without a database or app context.
+
+Usage:
+  python bench_message_render.py [--messages 2000] [--distinct 20]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import nh3
+
+from bcource.helpers import sanitize_html
+from bcource.messages import _html_to_text, cleanhtml
+
+
+def cleanhtml_bs4(raw_html):
+    """The BeautifulSoup implementation cleanhtml() used before."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(raw_html, "html.parser")
+    for a in soup.find_all('a'):
+        href = a.get('href')
+        if href:
+            a.replace_with(f'{a.get_text()} ({href})')
+    for br in soup.find_all('br'):
+        br.replace_with('\n')
+    for p in soup.find_all('p'):
+        p.insert_before('\n')
+        p.insert_after('\n')
+    for div in soup.find_all('div'):
+        div.insert_after('\n')
+    for h in soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6']):
+        h.insert_before('\n')
+        h.insert_after('\n')
+    for li in soup.find_all('li'):
+        li.insert_before('\n  • ')
+    text = soup.get_text()
+    text = re.sub(r'\n\s*\n\s*\n+', '\n\n', text)
+    text = re.sub(r'[ \t]+', ' ', text)
+    return text.strip()
+
+
+def make_bodies(count, distinct):
+    template = """
+<h2>Reminder: Training {n}</h2>
+<p>Dear student {n},</p>
+<p>This is a reminder for your training on <strong>Monday</strong> at 19:00.
+Please find the details below.</p>
+<ul>
+  <li>Location: Grote Trainingsruimte, Frans Halsstraat 7</li>
+  <li>Trainer: Jane Doe</li>
+  <li>Bring: mat, water &amp; towel</li>
+</ul>
+<div>Questions? <a href="https://bcourse.nl/account/">Visit your account</a><br>
+or reply to this message.</div>
+<hr><p style="font-size: 12px; color: #666;">Bcourse Training System</p>
+"""
+    return [template.format(n=i % distinct) for i in range(count)]
+
+
+def bench(name, func, bodies):
+    start = time.perf_counter()
+    for body in bodies:
+        func(body)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<40} {len(bodies) / elapsed:>12,.0f} msg/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000, help="messages to render")
+    parser.add_argument("--distinct", type=int, default=20, help="distinct bodies among them")
+    args = parser.parse_args()
+
+    bodies = make_bodies(args.messages, args.distinct)
+    print(f"{args.messages} messages, {args.distinct} distinct bodies")
+    print("=" * 60)
+
+    bench("text/plain: BeautifulSoup (before)", cleanhtml_bs4, bodies)
+    bench("text/plain: html.parser, no cache", _html_to_text, bodies)
+    bench("text/plain: html.parser, memoized", cleanhtml, bodies)
+    bench("sanitize: nh3.clean, no cache", nh3.clean, bodies)
+    bench("sanitize: memoized", sanitize_html, bodies)
+
+    bench("sanitize + text/plain (memoized)",
+          lambda body: (sanitize_html(body), cleanhtml(body)), bodies)
+
+
+if __name__ == "__main__":
+    main()
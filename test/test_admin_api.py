@@ -121,7 +121,8 @@ class TestLocationEndpoints(unittest.TestCase):
         mock_loc.country = 'NL'
 
         mock_query = Mock()
-        mock_query.order_by.return_value.all.return_value = [mock_loc]
+        mock_query.options.return_value = mock_query
+        mock_query.order_by.return_value.limit.return_value.all.return_value = [mock_loc]
         mock_location_cls.query.filter_by.return_value = mock_query
 
         resp = self.client.get('/admin-api/locations/')
@@ -164,7 +165,8 @@ class TestTrainingTypeEndpoints(unittest.TestCase):
         mock_tt.description = 'Yoga class'
 
         mock_query = Mock()
-        mock_query.order_by.return_value.all.return_value = [mock_tt]
+        mock_query.options.return_value = mock_query
+        mock_query.order_by.return_value.limit.return_value.all.return_value = [mock_tt]
         mock_tt_cls.query.filter_by.return_value = mock_query
 
         resp = self.client.get('/admin-api/training-types/')
@@ -213,6 +215,7 @@ class TestStudentEndpoints(unittest.TestCase):
 
         mock_query = Mock()
         mock_query.filter.return_value = mock_query
+        mock_query.options.return_value = mock_query
         mock_query.order_by.return_value.limit.return_value.all.return_value = [mock_student]
         mock_student_cls.query.join.return_value = mock_query
 
@@ -238,6 +241,7 @@ class TestStudentEndpoints(unittest.TestCase):
         mock_practice_cls.default_row.return_value = mock_practice
 
         mock_query = Mock()
+        mock_query.options.return_value = mock_query
         mock_query.order_by.return_value.limit.return_value.all.return_value = []
         mock_student_cls.query.join.return_value.filter.return_value = mock_query
 
@@ -289,7 +293,8 @@ class TestTrainingEndpoints(unittest.TestCase):
             mock_query = Mock()
             mock_query.filter_by.return_value = mock_query
             mock_query.filter.return_value = mock_query
-            mock_query.order_by.return_value.all.return_value = [mock_training]
+            mock_query.options.return_value = mock_query
+            mock_query.order_by.return_value.limit.return_value.all.return_value = [mock_training]
             mock_training_cls.query.filter_by.return_value = mock_query
 
             resp = self.client.get('/admin-api/trainings/')
@@ -311,7 +316,8 @@ class TestTrainingEndpoints(unittest.TestCase):
 
             mock_query = Mock()
             mock_query.filter_by.return_value = mock_query
-            mock_query.order_by.return_value.all.return_value = []
+            mock_query.options.return_value = mock_query
+            mock_query.order_by.return_value.limit.return_value.all.return_value = []
             mock_training_cls.query.filter_by.return_value = mock_query
 
             resp = self.client.get('/admin-api/trainings/?active=true')
@@ -551,7 +557,8 @@ class TestTrainingEventEndpoints(unittest.TestCase):
             mock_event.training_id = 1
 
             mock_query = Mock()
-            mock_query.order_by.return_value.all.return_value = [mock_event]
+            mock_query.options.return_value = mock_query
+            mock_query.order_by.return_value.limit.return_value.all.return_value = [mock_event]
             mock_event_cls.query.filter_by.return_value = mock_query
 
             resp = self.client.get('/admin-api/trainings/1/events')
@@ -715,7 +722,8 @@ class TestEnrollmentEndpoints(unittest.TestCase):
 
             mock_query = Mock()
             mock_query.filter_by.return_value = mock_query
-            mock_query.order_by.return_value.all.return_value = [mock_enrollment]
+            mock_query.options.return_value = mock_query
+            mock_query.order_by.return_value.limit.return_value.all.return_value = [mock_enrollment]
             mock_enroll_cls.query.filter_by.return_value = mock_query
 
             resp = self.client.get('/admin-api/trainings/1/enrollments')
@@ -738,7 +746,8 @@ class TestEnrollmentEndpoints(unittest.TestCase):
 
             mock_query = Mock()
             mock_query.filter_by.return_value = mock_query
-            mock_query.order_by.return_value.all.return_value = []
+            mock_query.options.return_value = mock_query
+            mock_query.order_by.return_value.limit.return_value.all.return_value = []
             mock_enroll_cls.query.filter_by.return_value = mock_query
 
             resp = self.client.get('/admin-api/trainings/1/enrollments?status=waitlist')
@@ -1178,121 +1187,113 @@ class TestBulkMoveEndpoint(unittest.TestCase):
         mock_user.has_role.return_value = True
         return patcher
 
+    def _mock_queries(self, mock_training_cls, mock_db, source_rows, target_rows, max_participants=10):
+        """Source (id 1) and target (id 2) trainings, and the results of the source and target queries."""
+        mock_training_cls.query.get_or_404.return_value = Mock(id=1, practice_id=1)
+        mock_training_cls.query.get.return_value = Mock(id=2, practice_id=1, max_participants=max_participants)
+        mock_db.session.execute.side_effect = [source_rows, Mock(all=Mock(return_value=target_rows)), Mock()]
+
+    def _post_bulk_move(self, **data):
+        body = {'student_ids': [10], 'target_training_id': 2, 'operation': 'move'}
+        body.update(data)
+        resp = self.client.post('/admin-api/trainings/1/enrollments/bulk-move',
+            data=json.dumps(body),
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        return json.loads(resp.data)
+
+    @patch('bcource.admin_api.enrollments.EntityChange')
+    @patch('bcource.admin_api.enrollments.UserChange')
     @patch('bcource.admin_api.enrollments.db')
-    @patch('bcource.admin_api.enrollments.TrainingEnroll')
     @patch('bcource.admin_api.enrollments.Training')
-    def test_bulk_move(self, mock_training_cls, mock_enroll_cls, mock_db):
+    def test_bulk_move(self, mock_training_cls, mock_db, mock_user_change, mock_entity_change):
+        """Move: the source rows are updated to the target with one UPDATE."""
+        from sqlalchemy.sql.dml import Update
         patcher = self._auth_patch()
         try:
-            mock_training_cls.query.get_or_404.return_value = Mock(id=1)
-            mock_training_cls.query.get.return_value = Mock(id=2)
-
-            source_enrollment = Mock(status='enrolled', paid=True)
-
-            def filter_by_side_effect(**kwargs):
-                result = Mock()
-                if kwargs.get('training_id') == 1:
-                    result.first.return_value = source_enrollment
-                elif kwargs.get('training_id') == 2:
-                    result.first.return_value = None  # Not in target
-                return result
-
-            mock_enroll_cls.query.filter_by.side_effect = filter_by_side_effect
-
-            resp = self.client.post('/admin-api/trainings/1/enrollments/bulk-move',
-                data=json.dumps({
-                    'student_ids': [10],
-                    'target_training_id': 2,
-                    'operation': 'move',
-                }),
-                content_type='application/json')
+            source = Mock(student_id=10, status='enrolled', paid=True, waitlist_position=None, waitlist_opt_out=False)
+            self._mock_queries(mock_training_cls, mock_db, [source], [])
 
-            self.assertEqual(resp.status_code, 200)
-            data = json.loads(resp.data)
+            data = self._post_bulk_move()
             self.assertIn(10, data['moved'])
             self.assertEqual(len(data['skipped']), 0)
             self.assertEqual(len(data['errors']), 0)
 
-            mock_db.session.add.assert_called_once()
-            mock_db.session.delete.assert_called_once_with(source_enrollment)
+            self.assertEqual(mock_db.session.execute.call_count, 3)
+            self.assertIsInstance(mock_db.session.execute.call_args_list[2][0][0], Update)
+            mock_db.session.add.assert_not_called()
+            mock_db.session.delete.assert_not_called()
             mock_db.session.commit.assert_called_once()
+            changes = mock_entity_change.log.call_args[0][1]
+            self.assertEqual(changes, [('enrollment', 'deleted', 1, 10), ('enrollment', 'created', 2, 10)])
         finally:
             patcher.stop()
 
+    @patch('bcource.admin_api.enrollments.EntityChange')
+    @patch('bcource.admin_api.enrollments.UserChange')
     @patch('bcource.admin_api.enrollments.db')
-    @patch('bcource.admin_api.enrollments.TrainingEnroll')
     @patch('bcource.admin_api.enrollments.Training')
-    def test_bulk_copy(self, mock_training_cls, mock_enroll_cls, mock_db):
-        """Copy operation: source enrollment should NOT be deleted."""
+    def test_bulk_copy(self, mock_training_cls, mock_db, mock_user_change, mock_entity_change):
+        """Copy operation: target rows are inserted with one INSERT, the source is kept."""
         patcher = self._auth_patch()
         try:
-            mock_training_cls.query.get_or_404.return_value = Mock(id=1)
-            mock_training_cls.query.get.return_value = Mock(id=2)
-
-            source_enrollment = Mock(status='enrolled', paid=False)
-
-            def filter_by_side_effect(**kwargs):
-                result = Mock()
-                if kwargs.get('training_id') == 1:
-                    result.first.return_value = source_enrollment
-                elif kwargs.get('training_id') == 2:
-                    result.first.return_value = None
-                return result
-
-            mock_enroll_cls.query.filter_by.side_effect = filter_by_side_effect
-
-            resp = self.client.post('/admin-api/trainings/1/enrollments/bulk-move',
-                data=json.dumps({
-                    'student_ids': [10],
-                    'target_training_id': 2,
-                    'operation': 'copy',
-                }),
-                content_type='application/json')
+            source = Mock(student_id=10, status='enrolled', paid=False, waitlist_position=None, waitlist_opt_out=False)
+            self._mock_queries(mock_training_cls, mock_db, [source], [])
 
-            self.assertEqual(resp.status_code, 200)
-            data = json.loads(resp.data)
+            data = self._post_bulk_move(operation='copy')
             self.assertIn(10, data['moved'])
 
-            mock_db.session.add.assert_called_once()
+            statement, rows = mock_db.session.execute.call_args_list[2][0]
+            self.assertTrue(statement.is_insert)
+            self.assertEqual([(r['student_id'], r['training_id'], r['status'], r['paid']) for r in rows],
+                             [(10, 2, 'enrolled', False)])
             mock_db.session.delete.assert_not_called()  # Copy doesn't delete
+            changes = mock_entity_change.log.call_args[0][1]
+            self.assertEqual(changes, [('enrollment', 'created', 2, 10)])
         finally:
             patcher.stop()
 
     @patch('bcource.admin_api.enrollments.db')
-    @patch('bcource.admin_api.enrollments.TrainingEnroll')
     @patch('bcource.admin_api.enrollments.Training')
-    def test_bulk_move_skips_existing(self, mock_training_cls, mock_enroll_cls, mock_db):
+    def test_bulk_move_skips_existing(self, mock_training_cls, mock_db):
         """Students already in target training should be skipped."""
         patcher = self._auth_patch()
         try:
-            mock_training_cls.query.get_or_404.return_value = Mock(id=1)
-            mock_training_cls.query.get.return_value = Mock(id=2)
-
-            source_enrollment = Mock(status='enrolled', paid=True)
-            target_existing = Mock(status='enrolled')
-
-            def filter_by_side_effect(**kwargs):
-                result = Mock()
-                if kwargs.get('training_id') == 1:
-                    result.first.return_value = source_enrollment
-                elif kwargs.get('training_id') == 2:
-                    result.first.return_value = target_existing  # Already exists
-                return result
-
-            mock_enroll_cls.query.filter_by.side_effect = filter_by_side_effect
-
-            resp = self.client.post('/admin-api/trainings/1/enrollments/bulk-move',
-                data=json.dumps({
-                    'student_ids': [10],
-                    'target_training_id': 2,
-                    'operation': 'move',
-                }),
-                content_type='application/json')
+            source = Mock(student_id=10, status='enrolled', paid=True, waitlist_position=None, waitlist_opt_out=False)
+            target_existing = Mock(student_id=10, status='enrolled', waitlist_position=None)
+            self._mock_queries(mock_training_cls, mock_db, [source], [target_existing])
 
-            self.assertEqual(resp.status_code, 200)
-            data = json.loads(resp.data)
+            data = self._post_bulk_move()
             self.assertIn(10, data['skipped'])
             self.assertEqual(len(data['moved']), 0)
+            self.assertEqual(mock_db.session.execute.call_count, 2)  # nothing to write
+        finally:
+            patcher.stop()
+
+    @patch('bcource.admin_api.enrollments.EntityChange')
+    @patch('bcource.admin_api.enrollments.UserChange')
+    @patch('bcource.admin_api.enrollments.db')
+    @patch('bcource.admin_api.enrollments.Training')
+    def test_bulk_move_full_target(self, mock_training_cls, mock_db, mock_user_change, mock_entity_change):
+        """A full target rejects enrolled students unless waitlist_when_full is set."""
+        patcher = self._auth_patch()
+        try:
+            source = Mock(student_id=10, status='enrolled', paid=True, waitlist_position=None, waitlist_opt_out=False)
+            taken = Mock(student_id=11, status='enrolled', waitlist_position=None)
+            queued = Mock(student_id=12, status='waitlist', waitlist_position=1)
+
+            self._mock_queries(mock_training_cls, mock_db, [source], [taken, queued], max_participants=1)
+            data = self._post_bulk_move()
+            self.assertEqual(data['moved'], [])
+            self.assertEqual(data['errors'], ['Student 10: target training is full'])
+
+            mock_db.reset_mock()
+            self._mock_queries(mock_training_cls, mock_db, [source], [taken, queued], max_participants=1)
+            data = self._post_bulk_move(waitlist_when_full=True)
+            self.assertEqual(data['moved'], [10])
+            self.assertEqual(data['waitlisted'], [10])
+            statuses = mock_user_change.log_enrollments.call_args[0][1]
+            self.assertEqual(statuses, [(10, 1, None), (10, 2, 'waitlist')])
         finally:
             patcher.stop()
 
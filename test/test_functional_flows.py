@@ -14,6 +14,7 @@ import unittest
 from unittest.mock import patch
 from datetime import datetime, timedelta
 import pytz
+import time
 
 import sys
 import os
@@ -29,11 +30,12 @@ def _import_deferred():
     from bcource.models import (
         Training, TrainingEnroll, TrainingEvent, Student, User,
         Practice, Location, TrainingType, StudentStatus, StudentType,
-        Trainer,
+        Trainer, UserSettings,
     )
     from bcource.students.common import (
         enroll_common, deroll_common, invite_from_waitlist,
         enroll_from_waitlist, deinvite_from_waitlist,
+        invite_from_waitlist_bulk,
     )
     from flask_security import hash_password
 
@@ -696,5 +698,1455 @@ class TestCancelationPolicy(FunctionalTestBase):
         self.assertTrue(result)
 
 
+# ---------------------------------------------------------------------------
+# Flow 12: Waitlist queue positions stay compact
+# ---------------------------------------------------------------------------
+class TestWaitlistQueuePositions(FunctionalTestBase):
+
+    def _waitlist_users(self, count):
+        training = self.create_test_training(max_participants=1)
+        users = []
+        for _ in range(count):
+            u, _ = self.create_test_user_and_student()
+            users.append(u)
+            enroll_common(training, u)
+            training = self.fresh_training(training)
+        return training, users
+
+    def test_positions_assigned_in_order(self):
+        """Waitlisted students get consecutive positions; enrolled have none."""
+        training, users = self._waitlist_users(4)
+
+        self.assertIsNone(self.get_enrollment(training, users[0]).waitlist_position)
+        positions = [self.get_enrollment(training, u).waitlist_position for u in users[1:]]
+        self.assertEqual(positions, [1, 2, 3])
+
+    def test_positions_compacted_when_leaving(self):
+        """Declining from the middle of the queue shifts the entries behind it."""
+        training, users = self._waitlist_users(4)
+
+        enrollment = self.get_enrollment(training, users[2])
+        enrollment.status = 'waitlist-declined'
+        db.session.commit()
+
+        self.assertIsNone(self.get_enrollment(training, users[2]).waitlist_position)
+        self.assertEqual(self.get_enrollment(training, users[1]).waitlist_position, 1)
+        self.assertEqual(self.get_enrollment(training, users[3]).waitlist_position, 2)
+
+        # Head of the queue is invited when the enrolled student cancels
+        training = self.fresh_training(training)
+        deroll_common(training, users[0], admin=False)
+
+        self.assertEqual(self.get_enrollment(training, users[1]).status, 'waitlist-invited')
+        self.assertEqual(self.get_enrollment(training, users[3]).waitlist_position, 1)
+
+    def test_opted_out_students_skipped(self):
+        """Students that disabled transactional emails are skipped for invites."""
+        from bcource.models import UserSettings
+        training, users = self._waitlist_users(3)
+
+        settings = UserSettings(user=users[1], msg_transactional_emails=False)
+        db.session.add(settings)
+        db.session.commit()
+        self.assertTrue(self.get_enrollment(training, users[1]).waitlist_opt_out)
+
+        training = self.fresh_training(training)
+        training.max_participants = 2
+        eligible = list(training.waitlist_enrollments_eligeble())
+
+        self.assertEqual([e.student.user_id for e in eligible], [users[2].id])
+        self.assertEqual(training._spots_waitlist_count, 1)
+
+        db.session.delete(settings)
+        db.session.commit()
+
+
+# ---------------------------------------------------------------------------
+# Flow 13: Bulk waitlist cascade invites all open spots at once
+# ---------------------------------------------------------------------------
+class TestBulkWaitlistInvite(FunctionalTestBase):
+
+    def test_bulk_invite_fills_open_spots(self):
+        """All open spots are invited in one go with one trainer summary."""
+        from bcource.models import Message
+        training = self.create_test_training(max_participants=2)
+        users = []
+        for _ in range(5):
+            u, _ = self.create_test_user_and_student()
+            users.append(u)
+            enroll_common(training, u)
+            training = self.fresh_training(training)
+
+        # Admin removes both enrolled students, no cascade
+        for u in users[:2]:
+            deroll_common(training, u, admin=True)
+            training = self.fresh_training(training)
+
+        from bcource.models import EntityChange
+        last_change = db.session.scalar(db.select(db.func.max(EntityChange.id))) or 0
+        invited = invite_from_waitlist_bulk(training)
+
+        self.assertEqual(len(invited), 2)
+        # the Core UPDATE is logged for the admin API change feed
+        changes = EntityChange.query.filter(EntityChange.id > last_change).all()
+        self.assertEqual(sorted((c.entity, c.op, c.training_id, c.ref_id) for c in changes),
+                         sorted(('enrollment', 'updated', training.id, e.student_id) for e in invited))
+        for u in users[2:4]:
+            e = self.get_enrollment(training, u)
+            self.assertEqual(e.status, 'waitlist-invited')
+            self.assertIsNotNone(e.invite_date)
+            self.assertIsNone(e.waitlist_position)
+
+        e = self.get_enrollment(training, users[4])
+        self.assertEqual(e.status, 'waitlist')
+        self.assertEqual(e.waitlist_position, 1)
+
+        summaries = Message.query.filter(
+            Message.subject == f'Waitlist Invitations Sent - {training.name}').all()
+        self.assertEqual(len(summaries), 1)
+        for m in summaries:
+            db.session.delete(m)
+        db.session.commit()
+
+    def test_bulk_invite_sms_after_the_messages(self):
+        """The invitation SMS go out after the e-mails through notify(), deferred in a deferred_messages() block."""
+        from bcource.messages import deferred_messages, send_deferred
+        training = self.create_test_training(max_participants=1)
+        users = []
+        for i in range(3):
+            u, _ = self.create_test_user_and_student()
+            u.phone_number = f'+3161234{i:04d}'
+            db.session.commit()
+            users.append(u)
+            enroll_common(training, u)
+            training = self.fresh_training(training)
+        deroll_common(training, users[0], admin=True)
+        training = self.fresh_training(training)
+
+        with deferred_messages() as outbox:
+            invited = invite_from_waitlist_bulk(training)
+        self.assertEqual(len(invited), 1)
+        self.mock_sms.assert_not_called()
+
+        send_deferred(outbox)
+        self.mock_sms.assert_called_once()
+        self.assertEqual(self.mock_sms.call_args[0][0], users[1].phone_number)
+
+    def test_bulk_invite_skips_opted_out_students(self):
+        """Students who turned off transactional emails are not invited, as with single invitations."""
+        training = self.create_test_training(max_participants=1)
+        users = []
+        for _ in range(3):
+            u, _ = self.create_test_user_and_student()
+            users.append(u)
+            enroll_common(training, u)
+            training = self.fresh_training(training)
+        settings = users[1].usersettings or UserSettings(user=users[1])
+        settings.msg_transactional_emails = False
+        db.session.add(settings)
+        db.session.commit()
+        # the waitlist_opt_out flag is kept by a flush hook, rows written with Core statements miss it
+        db.session.execute(db.update(TrainingEnroll).where(TrainingEnroll.training_id == training.id)
+                           .values(waitlist_opt_out=False))
+        db.session.commit()
+
+        deroll_common(training, users[0], admin=True)
+        training = self.fresh_training(training)
+        self.mock_email_send.reset_mock()
+        invited = invite_from_waitlist_bulk(training)
+
+        self.assertEqual(invited, [])
+        self.assertEqual(self.get_enrollment(training, users[1]).status, 'waitlist')
+        self.mock_email_send.assert_not_called()
+
+    def test_bulk_invite_nothing_available(self):
+        """No invitations when the training is still full."""
+        training = self.create_test_training(max_participants=1)
+        for _ in range(2):
+            u, _ = self.create_test_user_and_student()
+            enroll_common(training, u)
+            training = self.fresh_training(training)
+
+        self.assertEqual(invite_from_waitlist_bulk(training), [])
+
+
+
+# ---------------------------------------------------------------------------
+# Personal calendar feeds
+# ---------------------------------------------------------------------------
+class TestCalendarFeed(FunctionalTestBase):
+
+    def feed_url(self, user):
+        settings = user.usersettings
+        if not settings:
+            settings = UserSettings(user=user)
+            db.session.add(settings)
+        token = settings.get_calendar_token()
+        db.session.commit()
+        return f'/account/calendar/{token}.ics'
+
+    def test_student_feed_and_conditional_get(self):
+        """The feed lists the enrollment and answers 304 until something changes."""
+        training = self.create_test_training(max_participants=1)
+        user, _ = self.create_test_user_and_student()
+        enroll_common(training, user)
+        url = self.feed_url(user)
+
+        client = self.app.test_client()
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/calendar')
+        self.assertIn(training.name.encode(), response.data)
+        self.assertIn(b'STATUS:CONFIRMED', response.data)
+        etag = response.headers['ETag']
+
+        response = client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        # A second student on the waitlist does not change this feed
+        other, _ = self.create_test_user_and_student()
+        training = self.fresh_training(training)
+        enroll_common(training, other)
+        self.assertEqual(client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+
+        training = self.fresh_training(training)
+        deroll_common(training, user, admin=True)
+        response = client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(training.name.encode(), response.data)
+
+    def test_expired_and_declined_enrollments_are_left_out(self):
+        """Enrollments without a seat are not published as confirmed events."""
+        training = self.create_test_training(max_participants=1)
+        user, _ = self.create_test_user_and_student()
+        enroll_common(training, user)
+        url = self.feed_url(user)
+        client = self.app.test_client()
+        etag = client.get(url).headers['ETag']
+
+        enrollment = self.get_enrollment(training, user)
+        for status in ('waitlist-invite-expired', 'waitlist-declined'):
+            enrollment.status = status
+            db.session.commit()
+            response = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn(training.name.encode(), response.data)
+            self.assertNotIn(b'STATUS:CONFIRMED', response.data)
+
+    def test_trainer_feed(self):
+        """Trainers see the trainings they teach."""
+        training = self.create_test_training(max_participants=1)
+        trainer_user = training.trainers[0].user
+        response = self.app.test_client().get(self.feed_url(trainer_user))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(training.name.encode(), response.data)
+
+    def test_unknown_token(self):
+        response = self.app.test_client().get('/account/calendar/not-a-token.ics')
+        self.assertEqual(response.status_code, 404)
+
+
+
+# ---------------------------------------------------------------------------
+# Trainer notification digest
+# ---------------------------------------------------------------------------
+class TestTrainerDigest(FunctionalTestBase):
+
+    def setUp(self):
+        super().setUp()
+        from bcource.models import AutomationClasses, AutomationSchedule, BeforeAfterEnum, EventsEnum
+        automation_class = AutomationClasses.query.filter_by(class_name='TrainerDigestTask').first()
+        if not automation_class:
+            automation_class = AutomationClasses(class_name='TrainerDigestTask', description='digest',
+                                                 module_path='bcource.automation.automation_tasks',
+                                                 qualified_name='bcource.automation.automation_tasks.TrainerDigestTask')
+            db.session.add(automation_class)
+        self.schedule = AutomationSchedule(name='_functest_trainer_digest', automation_class=automation_class,
+                                           beforeafter=BeforeAfterEnum.after, events=EventsEnum.first,
+                                           interval=timedelta(0), active=True)
+        db.session.add(self.schedule)
+        db.session.commit()
+
+    def tearDown(self):
+        from bcource.models import TrainerNotification
+        TrainerNotification.query.delete()
+        db.session.delete(self.schedule)
+        db.session.commit()
+        super().tearDown()
+
+    def set_cadence(self, user, cadence):
+        settings = user.usersettings or UserSettings(user=user)
+        settings.notification_cadence = cadence
+        db.session.add(settings)
+        db.session.commit()
+
+    def test_notifications_collapsed_into_one_digest(self):
+        """Queued trainer notifications are sent as one message by the digest task."""
+        from bcource.models import Message, TrainerNotification
+        from bcource.automation.automation_tasks import TrainerDigestTask
+
+        training = self.create_test_training(max_participants=1)
+        trainer_user = training.trainers[0].user
+        self.set_cadence(trainer_user, 'hourly')
+
+        for _ in range(2):
+            u, _ = self.create_test_user_and_student()
+            training = self.fresh_training(training)
+            enroll_common(training, u)
+
+        pending = TrainerNotification.pending(trainer_user.id)
+        self.assertEqual(len(pending), 2)
+        self.assertTrue(any(n.email for n in pending))
+
+        due = [item for item in TrainerDigestTask.query() if item.id == trainer_user.id]
+        self.assertEqual(len(due), 1)
+        self.assertAlmostEqual((due[0].due - pending[0].created_date).total_seconds(), 3600, delta=1)
+
+        self.assertTrue(TrainerDigestTask(trainer_user.id, self.schedule.name).execute())
+        self.assertEqual(TrainerNotification.pending(trainer_user.id), [])
+
+        digests = Message.query.filter(Message.subject == 'Training updates (2)').all()
+        self.assertEqual(len(digests), 1)
+        self.assertIn(training.name, digests[0].body)
+        for m in digests:
+            db.session.delete(m)
+        db.session.commit()
+
+    def test_failed_digest_backs_off_and_gives_up(self):
+        """A digest whose delivery fails is retried later, not every minute, and given up after the limit."""
+        from bcource.models import TrainerNotification
+        from bcource.automation.automation_tasks import TrainerDigestTask
+
+        training = self.create_test_training(max_participants=1)
+        trainer_user = training.trainers[0].user
+        self.set_cadence(trainer_user, 'hourly')
+        u, _ = self.create_test_user_and_student()
+        enroll_common(training, u)
+
+        with patch('bcource.messages.SendEmail.send', side_effect=RuntimeError('smtp down')), \
+                patch('bcource.messages.SystemMessage.send', side_effect=RuntimeError('smtp down')):
+            with self.assertRaises(RuntimeError):
+                TrainerDigestTask(trainer_user.id, self.schedule.name).execute()
+        db.session.rollback()
+
+        pending = TrainerNotification.pending(trainer_user.id)
+        self.assertEqual([n.attempts for n in pending], [1])
+        due = [item.due for item in TrainerDigestTask.query() if item.id == trainer_user.id]
+        retry = timedelta(minutes=self.app.config['BCOURSE_TRAINER_DIGEST_RETRY_MINUTES'])
+        self.assertGreaterEqual(due[0], pending[0].attempt_date + retry)
+
+        TrainerNotification.query.filter_by(user_id=trainer_user.id).update(
+            {'attempts': self.app.config['BCOURSE_TRAINER_DIGEST_MAX_ATTEMPTS']})
+        db.session.commit()
+        self.assertEqual(TrainerNotification.pending(trainer_user.id), [])
+        self.assertEqual([item for item in TrainerDigestTask.query() if item.id == trainer_user.id], [])
+
+    def test_bulk_waitlist_summary_queued(self):
+        """The trainer summary of a bulk waitlist invitation goes to the digest, not straight out."""
+        from bcource.models import Message, TrainerNotification
+        training = self.create_test_training(max_participants=1)
+        trainer_user = training.trainers[0].user
+        self.set_cadence(trainer_user, 'daily')
+        users = []
+        for _ in range(2):
+            u, _ = self.create_test_user_and_student()
+            users.append(u)
+            enroll_common(training, u)
+            training = self.fresh_training(training)
+        deroll_common(training, users[0], admin=True)
+        TrainerNotification.query.delete()
+        db.session.commit()
+
+        last_message = db.session.scalar(db.select(db.func.max(Message.id))) or 0
+        invited = invite_from_waitlist_bulk(self.fresh_training(training))
+        self.assertEqual(len(invited), 1)
+        self.assertEqual([n.subject for n in TrainerNotification.pending(trainer_user.id)],
+                         [f'Waitlist Invitations Sent - {training.name}'])
+        self.assertEqual(Message.query.filter(Message.id > last_message,
+                                              Message.subject == f'Waitlist Invitations Sent - {training.name}').count(), 0)
+
+    def test_immediate_cadence_not_queued(self):
+        """Trainers who opt in to immediate delivery are not queued."""
+        from bcource.models import TrainerNotification
+        training = self.create_test_training(max_participants=1)
+        trainer_user = training.trainers[0].user
+        self.set_cadence(trainer_user, 'immediate')
+
+        u, _ = self.create_test_user_and_student()
+        enroll_common(training, u)
+        self.assertEqual(TrainerNotification.pending(trainer_user.id), [])
+
+
+
+# ---------------------------------------------------------------------------
+# Inbox bulk actions
+# ---------------------------------------------------------------------------
+class TestInboxBulkActions(FunctionalTestBase):
+
+    def setUp(self):
+        super().setUp()
+        from bcource.models import Message
+        from flask import g
+        g.is_mobile = False
+        self.user, _ = self.create_test_user_and_student()
+        sender, _ = self.create_test_user_and_student()
+        self.messages = Message.create_db_messages(db.session, [
+            dict(envelop_from=sender, envelop_to=[self.user], subject=f'_functest subject {i}',
+                 body=f'<p>_functest {"invoice" if i % 2 else "hello"} {i}</p>',
+                 tags=['_functest_even'] if i % 2 == 0 else [])
+            for i in range(6)])
+
+    def tearDown(self):
+        for m in self.messages:
+            db.session.delete(m)
+        db.session.commit()
+        super().tearDown()
+
+    def clauses(self, query):
+        from werkzeug.datastructures import MultiDict
+        from urllib.parse import parse_qsl
+        from bcource.user.user_views import make_filters, message_filter_clauses
+        args = MultiDict(parse_qsl(query))
+        filters = make_filters(mailbox='inbox').process_filters(args)
+        return message_filter_clauses(self.user, filters, args.get('q', None))
+
+    def test_action_by_ids(self):
+        from bcource.models import UserMessageAssociation
+        from bcource.user.user_views import bulk_message_action
+        self.assertEqual(self.user.unread_messages, 6)
+        ids = [m.id for m in self.messages[:2]]
+        clauses = [UserMessageAssociation.user_id == self.user.id,
+                   UserMessageAssociation.message_id.in_(ids)]
+        self.assertEqual(bulk_message_action('read', clauses), 2)
+        # already read rows are not touched again
+        self.assertEqual(bulk_message_action('read', clauses), 0)
+        db.session.commit()
+        self.assertEqual(self.user.unread_messages, 4)
+        self.assertIsNone(bulk_message_action('archive', clauses))
+
+    def test_action_by_filter_set(self):
+        from bcource.models import MessageTag
+        from bcource.user.user_views import bulk_message_action
+        self.assertEqual(bulk_message_action('read', self.clauses('q=invoice')), 3)
+        db.session.commit()
+        self.assertEqual(self.user.unread_messages, 3)
+
+        tag_id = MessageTag.get_tag_ids(['_functest_even'])['_functest_even']
+        self.assertEqual(bulk_message_action('delete', self.clauses(f'tag={tag_id}')), 3)
+        db.session.commit()
+        self.assertEqual(self.user.unread_messages, 0)
+
+        self.assertEqual(bulk_message_action('undelete', self.clauses('read=3')), 3)
+        self.assertEqual(bulk_message_action('unread', self.clauses('read=1')), 3)
+        db.session.commit()
+        self.assertEqual(self.user.unread_messages, 6)
+
+    def test_counter_follows_orm_changes(self):
+        from bcource.models import UserMessageAssociation
+        from datetime import datetime
+        rows = db.session.query(UserMessageAssociation).filter_by(user_id=self.user.id).all()
+        rows[0].message_read = datetime.utcnow()
+        rows[1].message_deleted = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(self.user.unread_messages, 4)
+
+        rows[1].message_deleted = None
+        db.session.delete(rows[2])
+        db.session.commit()
+        self.assertEqual(self.user.unread_messages, 4)
+
+    def test_adjust_creates_and_adds_to_counters(self):
+        from bcource.models import UserMessageCounter
+        from sqlalchemy import delete
+        db.session.execute(delete(UserMessageCounter).where(UserMessageCounter.user_id == self.user.id))
+        UserMessageCounter.adjust(db.session, {self.user.id: 2})
+        UserMessageCounter.adjust(db.session, {self.user.id: 3})
+        db.session.commit()
+        self.assertEqual(db.session.get(UserMessageCounter, self.user.id).unread_count, 5)
+
+    def test_reconcile(self):
+        from bcource.models import UserMessageCounter
+        from sqlalchemy import update
+        db.session.execute(update(UserMessageCounter).where(
+            UserMessageCounter.user_id == self.user.id).values(unread_count=42))
+        db.session.commit()
+        self.assertGreaterEqual(UserMessageCounter.reconcile(db.session), 1)
+        db.session.expire_all()
+        self.assertEqual(self.user.unread_messages, 6)
+        self.assertEqual(UserMessageCounter.reconcile(db.session), 0)
+
+
+
+class TestMessageSearch(FunctionalTestBase):
+
+    def setUp(self):
+        super().setUp()
+        from bcource.models import Message
+        self.user, _ = self.create_test_user_and_student()
+        sender, _ = self.create_test_user_and_student()
+        contents = [('Nieuwe trainingen', '<p>Er zijn nieuwe <b>trainingen</b> gepland.</p>'),
+                    ('Invoice', '<p>Your invoice for the training at the caf&eacute;</p>'),
+                    ('Reminder', '<p>Reminder: training tomorrow, see you at the Café</p>'),
+                    ('Hello', '<p>Nothing to see here</p>')]
+        self.messages = Message.create_db_messages(db.session, [
+            dict(envelop_from=sender, envelop_to=[self.user], subject=f'_functest {subject}', body=body)
+            for subject, body in contents])
+
+    def tearDown(self):
+        for m in self.messages:
+            db.session.delete(m)
+        db.session.commit()
+        super().tearDown()
+
+    def search(self, user_q):
+        from bcource.models import MessageSearchToken, UserMessageAssociation
+        ranked = MessageSearchToken.search(user_q)
+        rows = db.session.execute(db.select(ranked.c.message_id)
+                                  .join(UserMessageAssociation, UserMessageAssociation.message_id == ranked.c.message_id)
+                                  .where(UserMessageAssociation.user_id == self.user.id)
+                                  .order_by(ranked.c.rank.desc(), ranked.c.message_id)).scalars().all()
+        subjects = {m.id: m.subject.replace('_functest ', '') for m in self.messages}
+        return [subjects[message_id] for message_id in rows]
+
+    def test_stemming_and_ranking(self):
+        """Dutch and English forms of a word match, subject matches rank first."""
+        self.assertEqual(self.search('trainingen'), ['Nieuwe trainingen', 'Invoice', 'Reminder'])
+        self.assertEqual(self.search('Training'), self.search('trainings'))
+
+    def test_all_terms_accents_and_html(self):
+        self.assertEqual(self.search('cafe training'), ['Invoice', 'Reminder'])
+        self.assertEqual(self.search('CAFÉ invoice'), ['Invoice'])
+        # tag names are not indexed
+        self.assertEqual(self.search('b'), [])
+        self.assertEqual(self.search('nothing'), ['Hello'])
+
+    def test_inbox_filter_uses_index(self):
+        from bcource.user.user_views import message_filter_clauses, make_filters
+        from bcource.models import UserMessageAssociation
+        from werkzeug.datastructures import MultiDict
+        from flask import g
+        g.is_mobile = False
+        filters = make_filters(mailbox='inbox').process_filters(MultiDict())
+        clauses = message_filter_clauses(self.user, filters, 'reminder')
+        ids = db.session.scalars(db.select(UserMessageAssociation.message_id).where(*clauses)).all()
+        self.assertEqual(ids, [self.messages[2].id])
+
+    def test_inbox_list_runs_the_search_once(self):
+        from bcource.user.user_views import make_message_select, make_filters
+        from werkzeug.datastructures import MultiDict
+        from flask import g
+        g.is_mobile = False
+        filters = make_filters(mailbox='inbox').process_filters(MultiDict())
+        with patch('bcource.user.user_views.current_user', self.user):
+            q = make_message_select(filters, 'reminder')
+            self.assertEqual([row.message_id for row in q], [self.messages[2].id])
+        self.assertEqual(str(q.statement).count('FROM message_search_token'), 1)
+
+    def test_fulltext_not_used_for_compressed_bodies(self):
+        from bcource.models import MessageSearchToken
+        with patch.object(db.engine.dialect, 'name', 'mysql'), \
+                patch.dict(self.app.config, BCOURSE_MESSAGE_SEARCH_FULLTEXT=True):
+            with patch.dict(self.app.config, BCOURSE_MESSAGE_BODY_COMPRESS_MIN=0):
+                self.assertTrue(MessageSearchToken.fulltext())
+            with patch.dict(self.app.config, BCOURSE_MESSAGE_BODY_COMPRESS_MIN=1024):
+                self.assertFalse(MessageSearchToken.fulltext())
+
+
+class TestMessageRetention(FunctionalTestBase):
+
+    def setUp(self):
+        super().setUp()
+        import tempfile
+        from bcource.models import Message, MessageTag
+        self.archive_dir = tempfile.mkdtemp()
+        self.user, _ = self.create_test_user_and_student()
+        sender, _ = self.create_test_user_and_student()
+        self.messages = Message.create_db_messages(db.session, [
+            dict(envelop_from=sender, envelop_to=[self.user], subject=f'_functest retention {i}',
+                 body=f'<p>_functest retention {i}</p>', tags=[tag])
+            for i, tag in enumerate(['_functest_short', '_functest_short', '_functest_keep', '_functest_short'])])
+        self.ids = [m.id for m in self.messages]
+        tag_ids = MessageTag.get_tag_ids(['_functest_short'])
+        db.session.get(MessageTag, tag_ids['_functest_short']).retention_days = 7
+        # the first two messages are old, the last one is recent
+        for message in self.messages[:3]:
+            message.created_date = datetime.utcnow() - timedelta(days=30)
+        db.session.commit()
+
+    def tearDown(self):
+        import shutil
+        from bcource.models import Message, MessageTag
+        db.session.rollback()
+        for message in db.session.scalars(db.select(Message).where(Message.id.in_(self.ids))):
+            db.session.delete(message)
+        MessageTag.query.filter(MessageTag.tag.like('_functest%')).update({'retention_days': None})
+        db.session.commit()
+        shutil.rmtree(self.archive_dir)
+        super().tearDown()
+
+    def test_archive_and_purge(self):
+        """Old messages with a tag policy are archived and purged in batches, the rest stays."""
+        import gzip, json
+        from bcource.message_retention import MessageRetention
+        from bcource.models import Message, UserMessageAssociation
+        self.assertEqual(self.user.unread_messages, 4)
+
+        retention = MessageRetention(archive_dir=self.archive_dir)
+        retention.batch_size, retention.sleep = 1, 0
+        report = retention.run()
+
+        self.assertEqual(report['messages_archived'], 2)
+        self.assertEqual(report['recipients_purged'], 2)
+        self.assertGreaterEqual(report['batches'], 3)
+        remaining = db.session.scalars(db.select(Message.id).where(Message.id.in_(self.ids))).all()
+        self.assertEqual(remaining, self.ids[2:])
+        self.assertEqual(UserMessageAssociation.query.filter_by(user_id=self.user.id).count(), 2)
+        self.assertEqual(self.user.unread_messages, 2)
+
+        with gzip.open(report['archive'], 'rt', encoding='utf-8') as archive:
+            lines = [json.loads(line) for line in archive]
+        self.assertEqual([line['id'] for line in lines], self.ids[:2])
+        self.assertEqual(lines[0]['tags'], ['_functest_short'])
+        self.assertIn('_functest retention 0', lines[0]['body'])
+        self.assertEqual(lines[0]['recipients'][0]['user_id'], self.user.id)
+
+        # nothing left to do on the next run
+        self.assertEqual(MessageRetention(archive_dir=self.archive_dir).run()['messages_archived'], 0)
+
+    def test_tags_without_policy_use_the_default(self):
+        """A tag without a policy counts with the default retention, it does not leave the message to the other tags."""
+        from bcource.message_retention import MessageRetention
+        from bcource.models import MessageTag
+        tag_ids = MessageTag.get_tag_ids(['_functest_short', '_functest_keep'])
+        old = datetime.utcnow() - timedelta(days=30)
+        rows = [(1, old), (2, old), (3, old)]
+        tag_rows = [(1, tag_ids['_functest_short']), (1, tag_ids['_functest_keep']), (2, tag_ids['_functest_short'])]
+
+        retention = MessageRetention(archive_dir=self.archive_dir)
+        policies = retention.policies()
+        for default_days, expired in ((0, [2]), (60, [2]), (10, [1, 2, 3])):
+            retention.default_days = default_days
+            self.assertEqual(retention.expired(rows, tag_rows, policies), expired)
+
+        # a policy of 0 keeps the message whatever the other tags say
+        retention.default_days = 10
+        self.assertEqual(retention.expired(rows, tag_rows, {**policies, tag_ids['_functest_keep']: 0}), [2, 3])
+
+    def test_purge_deleted_recipients(self):
+        from bcource.message_retention import MessageRetention
+        from bcource.models import UserMessageAssociation, MessageTag
+        MessageTag.query.filter(MessageTag.tag.like('_functest%')).update({'retention_days': None})
+        row = UserMessageAssociation.query.filter_by(user_id=self.user.id, message_id=self.ids[2]).one()
+        row.message_deleted = datetime.utcnow() - timedelta(days=60)
+        db.session.commit()
+
+        report = MessageRetention(archive_dir=self.archive_dir).run()
+        self.assertEqual(report['messages_archived'], 0)
+        self.assertEqual(report['deleted_purged'], 1)
+        self.assertEqual(UserMessageAssociation.query.filter_by(user_id=self.user.id).count(), 3)
+
+
+class TestMessageThreads(FunctionalTestBase):
+
+    def setUp(self):
+        super().setUp()
+        from bcource.models import Message
+        self.user, _ = self.create_test_user_and_student()
+        self.support, _ = self.create_test_user_and_student()
+        self.messages = []
+        parent = None
+        for i in range(5):
+            sender, recipient = (self.user, self.support) if i % 2 == 0 else (self.support, self.user)
+            parent = Message.create_db_message(db.session, sender, [recipient], f'_functest thread {i}',
+                                               f'<p>_functest thread {i}</p>', in_reply_to=parent)
+            self.messages.append(parent)
+
+    def tearDown(self):
+        for m in reversed(self.messages):
+            db.session.delete(m)
+        db.session.commit()
+        super().tearDown()
+
+    def test_thread_root(self):
+        root = self.messages[0]
+        self.assertIsNone(root.thread_root_id)
+        self.assertEqual({m.thread_root_id for m in self.messages[1:]}, {root.id})
+        self.assertEqual({m.thread_id for m in self.messages}, {root.id})
+
+    def test_thread_page_single_query(self):
+        """A page of the conversation is read with one query after the access check."""
+        from sqlalchemy import event
+        from bcource.user.user_views import thread_page
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        message_id, user = self.messages[3].id, self.user
+        db.session.expire_all()
+        user.id  # reload the user before counting
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            page = thread_page(message_id, user, page=1, per_page=3)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertEqual(len(statements), 2)
+        self.assertEqual([m['id'] for m in page['messages']], [m.id for m in self.messages[:3]])
+        self.assertTrue(page['has_next'])
+        self.assertEqual([m['is_sent'] for m in page['messages']], [True, False, True])
+
+        page = thread_page(self.messages[0].id, self.user, page=2, per_page=3)
+        self.assertEqual([m['id'] for m in page['messages']], [m.id for m in self.messages[3:]])
+        self.assertFalse(page['has_next'])
+
+    def test_thread_access(self):
+        from bcource.user.user_views import thread_page
+        outsider, _ = self.create_test_user_and_student()
+        self.assertIsNone(thread_page(self.messages[0].id, outsider))
+
+
+class TestStudentRecords(FunctionalTestBase):
+
+    def create_user(self, suffix):
+        from bcource import security
+        email = f'functest_{suffix}@test.local'
+        self._test_user_emails.append(email)
+        user = security.datastore.create_user(email=email, password=hash_password('TestPass123!'),
+                                              first_name='Func', last_name=suffix, active=True)
+        db.session.commit()
+        return user
+
+    def test_student_created_on_register(self):
+        from flask_security.signals import user_registered
+        user = self.create_user('reg01')
+        self.assertEqual(user.students, [])
+        user_registered.send(self.app, user=user, confirmation_token=None, form_data={})
+        self.assertEqual(len(user.students), 1)
+        self.assertEqual(user.students[0].practice.shortname, Practice.default_row().shortname)
+
+        # confirming later does not add a second record
+        from flask_security.signals import user_confirmed
+        user_confirmed.send(self.app, user=user)
+        db.session.expire_all()
+        self.assertEqual(len(user.students), 1)
+
+    def test_list_is_read_only_and_reconcile_fills_gaps(self):
+        from flask import g
+        from bcource.students.students_views import students_query, make_filters
+        g.is_mobile = False
+        user = self.create_user('rec01')
+
+        students_query(make_filters().process_filters()).all()
+        self.assertEqual(Student.query.filter_by(user_id=user.id).count(), 0)
+
+        self.assertIn(user.id, Student.missing_user_ids())
+        self.assertGreaterEqual(Student.create_missing(), 1)
+        self.assertEqual(Student.query.filter_by(user_id=user.id).count(), 1)
+        self.assertEqual(Student.create_missing(), 0)
+
+
+class TestUserSearch(FunctionalTestBase):
+
+    def create_user(self, suffix, first_name, last_name):
+        from bcource import security
+        email = f'functest_{suffix}@test.local'
+        self._test_user_emails.append(email)
+        user = security.datastore.create_user(email=email, password=hash_password('TestPass123!'),
+                                              first_name=first_name, last_name=last_name, active=True)
+        db.session.commit()
+        return user
+
+    def search(self, user_q):
+        from bcource.models import UserSearchToken
+        clause, rank = UserSearchToken.match(user_q)
+        return [user.email for user in User.query.filter(clause, User.email.like('functest_us%'))
+                .order_by(rank, User.first_name, User.last_name).all()]
+
+    def test_key_and_tokens_maintained(self):
+        from sqlalchemy import select
+        from bcource.models import UserSearchToken
+        user = self.create_user('us01', 'José', 'van Dijk')
+        self.assertEqual(user.search_key, 'jose van dijk functest us01 test local')
+        self.assertIn('jose', [row.token for row in user.search_tokens])
+
+        user.first_name = 'Joost'
+        db.session.commit()
+        tokens = set(db.session.scalars(select(UserSearchToken.token).where(UserSearchToken.user_id == user.id)))
+        self.assertIn('joost', tokens)
+        self.assertNotIn('jose', tokens)
+
+    def test_collation_equal_spellings_fold_to_one_token(self):
+        """Spellings the database collation compares equal must not become two primary keys."""
+        user = self.create_user('us09', 'Søren', 'Straße Strasse')
+        self.assertEqual(user.search_key, 'soren strasse functest us09 test local')
+        self.assertEqual([self.search(q) for q in ('sør', 'STRASS')], [[user.email], [user.email]])
+
+    def test_ranked_prefix_matching(self):
+        self.create_user('us02', 'Jan', 'Smit')
+        self.create_user('us03', 'Janet', 'Bakker')
+        self.create_user('us04', 'Piet', 'Jansen')
+
+        # exact word, then start of the key, then a later word
+        self.assertEqual(self.search('JAN'), ['functest_us02@test.local', 'functest_us03@test.local',
+                                              'functest_us04@test.local'])
+        self.assertEqual(self.search('piet jan'), ['functest_us04@test.local'])
+        self.assertEqual(self.search('ane'), [])
+
+        from bcource.models import UserSearchToken
+        self.assertEqual(UserSearchToken.match(' - '), (None, None))
+
+    def test_lookup_cache_cleared_on_change(self):
+        from bcource.models import user_search_cache
+        user = self.create_user('us05', 'Karel', 'Appel')
+        calls = []
+        lookup = lambda key: calls.append(key) or self.search('karel')
+        self.assertEqual(user_search_cache.get('karel', lookup, 60), ['functest_us05@test.local'])
+        user_search_cache.get('karel', lookup, 60)
+        self.assertEqual(len(calls), 1)
+
+        user.last_name = 'Doorman'
+        db.session.commit()
+        user_search_cache.get('karel', lookup, 60)
+        self.assertEqual(len(calls), 2)
+
+
+class TestExports(FunctionalTestBase):
+
+    def download(self, view, url, **kwargs):
+        from flask import g
+        with self.app.test_request_context(url):
+            g.is_mobile = False
+            response = view(**kwargs)
+            self.assertTrue(response.is_streamed)
+            return b''.join(response.response)
+
+    def test_student_export_csv_and_xlsx(self):
+        import csv, io, zipfile
+        from bcource.students.students_views import export
+        user, student = self.create_test_user_and_student()
+        user.first_name = '=cmd'
+        db.session.commit()
+
+        rows = list(csv.reader(io.StringIO(self.download(export, '/students/export.csv', fmt='csv').decode('utf-8-sig'))))
+        self.assertEqual(rows[0][:4], ['Id', 'First name', 'Last name', 'Email'])
+        row = [r for r in rows if r[0] == str(student.id)][0]
+        self.assertEqual(row[1:4], ["'=cmd", user.last_name, user.email])
+
+        workbook = zipfile.ZipFile(io.BytesIO(self.download(export, '/students/export.xlsx', fmt='xlsx')))
+        self.assertIsNone(workbook.testzip())
+        sheet = workbook.read('xl/worksheets/sheet1.xml').decode('utf-8')
+        self.assertIn(f'<c><v>{student.id}</v></c>', sheet)
+        self.assertIn(user.email, sheet)
+
+    def test_enrollment_and_attendance_export(self):
+        import csv, io
+        from bcource.students.students_views import attendance_export
+        from bcource.training.training_detail_view import training_export
+        training = self.create_test_training(max_participants=5)
+        user, student = self.create_test_user_and_student()
+        enroll_common(training, user)
+
+        rows = list(csv.reader(io.StringIO(self.download(
+            training_export, f'/training/training-detail/{training.id}/export.csv', id=training.id, fmt='csv').decode('utf-8-sig'))))
+        self.assertEqual([(r[0], r[5]) for r in rows[1:]], [(str(student.id), 'enrolled')])
+
+        url = f'/students/attendance.csv?id={student.id}'
+        self.assertEqual(len(self.download(attendance_export, url, fmt='csv').decode('utf-8-sig').splitlines()), 1)
+
+        # once the training is over it is part of the attendance history
+        past = datetime.now(tz=pytz.UTC) - timedelta(days=7)
+        TrainingEvent.query.filter_by(training_id=training.id).update(dict(start_time=past, end_time=past + timedelta(hours=2)))
+        db.session.commit()
+        rows = list(csv.reader(io.StringIO(self.download(attendance_export, url, fmt='csv').decode('utf-8-sig'))))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][2:5], [training.name, training.trainingtype.name, str(student.id)])
+
+
+class TestStudentImport(FunctionalTestBase):
+
+    CSV = ('''Email;First Name;Last Name;Phone Number;Birthday;Postal Code;House Number;Shoe size
+functest_imp01@example.com;Anna;Jansen;06 12345678;1990-02-01;1234 ab;5;42
+functest_imp02@example.com;Bert;de Vries;+31612345679;;;;
+not-an-email;Carla;Bakker;;;;;
+functest_imp03@example.com;Dirk;Smit;06 12345678;;;;
+functest_imp04@example.com;Eva;Visser;;32-13-2000;;;
+''')
+
+    def setUp(self):
+        super().setUp()
+        self._test_user_emails.extend(f'functest_imp0{i}@example.com' for i in range(1, 5))
+
+    def run_import(self, **kwargs):
+        from bcource.students.student_import import StudentImport
+        return StudentImport(self.CSV, **kwargs).run()
+
+    def test_dry_run_reports_without_writing(self):
+        report = self.run_import(dry_run=True)
+        self.assertTrue(report['done'])
+        self.assertEqual((report['rows'], report['created'], report['existing']), (5, 2, 0))
+        self.assertEqual([line for line, _message in report['errors']], [4, 5, 6])
+        self.assertIn((1, 'ignored columns: Shoe size'), report['warnings'])
+        self.assertIsNone(User.query.filter_by(email='functest_imp01@example.com').first())
+
+    def test_abandoned_uploads_expire(self):
+        import tempfile
+        from bcource.students.student_import import expire_uploads
+        with tempfile.TemporaryDirectory() as directory:
+            old, recent = os.path.join(directory, 'old.csv'), os.path.join(directory, 'recent.csv')
+            for path in (old, recent):
+                with open(path, 'w') as f:
+                    f.write(self.CSV)
+            age = self.app.config['BCOURSE_IMPORT_UPLOAD_MAX_AGE'] + 60
+            os.utime(old, (time.time() - age, time.time() - age))
+
+            expire_uploads(directory)
+            self.assertEqual(os.listdir(directory), ['recent.csv'])
+
+    def test_import_creates_users_and_resumes(self):
+        with patch.dict(self.app.config, BCOURSE_IMPORT_CHUNK_SIZE=1, BCOURSE_IMPORT_MAX_SECONDS=0):
+            report = self.run_import(dry_run=False)
+
+        # the time budget is spent after the first chunk, the next request continues
+        self.assertFalse(report['done'])
+        self.assertEqual((report['created'], report['next_line']), (1, 3))
+        report = self.run_import(dry_run=False, start_line=report['next_line'])
+        self.assertTrue(report['done'])
+        self.assertEqual(report['created'], 1)
+
+        user = User.query.filter_by(email='functest_imp01@example.com').one()
+        self.assertEqual((user.phone_number, user.postal_code, str(user.birthday)), ('+31612345678', '1234AB', '1990-02-01'))
+        self.assertEqual(len(user.students), 1)
+        self.assertEqual(user.usersettings.language, 'en')
+        self.assertEqual(user.search_key, 'anna jansen functest imp01 example com')
+
+        # running the whole file again only skips the existing users
+        report = self.run_import(dry_run=False)
+        self.assertEqual((report['created'], report['existing']), (0, 2))
+
+
+class TestFacetCounts(FunctionalTestBase):
+
+    def setUp(self):
+        super().setUp()
+        from flask import g
+        from bcource.filters import facet_cache
+        g.is_mobile = False
+        facet_cache.clear()
+
+    def counts(self, filters, id):
+        return {str(item.id): item.count for item in filters.get_filter(id)}
+
+    def test_student_counts_follow_other_facets(self):
+        from werkzeug.datastructures import MultiDict
+        from bcource.students.students_views import make_filters
+        _user, student = self.create_test_user_and_student()
+        status, studenttype = str(student.studentstatus_id), str(student.studenttype_id)
+
+        counts = self.counts(make_filters().process_filters(MultiDict()), 'studentstatus')
+        self.assertEqual(counts[status], Student.query.filter_by(practice_id=student.practice_id,
+                                                                 studentstatus_id=student.studentstatus_id).count())
+
+        # checking a type narrows the status counts, not the type counts
+        other = StudentType.query.filter(StudentType.id != student.studenttype_id).first()
+        if other:
+            filters = make_filters().process_filters(MultiDict([('studenttype', str(other.id))]))
+            self.assertEqual(self.counts(filters, 'studentstatus')[status], Student.query.filter_by(
+                practice_id=student.practice_id, studentstatus_id=student.studentstatus_id,
+                studenttype_id=other.id).count())
+            self.assertEqual(self.counts(filters, 'studenttype')[studenttype], Student.query.filter_by(
+                practice_id=student.practice_id, studenttype_id=student.studenttype_id).count())
+
+        # options and rows come from the cache within the TTL
+        with patch('bcource.students.students_views.reference_data') as reference_data:
+            make_filters().process_filters(MultiDict())
+            reference_data.assert_not_called()
+
+    def test_training_and_enrollment_counts(self):
+        from werkzeug.datastructures import MultiDict
+        from bcource.scheduler.scheduler_views import make_filters as scheduler_filters
+        from bcource.training.training_detail_view import make_filters as training_filters
+        training = self.create_test_training(max_participants=1)
+        for _n in range(2):
+            user, _student = self.create_test_user_and_student()
+            enroll_common(training, user)
+            training = self.fresh_training(training)
+
+        filters = scheduler_filters().process_filters(MultiDict())
+        self.assertGreaterEqual(self.counts(filters, 'training_type')[str(training.trainingtype_id)], 1)
+        self.assertIsNotNone(self.counts(filters, 'period')['1'])
+
+        # checking "my" counts only the trainings the user is enrolled in
+        filters = scheduler_filters(user).process_filters(MultiDict())
+        self.assertEqual(self.counts(filters, 'my'), {str(user.id): 1})
+        filters = scheduler_filters(user).process_filters(MultiDict([('my', str(user.id))]))
+        self.assertEqual(self.counts(filters, 'training_type')[str(training.trainingtype_id)], 1)
+        self.assertEqual(sum(self.counts(filters, 'training_type').values()), 1)
+
+        filters = training_filters(training).process_filters(MultiDict())
+        self.assertEqual(self.counts(filters, 'waitlist'), {'1': 1})
+        self.assertEqual(sum(self.counts(filters, 'studenttype').values()), 2)
+
+        filters = training_filters(training).process_filters(MultiDict([('waitlist', '1')]))
+        self.assertEqual(sum(self.counts(filters, 'studenttype').values()), 1)
+
+class TestReferenceData(FunctionalTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self._test_trainingtype_ids = []
+
+    def tearDown(self):
+        from bcource.models import Policy
+        Policy.query.filter(Policy.name.like('_functest%')).delete(synchronize_session=False)
+        for trainingtype_id in self._test_trainingtype_ids:
+            TrainingType.query.filter_by(id=trainingtype_id).delete()
+        db.session.commit()
+        super().tearDown()
+
+    def reference_data(self):
+        """reference_data() as in a new request, the version is read once per request."""
+        from flask import g
+        from bcource.reference_data import reference_data
+        g.pop('reference_versions', None)
+        return reference_data()
+
+    def test_snapshots_are_read_only(self):
+        data = self.reference_data()
+        self.assertTrue(data.studentstatuses)
+        status = data.studentstatuses[0]
+        self.assertEqual(str(status), status.name)
+        with self.assertRaises(AttributeError):
+            status.name = 'changed'
+        # relationships are not part of the snapshot, nothing is lazy loaded
+        with self.assertRaises(AttributeError):
+            status.practice
+
+    def test_reloaded_after_edit(self):
+        from bcource.models import Policy
+        data = self.reference_data()
+        self.assertIs(self.reference_data(), data)
+
+        practice = Practice.default_row()
+        trainingtype = TrainingType(name='_functest type', practice=practice)
+        db.session.add(trainingtype)
+        db.session.commit()
+        self._test_trainingtype_ids.append(trainingtype.id)
+
+        reloaded = self.reference_data()
+        self.assertEqual(reloaded.version, data.version + 1)
+        self.assertIn(trainingtype.id, [t.id for t in reloaded.trainingtypes])
+        self.assertEqual(reloaded.policy_names(trainingtype.id), frozenset())
+
+        # a policy added to the type through the relationship bumps the version as well
+        trainingtype.policies.append(Policy(name='_functest policy', practice=practice))
+        db.session.commit()
+        self.assertEqual(self.reference_data().policy_names(trainingtype.id), {'_functest policy'})
+
+        # other changes do not
+        self.create_test_user_and_student()
+        self.assertEqual(self.reference_data().version, reloaded.version + 1)
+
+class AdminApiTestBase(FunctionalTestBase):
+    """Calls the admin API with the Bearer token of a db-admin test user."""
+
+    def setUp(self):
+        super().setUp()
+        from bcource import security
+        from bcource.admin_api.auth import generate_admin_token
+        admin, _student = self.create_test_user_and_student()
+        role = security.datastore.find_or_create_role(self.app.config['BCOURSE_SUPER_USER_ROLE'])
+        security.datastore.add_role_to_user(admin, role)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.api_headers = {'Authorization': f'Bearer {generate_admin_token(admin)}'}
+
+    def api_get(self, url):
+        return self.client.get(url, headers=self.api_headers)
+
+
+class TestAdminApiPagination(AdminApiTestBase):
+
+    def test_trainings_cursor_pages(self):
+        ids = sorted((self.create_test_training(max_participants=2).id for _n in range(3)), reverse=True)
+
+        resp = self.api_get('/admin-api/trainings/?limit=2')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([t['id'] for t in resp.get_json()], ids[:2])
+        self.assertEqual(resp.headers['X-Next-Cursor'], str(ids[1]))
+        self.assertIn(f'after={ids[1]}', resp.headers['Link'])
+
+        resp = self.api_get(f'/admin-api/trainings/?limit=2&after={ids[1]}')
+        self.assertEqual(resp.get_json()[0]['id'], ids[2])
+
+    def test_sparse_fields_load_only_what_they_need(self):
+        from sqlalchemy import event
+        training = self.create_test_training(max_participants=2)
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            resp = self.api_get(f'/admin-api/trainings/?limit=1&fields=id,name')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(resp.get_json(), [{'id': training.id, 'name': training.name}])
+        self.assertFalse([s for s in statements if 'training_enroll' in s or 'training_event' in s])
+
+        self.assertEqual(self.api_get('/admin-api/trainings/?fields=id,nope').status_code, 400)
+
+    def test_enrollments_cursor_pages(self):
+        training = self.create_test_training(max_participants=1)
+        for _n in range(3):
+            user, _student = self.create_test_user_and_student()
+            enroll_common(training, user)
+            training = self.fresh_training(training)
+
+        url = f'/admin-api/trainings/{training.id}/enrollments'
+        first = self.api_get(f'{url}?limit=2')
+        cursor = first.headers['X-Next-Cursor']
+        rest = self.api_get(f'{url}?limit=2&after={cursor}')
+        self.assertNotIn('X-Next-Cursor', rest.headers)
+
+        students = [e['student_id'] for e in first.get_json() + rest.get_json()]
+        self.assertEqual(len(students), 3)
+        self.assertEqual(students, [e.student_id for e in sorted(
+            training.trainingenrollments, key=lambda e: (e.enrole_date, e.student_id))])
+
+        self.assertEqual(self.api_get(f'{url}?after=999999').status_code, 400)
+
+    def test_students_cursor_pages_without_names(self):
+        students = []
+        for n in range(3):
+            user, student = self.create_test_user_and_student(f'noname{n}')
+            user.first_name = user.last_name = None
+            students.append(student.id)
+        db.session.commit()
+
+        found, after = [], ''
+        while True:
+            resp = self.api_get(f'/admin-api/students/?q=noname&limit=1{after}')
+            found += [s['id'] for s in resp.get_json()]
+            if 'X-Next-Cursor' not in resp.headers:
+                break
+            after = f'&after={resp.headers["X-Next-Cursor"]}'
+        self.assertEqual(found, sorted(students))
+
+class TestAdminApiChanges(AdminApiTestBase):
+
+    def poll(self, since):
+        """All changes after since, following has_more, and the last cursor."""
+        changes = []
+        while True:
+            data = self.api_get(f'/admin-api/changes/?since={since}').get_json()
+            changes += data['changes']
+            since = data['cursor']
+            if not data['has_more']:
+                return changes, since
+
+    def test_changes_and_tombstones_in_order(self):
+        _changes, cursor = self.poll(0)
+
+        training = self.create_test_training(max_participants=2)
+        user, student = self.create_test_user_and_student()
+        enroll_common(training, user)
+        training = self.fresh_training(training)
+        training.name = training.name + ' renamed'
+        db.session.commit()
+        event = training.trainingevents[0]
+        event_id = event.id
+        db.session.delete(event)
+        db.session.commit()
+
+        changes, cursor = self.poll(cursor)
+        # enroll_common updates the enrollment it just created (ical_sequence of the confirmation)
+        ours = [(c['entity'], c['op']) for c in changes
+                if c['training_id'] == training.id and (c['entity'], c['op']) != ('enrollment', 'updated')]
+        self.assertEqual(ours, [('training', 'created'), ('event', 'created'), ('enrollment', 'created'),
+                                ('training', 'updated'), ('event', 'deleted')])
+        self.assertEqual([c['cursor'] for c in changes], sorted(c['cursor'] for c in changes))
+
+        by_op = {(c['entity'], c['op']): c for c in changes if c['training_id'] == training.id}
+        self.assertEqual(by_op[('training', 'created')]['data']['name'], training.name)
+        self.assertEqual(by_op[('enrollment', 'created')]['student_id'], student.id)
+        self.assertEqual(by_op[('enrollment', 'created')]['data']['status'], 'enrolled')
+        self.assertEqual(by_op[('event', 'deleted')]['event_id'], event_id)
+        self.assertIsNone(by_op[('event', 'deleted')]['data'])
+        self.assertIsNone(by_op[('event', 'created')]['data'])
+
+        # nothing new: the cursor stays
+        self.assertEqual(self.poll(cursor), ([], cursor))
+
+    def test_changes_after_an_uncommitted_id_are_held_back(self):
+        from bcource.models import EntityChange
+        _changes, cursor = self.poll(0)
+        practice_id = Practice.default_row().id
+        last = db.session.scalar(db.select(db.func.max(EntityChange.id))) or 0
+        # last + 1 is taken by a transaction that has not committed yet
+        db.session.add(EntityChange(id=last + 2, practice_id=practice_id, entity='training', op='updated'))
+        db.session.commit()
+        self.assertEqual(self.poll(cursor), ([], cursor))
+
+        # the change after the gap is older than the longest transaction: the gap was rolled back
+        db.session.execute(db.update(EntityChange).where(EntityChange.id == last + 2).values(
+            created_date=datetime.utcnow() - timedelta(hours=1)))
+        db.session.commit()
+        changes, _cursor = self.poll(cursor)
+        self.assertEqual([c['cursor'] for c in changes], [last + 2])
+
+        # a late commit fills the gap before the cursor passes it
+        _changes, cursor = self.poll(0)
+        db.session.add(EntityChange(id=last + 5, practice_id=practice_id, entity='training', op='updated'))
+        db.session.commit()
+        self.assertEqual(self.poll(cursor), ([], cursor))
+        db.session.add(EntityChange(id=last + 3, practice_id=practice_id, entity='training', op='updated'))
+        db.session.add(EntityChange(id=last + 4, practice_id=practice_id, entity='training', op='updated'))
+        db.session.commit()
+        changes, _cursor = self.poll(cursor)
+        self.assertEqual([c['cursor'] for c in changes], [last + 3, last + 4, last + 5])
+
+    def test_rolled_back_changes_take_no_ids(self):
+        from bcource.models import EntityChange
+        training = self.create_test_training(max_participants=2)
+        _changes, cursor = self.poll(0)
+        last = db.session.scalar(db.select(db.func.max(EntityChange.id))) or 0
+        name = training.name
+
+        # a failed operation of a best-effort batch: its savepoint is rolled back
+        savepoint = db.session.begin_nested()
+        training.name = name + ' failed'
+        db.session.flush()
+        # no id is taken before the commit
+        self.assertEqual(db.session.scalar(db.select(db.func.max(EntityChange.id))) or 0, last)
+        savepoint.rollback()
+        training.name = name + ' renamed'
+        db.session.commit()
+        # a rolled back transaction
+        training = self.fresh_training(training)
+        training.name = name + ' rolled back'
+        db.session.flush()
+        db.session.rollback()
+        training = self.fresh_training(training)
+        training.name = name
+        db.session.commit()
+
+        self.assertEqual(db.session.scalars(db.select(EntityChange.id).where(
+            EntityChange.id > last).order_by(EntityChange.id)).all(), [last + 1, last + 2])
+        # nothing is held back behind a gap
+        changes, _cursor = self.poll(cursor)
+        self.assertEqual([(c['cursor'], c['op']) for c in changes], [(last + 1, 'updated'), (last + 2, 'updated')])
+
+
+class TestAdminApiBatch(AdminApiTestBase):
+
+    def batch(self, mode, operations):
+        return self.client.post('/admin-api/batch/', headers=self.api_headers,
+                                json={'mode': mode, 'operations': operations})
+
+    def enroll_ops(self, training, *students):
+        return [{'op': 'enroll', 'training_id': training.id, 'data': {'student_id': student.id}}
+                for student in students]
+
+    def enrolled(self, training):
+        db.session.rollback()
+        return {e.student_id for e in TrainingEnroll.query.filter_by(training_id=training.id)}
+
+    def test_atomic_batch_commits_and_notifies_after_commit(self):
+        from bcource.messages import SystemMessage
+        training = self.create_test_training(max_participants=1)
+        _user, first = self.create_test_user_and_student()
+        _user, second = self.create_test_user_and_student()
+
+        with patch.object(SystemMessage, 'send_bulk') as send_bulk:
+            resp = self.batch('atomic', self.enroll_ops(training, first, second) + [
+                {'op': 'update_training', 'training_id': training.id, 'data': {'name': training.name + ' renamed'}}])
+
+        data = resp.get_json()
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(data['committed'])
+        self.assertEqual([(r['status'], r['ok']) for r in data['results']], [(201, True), (201, True), (200, True)])
+        self.assertEqual([r['result']['status'] for r in data['results'][:2]], ['enrolled', 'waitlist'])
+        self.assertEqual(self.enrolled(training), {first.id, second.id})
+        # all notifications in one delivery, after the commit
+        send_bulk.assert_called_once()
+        self.assertGreaterEqual(len(send_bulk.call_args[0][0]), 4)
+
+    def test_atomic_batch_rolls_back_on_failure(self):
+        from bcource.messages import SystemMessage
+        training = self.create_test_training(max_participants=2)
+        _user, first = self.create_test_user_and_student()
+        _user, second = self.create_test_user_and_student()
+        operations = self.enroll_ops(training, first)
+        operations += [{'op': 'enroll', 'training_id': training.id, 'data': {'student_id': 0}}]
+        operations += self.enroll_ops(training, second)
+
+        with patch.object(SystemMessage, 'send_bulk') as send_bulk:
+            data = self.batch('atomic', operations).get_json()
+
+        self.assertFalse(data['committed'])
+        self.assertEqual([(r['status'], r['ok']) for r in data['results']], [(201, True), (400, False), (None, False)])
+        self.assertEqual(data['results'][1]['error'], 'Invalid student_id')
+        self.assertEqual(self.enrolled(training), set())
+        send_bulk.assert_not_called()
+
+    def test_best_effort_commits_the_successful_operations(self):
+        from bcource.messages import SystemMessage
+        training = self.create_test_training(max_participants=2)
+        _user, first = self.create_test_user_and_student()
+        _user, second = self.create_test_user_and_student()
+        operations = self.enroll_ops(training, first, first, second)
+
+        with patch.object(SystemMessage, 'send_bulk') as send_bulk:
+            data = self.batch('best-effort', operations).get_json()
+
+        self.assertTrue(data['committed'])
+        self.assertEqual([(r['status'], r['ok']) for r in data['results']], [(201, True), (409, False), (201, True)])
+        self.assertEqual(self.enrolled(training), {first.id, second.id})
+        send_bulk.assert_called_once()
+
+    def test_unknown_operation_rejects_the_batch(self):
+        resp = self.batch('atomic', [{'op': 'drop_everything'}])
+        self.assertEqual(resp.status_code, 400)
+
+    def test_operations_after_the_time_limit_are_not_run(self):
+        training = self.create_test_training(max_participants=2)
+        _user, first = self.create_test_user_and_student()
+        maximum = self.app.config['ADMIN_API_BATCH_MAX_SECONDS']
+        self.app.config['ADMIN_API_BATCH_MAX_SECONDS'] = -1
+        try:
+            data = self.batch('best-effort', self.enroll_ops(training, first)).get_json()
+        finally:
+            self.app.config['ADMIN_API_BATCH_MAX_SECONDS'] = maximum
+
+        self.assertEqual([(r['status'], r['ok']) for r in data['results']], [(503, False)])
+        self.assertEqual(self.enrolled(training), set())
+
+
+
+class TestAdminApiBulkMove(AdminApiTestBase):
+
+    def test_move_class_waitlists_when_target_is_full(self):
+        from bcource.models import EntityChange
+        source = self.create_test_training(max_participants=2)
+        students = []
+        for _n in range(3):
+            user, student = self.create_test_user_and_student()
+            source = self.fresh_training(source)
+            enroll_common(source, user)
+            students.append(student)
+        target = self.create_test_training(max_participants=2)
+        user, _student = self.create_test_user_and_student()
+        enroll_common(target, user)
+        last_change = db.session.scalar(db.select(db.func.max(EntityChange.id))) or 0
+
+        resp = self.client.post(f'/admin-api/trainings/{source.id}/enrollments/bulk-move', headers=self.api_headers,
+                                json={'student_ids': [s.id for s in students], 'target_training_id': target.id,
+                                      'operation': 'move', 'waitlist_when_full': True})
+        data = resp.get_json()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data['moved'], [s.id for s in students])
+        self.assertEqual(data['waitlisted'], [students[1].id])
+
+        db.session.expire_all()
+        moved = {e.student_id: (e.status, e.waitlist_position)
+                 for e in TrainingEnroll.query.filter(TrainingEnroll.student_id.in_([s.id for s in students]))}
+        self.assertEqual(moved, {students[0].id: ('enrolled', None), students[1].id: ('waitlist', 1),
+                                 students[2].id: ('waitlist', 2)})
+        self.assertEqual(TrainingEnroll.query.filter_by(training_id=source.id).count(), 0)
+        self.assertEqual(TrainingEnroll.query.filter_by(training_id=target.id).count(), 4)
+
+        changes = EntityChange.query.filter(EntityChange.id > last_change).all()
+        self.assertEqual(sorted((c.op, c.training_id) for c in changes),
+                         sorted([('deleted', source.id)] * 3 + [('created', target.id)] * 3))
+
+
+class TestChangeFeed(FunctionalTestBase):
+
+    def test_poll_dispatches_to_subscribers(self):
+        """One poll hands unread and enrollment changes to the subscribed user only."""
+        from bcource.user.change_feed import ChangeFeed
+        from bcource.messages import SystemMessage
+        training = self.create_test_training(max_participants=1)
+        user, _ = self.create_test_user_and_student()
+        other, _ = self.create_test_user_and_student()
+
+        feed = ChangeFeed(self.app)
+        self.assertEqual(feed.poll(), 0)
+        events = feed.subscribe(user.id)
+
+        enroll_common(training, user)
+        training = self.fresh_training(training)
+        enroll_common(training, other)
+        SystemMessage(envelop_to=[user], subject='_functest feed', body='<p>_functest</p>').send()
+        SystemMessage(envelop_to=[user], subject='_functest feed 2', body='<p>_functest</p>').send()
+
+        feed.poll()
+        received = {}
+        while not events.empty():
+            kind, data = events.get_nowait()
+            received.setdefault(kind, []).append(data)
+
+        self.assertEqual(received['enrollment'], [dict(training_id=training.id, status='enrolled')])
+        # two messages collapse into one event with the current count
+        self.assertEqual(received['unread'], [dict(unread=user.unread_messages)])
+        self.assertGreaterEqual(user.unread_messages, 2)
+        self.assertEqual(feed.poll(), 0)
+
+        feed.unsubscribe(user.id, events)
+        self.assertEqual(feed.subscribers, {})
+
+    def test_poll_reads_ids_that_commit_late(self):
+        """An id skipped by a poll (its transaction still open) is delivered by a later poll."""
+        from bcource.user.change_feed import ChangeFeed
+        from bcource.models import UserChange
+        user, _ = self.create_test_user_and_student()
+        feed = ChangeFeed(self.app)
+        feed.poll()
+        events = feed.subscribe(user.id)
+
+        late = feed.last_id + 1
+        change = dict(user_id=user.id, kind='enrollment', value='enrolled')
+        db.session.execute(UserChange.__table__.insert(), [dict(change, id=late + 1, ref_id=2)])
+        db.session.commit()
+        self.assertEqual(feed.poll(), 1)
+        self.assertIn(late, feed.gaps)
+
+        db.session.execute(UserChange.__table__.insert(), [dict(change, id=late, ref_id=1)])
+        db.session.commit()
+        self.assertEqual(feed.poll(), 1)
+        self.assertEqual(feed.gaps, {})
+        received = [events.get_nowait()[1]['training_id'] for _n in range(events.qsize())]
+        self.assertEqual(received, [2, 1])
+
+    def test_streams_are_capped(self):
+        from bcource.user.change_feed import ChangeFeed
+        feed = ChangeFeed(self.app)
+        per_user = self.app.config['BCOURSE_SSE_MAX_STREAMS_PER_USER']
+        self.assertTrue(all(feed.subscribe(1) for _n in range(per_user)))
+        self.assertIsNone(feed.subscribe(1))
+        while sum(len(c) for c in feed.subscribers.values()) < self.app.config['BCOURSE_SSE_MAX_STREAMS']:
+            feed.subscribe(len(feed.subscribers) + 1)
+        self.assertIsNone(feed.subscribe(1000))
+
+    def test_events_slot_released_when_response_closes(self):
+        """A stream that is closed before it started does not keep its slot."""
+        from bcource.user.change_feed import ChangeFeed
+        from bcource.user.user_views import events
+        user, _ = self.create_test_user_and_student()
+        feed = ChangeFeed.get(self.app)
+        with patch.object(ChangeFeed, 'start'), \
+                patch('bcource.user.user_views.current_user', user):
+            response = events.__wrapped__()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(feed.subscribers.get(user.id, ())), 1)
+        response.close()
+        self.assertNotIn(user.id, feed.subscribers)
+
+    def test_events_endpoint_requires_login(self):
+        response = self.app.test_client().get('/account/events')
+        self.assertNotEqual(response.status_code, 200)
+
 if __name__ == '__main__':
     unittest.main()
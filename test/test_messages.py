@@ -26,6 +26,8 @@ from bcource.messages import (
     EmailStudentEnrolledInTrainingWaitlist,
     EmailAttendeeListReminder
 )
+from bcource.ical import TrainingCalendar
+from icalendar import Calendar
 
 
 class TestCleanHTML(unittest.TestCase):
@@ -60,6 +62,29 @@ class TestCleanHTML(unittest.TestCase):
         self.assertIn("Text", result)
 
 
+    def test_cleanhtml_links_and_lists(self):
+        """Test links keep their url and list items get a bullet."""
+        html = '<p>See <a href="https://example.com">site</a></p><ul><li>one</li><li>two</li></ul>'
+        result = cleanhtml(html)
+        self.assertIn("site (https://example.com)", result)
+        self.assertIn("• one", result)
+        self.assertIn("• two", result)
+
+    def test_cleanhtml_entities_and_scripts(self):
+        """Test entities are decoded and script content is dropped."""
+        result = cleanhtml("<p>a &amp; b</p><script>alert(1)</script><br>c")
+        self.assertEqual(result, "a & b\n\nc")
+
+    def test_cleanhtml_memoized(self):
+        """Test the conversion is memoized by content."""
+        html = "<p>_memo_ test</p>"
+        with patch('bcource.messages._html_to_text', return_value="memo") as mock_convert:
+            first = cleanhtml(html)
+            second = cleanhtml(html)
+        self.assertEqual(first, second)
+        self.assertLessEqual(mock_convert.call_count, 1)
+
+
 class TestSystemMessage(unittest.TestCase):
     """Test SystemMessage base class."""
 
@@ -193,6 +218,21 @@ class TestSystemMessage(unittest.TestCase):
             self.assertEqual(call_kwargs['envelop_to'], [mock_user])
             self.assertEqual(call_kwargs['tags'], ['test'])
 
+    @patch('bcource.messages.Message.create_db_messages')
+    def test_system_message_send_bulk(self, mock_create_db_messages):
+        """Test send_bulk stores all messages with one create_db_messages call."""
+        mock_user1 = Mock()
+        mock_user2 = Mock()
+
+        msgs = [SystemMessage(envelop_to=mock_user1, body="<p>One</p>", subject="One", taglist=['a']),
+                SystemMessage(envelop_to=mock_user2, body="<p>Two</p>", subject="Two", taglist=['b'])]
+        SystemMessage.send_bulk(msgs)
+
+        mock_create_db_messages.assert_called_once()
+        stored = mock_create_db_messages.call_args[0][1]
+        self.assertEqual([m['envelop_to'] for m in stored], [[mock_user1], [mock_user2]])
+        self.assertEqual([m['tags'] for m in stored], [['a'], ['b']])
+
     def test_system_message_uses_class_name_as_content_tag(self):
         """Test that class name is used as CONTENT_TAG by default."""
         mock_user = Mock()
@@ -223,6 +263,80 @@ class TestSystemMessage(unittest.TestCase):
             self.assertEqual(msg.kwargs['custom_var'], 'value')
 
 
+class TestCreateDbMessages(unittest.TestCase):
+    """Test the bulk message fan-out against the database."""
+
+    def setUp(self):
+        from bcource import create_app, db
+        from bcource.models import User
+        self.app = create_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.db = db
+        self.users = User.query.limit(2).all()
+
+    def tearDown(self):
+        from bcource.models import Message
+        Message.query.filter(Message.subject.like('_MSGTEST_%')).delete(synchronize_session=False)
+        self.db.session.commit()
+        self.app_context.pop()
+
+    def test_create_db_messages(self):
+        """Test recipients and tags are stored for every message."""
+        from bcource.models import Message, MessageTag
+        if len(self.users) < 2:
+            self.skipTest('Needs two users in the database')
+
+        sender, recipient = self.users
+        MessageTag.get_tag_ids(['msgtest', 'email'])
+        with patch.object(self.db.session, 'commit', wraps=self.db.session.commit) as mock_commit:
+            messages = Message.create_db_messages(self.db.session, [
+                dict(envelop_from=sender, envelop_to=[recipient, sender, recipient],
+                     subject='_MSGTEST_1', body='<p>one</p>', tags=['msgtest', 'email']),
+                dict(envelop_from=sender, envelop_to=[recipient],
+                     subject='_MSGTEST_2', body='<p>two</p>', tags=['msgtest']),
+            ])
+            self.assertEqual(mock_commit.call_count, 1)
+
+        first, second = [self.db.session.get(Message, m.id) for m in messages]
+        self.assertEqual(sorted(a.user_id for a in first.envelop_to), sorted([recipient.id, sender.id]))
+        self.assertEqual(sorted(t.tag for t in first.tags), ['email', 'msgtest'])
+        self.assertEqual([a.user_id for a in second.envelop_to], [recipient.id])
+        self.assertEqual(MessageTag.get_tag_ids(['msgtest'])['msgtest'], second.tags[0].id)
+
+    def test_bodies_deduplicated(self):
+        """Test identical bodies share one message_body row."""
+        from bcource.models import Message, MessageBody
+        if len(self.users) < 2:
+            self.skipTest('Needs two users in the database')
+
+        sender, recipient = self.users
+        body = '<p>_MSGTEST_ identical reminder body</p>'
+        messages = Message.create_db_messages(self.db.session, [
+            dict(envelop_from=sender, envelop_to=[recipient], subject='_MSGTEST_a', body=body),
+            dict(envelop_from=sender, envelop_to=[recipient], subject='_MSGTEST_b', body=body),
+        ])
+        again = Message.create_db_message(self.db.session, sender, [recipient], '_MSGTEST_c', body)
+
+        self.assertEqual(messages[0].body_id, messages[1].body_id)
+        self.assertEqual(messages[0].body_id, again.body_id)
+        self.assertEqual(again.body, body)
+        self.assertEqual(MessageBody.query.filter(
+            MessageBody.hash == MessageBody.content_hash(body)).count(), 1)
+
+    def test_compressed_body(self):
+        """Test bodies above the threshold are stored compressed and read back."""
+        from bcource.models import MessageBody
+        body = '<p>' + 'compressible ' * 100 + '</p>'
+        obj = MessageBody.from_text(body, compress_min=64)
+
+        self.assertTrue(obj.compressed)
+        self.assertIsNone(obj.body)
+        self.assertLess(len(obj.data), len(body))
+        self.assertEqual(obj.text, body)
+        self.assertFalse(MessageBody.from_text('<p>short</p>', compress_min=64).compressed)
+
+
 class TestSendEmail(unittest.TestCase):
     """Test SendEmail class."""
 
@@ -294,6 +408,43 @@ class TestSendEmail(unittest.TestCase):
                 self.assertEqual(mock_email_msg.call_count, 2)
                 self.assertEqual(mock_msg_instance.send.call_count, 2)
 
+    @patch('bcource.messages.EmailMultiAlternatives')
+    def test_send_email_renders_once_per_language(self, mock_email_msg):
+        """Test that the template is rendered once per language, not per recipient."""
+        def make_user(email, lang):
+            user = Mock()
+            user.email = email
+            user.fullname = email
+            user.usersettings.language = lang
+            user.usersettings.msg_transactional_emails = True
+            return user
+
+        users = [make_user("nl1@example.com", "nl"),
+                 make_user("en1@example.com", "en"),
+                 make_user("nl2@example.com", "nl")]
+
+        with patch('bcource.messages.Content') as mock_content:
+            mock_content.get_tag.return_value = "Body"
+            mock_content.get_subject.return_value = "Subject"
+            mock_content.render.side_effect = lambda tag, lang=None, **kw: (f"<p>Body {lang}</p>", f"Subject {lang}")
+
+            with patch('bcource.messages.security.datastore.find_user') as mock_find:
+                mock_system_user = Mock()
+                mock_system_user.email = "system@example.com"
+                mock_system_user.fullname = "System"
+                mock_find.return_value = mock_system_user
+
+                msg = SendEmail(envelop_to=users, CONTENT_TAG="test_tag")
+                mock_find.reset_mock()
+                msg.send_email()
+
+                self.assertEqual(mock_find.call_count, 1)
+
+            self.assertEqual(mock_content.render.call_count, 2)
+            self.assertEqual(mock_email_msg.call_count, 3)
+            subjects = [c.kwargs['subject'] for c in mock_email_msg.call_args_list]
+            self.assertEqual(subjects, ["Subject nl", "Subject en", "Subject nl"])
+
     def test_send_email_render_body(self):
         """Test email_render_body returns body."""
         mock_user = Mock()
@@ -462,6 +613,83 @@ class TestEmailWithICalAttachments(unittest.TestCase):
         self.assertIn('enrollment', str(context.exception))
 
 
+class TestTrainingCalendar(unittest.TestCase):
+    """Test the cached iCalendar builder."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        TrainingCalendar.clear()
+
+        self.mock_location = Mock()
+        self.mock_location.ical_adress = "Test Location, 123 Main St"
+        self.mock_location.update_datetime = datetime.datetime(2025, 1, 1)
+
+        self.mock_events = []
+        for day in (15, 22):
+            event = Mock()
+            event.id = day
+            event.start_time = datetime.datetime(2025, 6, day, 10, 0, 0)
+            event.end_time = datetime.datetime(2025, 6, day, 12, 0, 0)
+            event.location = self.mock_location
+            event.location_id = 1
+            event.update_datetime = datetime.datetime(2025, 1, 1)
+            self.mock_events.append(event)
+
+        self.mock_training = Mock()
+        self.mock_training.id = 7
+        self.mock_training.name = "Test Training"
+        self.mock_training.update_datetime = datetime.datetime(2025, 1, 1)
+        self.mock_training.trainingevents = self.mock_events
+
+    def make_user(self, email):
+        user = Mock()
+        user.email = email
+        user.fullname = email.split('@')[0]
+        return user
+
+    def test_to_ical_patches_attendee_uid_and_sequence(self):
+        """Test that the serialized calendar carries the recipient fields on every event."""
+        calendar = TrainingCalendar.get(self.mock_training, 'confirmed')
+        data = calendar.to_ical(self.make_user("alice@example.com"), "uuid-alice", 3)
+
+        cal = Calendar.from_ical(data)
+        self.assertEqual(str(cal['method']), 'REQUEST')
+        events = cal.walk('VEVENT')
+        self.assertEqual(len(events), 2)
+        for event in events:
+            self.assertEqual(str(event['uid']), 'uuid-alice')
+            self.assertEqual(event['sequence'], 3)
+            self.assertEqual(str(event['status']), 'CONFIRMED')
+            self.assertEqual(str(event['attendee']), 'mailto:alice@example.com')
+            self.assertEqual(event['attendee'].params['PARTSTAT'], 'ACCEPTED')
+            self.assertEqual(str(event['location']), "Test Location, 123 Main St")
+
+        other = Calendar.from_ical(calendar.to_ical(self.make_user("bob@example.com"), "uuid-bob", 1))
+        self.assertEqual(str(other.walk('VEVENT')[0]['attendee']), 'mailto:bob@example.com')
+
+    def test_cancelled_variant(self):
+        """Test the cancellation calendar."""
+        data = TrainingCalendar.get(self.mock_training, 'cancelled').to_ical(
+            self.make_user("alice@example.com"), "uuid-alice", 2)
+        cal = Calendar.from_ical(data)
+        self.assertEqual(str(cal['method']), 'CANCEL')
+        event = cal.walk('VEVENT')[0]
+        self.assertEqual(str(event['summary']), 'CANCELLED: Test Training')
+        self.assertEqual(event['attendee'].params['PARTSTAT'], 'DECLINED')
+
+    def test_skeleton_cached_until_event_changes(self):
+        """Test that the skeleton is reused until an event is updated."""
+        first = TrainingCalendar.get(self.mock_training, 'confirmed')
+        self.assertIs(TrainingCalendar.get(self.mock_training, 'confirmed'), first)
+        self.assertIsNot(TrainingCalendar.get(self.mock_training, 'waitlist'), first)
+
+        self.mock_events[1].update_datetime = datetime.datetime(2025, 2, 1)
+        self.mock_events[1].start_time = datetime.datetime(2025, 6, 23, 10, 0, 0)
+        rebuilt = TrainingCalendar.get(self.mock_training, 'confirmed')
+        self.assertIsNot(rebuilt, first)
+        self.assertIn(b'20250623T100000Z', rebuilt.to_ical(self.make_user("a@example.com"), "u", 1))
+
+
 class TestEmailAttendeeListReminder(unittest.TestCase):
     """Test EmailAttendeeListReminder class."""
 